@@ -1,53 +1,462 @@
 import os
+import time
+import atexit
+import hashlib
+import functools
+from io import BytesIO
 
 import boto3
-
-
-from chalice import Chalice, BadRequestError
+import jmespath
+from chalice import Chalice, BadRequestError, Response
 from chalicelib.storage import Config, S3Storage, MaxSizeError, CachingStorage
-from chalicelib.storage import SemiDBMCache
+from chalicelib.storage import DeadlineExceededError
+from chalicelib.storage import SemiDBMCache, create_s3_client
+from chalicelib.storage import SharedSemiDBMCache, CircuitBreakingStorage
+from chalicelib.storage import MAX_POOL_CONNECTIONS, MAX_BODY_SIZE
+from chalicelib.storage import MAX_BATCH_SIZE
+from chalicelib.storage import DEFAULT_SERIALIZER, WRITE_BUFFER_INTERVAL
+from chalicelib.metrics import Metrics, Reporter, REPORT_INTERVAL
+from chalicelib.listings import Listings, RECENT_SIZE, POPULAR_SIZE
+from chalicelib.search import SearchIndex, S3SegmentStore
+from chalicelib.publish import Publisher
+from chalicelib.limits import check_structure, StructureLimitError
+from chalicelib.limits import MAX_DEPTH, MAX_NODES, MAX_STRING_LENGTH
+from chalicelib.breaker import CircuitOpenError, FAILURE_RATE
+from chalicelib.breaker import SLOW_CALL_DURATION, OPEN_DURATION
+from chalicelib.evaluate import EvaluationPool, EvaluationError
+from chalicelib.evaluate import LimitExceededError, PoolBusyError
+from chalicelib.evaluate import TIMEOUT, MEMORY_LIMIT, MAX_RESULT_SIZE
+from chalicelib.evaluate import iter_lines, encode_outcome
+from chalicelib.serializers import get_serializer
+from chalicelib.profiling import Profiler, FileSink, S3Sink
+from chalicelib.ratelimit import RateLimiter, RateLimitExceeded, Budget
+from chalicelib.ratelimit import DynamoDBBackend
 from chalicelib.schema import SavedQuery
 
 
 CACHE_DIR = '/tmp/appcache'
+# Evaluation outcomes are cached separately from shares, with their
+# own (smaller) size limit, so evaluations can't fill up the share
+# cache and turn it off.
+EVAL_CACHE_DIR = os.path.join(CACHE_DIR, 'eval')
+EVAL_CACHE_SIZE = 50 * 1024 * 1024
+MAX_CACHED_OUTCOME_SIZE = 64 * 1024
+# Default per client budgets, as '<tokens per second>/<burst>'.  The
+# 'bytes' budget limits the number of bytes written.
+RATE_LIMITS = {
+    'read': '20/100',
+    'write': '1/20',
+    'bytes': '%s/%s' % (100 * 1024, 2 * 1024 * 1024),
+    'eval': '5/50',
+}
+
+MAX_SEARCH_RESULTS = 100
+# The most queries that can be saved with one POST /anon/batch.
+MAX_BATCH_ITEMS = 1000
 
 app = Chalice(app_name='jmespath-playground')
 app.debug = True
 app.context = {}
+# None unless profiling is enabled with APP_PROFILE or
+# APP_PROFILE_SECRET, in which case request handlers are wrapped
+# with the profiler (see profiled()).
+PROFILER = Profiler.from_environ(os.environ)
 
 
 def before_request(app):
     if 'storage' in app.context:
+        reporter = app.context.get('reporter')
+        if reporter is not None:
+            reporter.maybe_report()
         return
-    s3 = boto3.client('s3')
-    config = Config(
-        bucket=os.environ['APP_S3_BUCKET'],
-        prefix=os.environ.get('APP_S3_PREFIX', ''),
-    )
+    config = _create_config()
+    # The client (and its connection pool) lives in app.context
+    # so warm containers reuse connections across invocations.
+    s3 = create_s3_client(config)
+    metrics = Metrics()
     if not os.path.isdir(CACHE_DIR):
         os.makedirs(CACHE_DIR)
-    cache = SemiDBMCache(CACHE_DIR)
+    # When several processes serve the app from the same host (see
+    # serve.py --workers) they need to coordinate writes to the cache.
+    cache_class = SemiDBMCache
+    if os.environ.get('APP_CACHE_SHARED', '').lower() == 'true':
+        cache_class = SharedSemiDBMCache
+    # Chunked documents are cached as individual chunks rather than
+    # as a whole, so the cache doesn't hold two copies of them.
+    # Writes can be buffered and written out in batches, see
+    # SemiDBMCache.
+    cache = cache_class(
+        CACHE_DIR, max_item_size=config.chunk_size,
+        serializer=get_serializer(os.environ.get('APP_CACHE_FORMAT',
+                                                 config.serializer)),
+        write_buffer_size=_optional_int(
+            os.environ.get('APP_CACHE_WRITE_BUFFER')),
+        write_buffer_interval=float(os.environ.get(
+            'APP_CACHE_WRITE_INTERVAL', WRITE_BUFFER_INTERVAL)))
+    # A large cache left behind by a previous container is reopened
+    # from its index snapshot rather than by scanning it.
+    metrics.timing('cache.open', cache.open_stats['open_time'])
+    atexit.register(cache.close)
     storage = S3Storage(client=s3,
-                        config=config)
-    app.context['storage'] = CachingStorage(storage, cache)
+                        config=config,
+                        metrics=metrics,
+                        remaining_time=_remaining_time,
+                        chunk_cache=cache)
+    app.context['metrics'] = metrics
+    app.context['cache'] = cache
+    app.context['rate_limiter'] = _create_rate_limiter()
+    if PROFILER is not None:
+        if os.environ.get('APP_PROFILE_SINK') == 's3':
+            PROFILER.sink = S3Sink(s3, config.bucket, config.prefix)
+        else:
+            PROFILER.sink = FileSink(os.path.join(CACHE_DIR, 'profiles'))
+    app.context['search'] = SearchIndex(
+        S3SegmentStore(s3, config.bucket, config.prefix),
+        local_dir=os.path.join(CACHE_DIR, 'search'))
+    # Reads that miss the cache, and writes, fail fast while S3 is
+    # having problems rather than tying up the container.
+    breaker_storage = _create_breaker_storage(storage, metrics)
+    if breaker_storage is not None:
+        app.context['breaker'] = breaker_storage.breaker
+        storage = breaker_storage
+    # Listings are maintained as index objects in S3, so they don't
+    # require listing or reading every stored query.  They're flushed
+    # from the request path, so they go through the breaker too.
+    listings = Listings(storage)
+    app.context['listings'] = listings
+    app.context['storage'] = CachingStorage(
+        storage, cache, metrics=metrics, listings=listings,
+        publisher=_create_publisher(s3, config, metrics),
+        max_stream_size=config.max_body_size)
+    # Expressions posted to /eval are run in worker processes, which
+    # are started by the first one.
+    if not os.path.isdir(EVAL_CACHE_DIR):
+        os.makedirs(EVAL_CACHE_DIR)
+    eval_cache = cache_class(EVAL_CACHE_DIR, max_filesize=EVAL_CACHE_SIZE,
+                             max_item_size=MAX_CACHED_OUTCOME_SIZE)
+    atexit.register(eval_cache.close)
+    app.context['eval_cache'] = eval_cache
+    evaluator = EvaluationPool(
+        workers=_optional_int(os.environ.get('APP_EVAL_WORKERS')),
+        timeout=float(os.environ.get('APP_EVAL_TIMEOUT', TIMEOUT)),
+        memory_limit=int(os.environ.get('APP_EVAL_MEMORY_LIMIT',
+                                        MEMORY_LIMIT)),
+        max_result_size=int(os.environ.get('APP_EVAL_MAX_RESULT_SIZE',
+                                           MAX_RESULT_SIZE)),
+        cache=eval_cache, metrics=metrics)
+    atexit.register(evaluator.stop)
+    app.context['evaluator'] = evaluator
+    # The metrics are periodically written to the log.
+    sources = {'evaluator': evaluator.stats}
+    if 'breaker' in app.context:
+        sources['breaker'] = app.context['breaker'].stats
+    interval = os.environ.get('APP_METRICS_INTERVAL', str(REPORT_INTERVAL))
+    if interval != 'off':
+        reporter = Reporter(metrics, interval=float(interval),
+                            sources=sources)
+        atexit.register(reporter.report)
+        app.context['reporter'] = reporter
+
+
+def after_fork():
+    # Called in each worker process forked by serve.py, after
+    # before_request() has initialized everything in the parent.  The
+    # S3 client hasn't made any requests yet so it has no connections
+    # to share, but the cache's file descriptors need reopening.
+    for name in ('cache', 'eval_cache'):
+        cache = app.context.get(name)
+        if cache is not None:
+            cache.after_fork()
+
+
+def before_exit():
+    # Called by serve.py's worker processes, which exit with
+    # os._exit() and so don't run the atexit handlers registered by
+    # before_request().  Writes out buffered cache entries.
+    for name in ('cache', 'eval_cache'):
+        cache = app.context.get(name)
+        if cache is not None:
+            cache.close()
+
+
+def _create_config():
+    env = os.environ
+    return Config(
+        bucket=env['APP_S3_BUCKET'],
+        prefix=env.get('APP_S3_PREFIX', ''),
+        max_body_size=_max_body_size(),
+        max_batch_size=int(env.get('APP_MAX_BATCH_SIZE', MAX_BATCH_SIZE)),
+        chunk_size=_optional_int(env.get('APP_S3_CHUNK_SIZE')),
+        shards=int(env.get('APP_S3_SHARDS', 0)),
+        serializer=env.get('APP_SERIALIZER', DEFAULT_SERIALIZER),
+        dedupe_data=env.get('APP_S3_DEDUPE_DATA', '').lower() == 'true',
+        max_pool_connections=int(env.get('APP_S3_MAX_POOL_CONNECTIONS',
+                                         MAX_POOL_CONNECTIONS)),
+        connect_timeout=float(env.get('APP_S3_CONNECT_TIMEOUT', 2)),
+        read_timeout=float(env.get('APP_S3_READ_TIMEOUT', 5)),
+        retry_mode=env.get('APP_S3_RETRY_MODE', 'adaptive'),
+        max_attempts=int(env.get('APP_S3_MAX_ATTEMPTS', 3)),
+        hedge_reads=env.get('APP_S3_HEDGE_READS', '').lower() == 'true',
+        hedge_percentile=float(env.get('APP_S3_HEDGE_PERCENTILE', 95)),
+    )
+
+
+def _create_breaker_storage(storage, metrics):
+    env = os.environ
+    failure_rate = env.get('APP_BREAKER_FAILURE_RATE', str(FAILURE_RATE))
+    if failure_rate == 'off':
+        return None
+    return CircuitBreakingStorage(
+        storage, metrics=metrics, failure_rate=float(failure_rate),
+        slow_call_duration=float(env.get('APP_BREAKER_SLOW_CALL',
+                                         SLOW_CALL_DURATION)),
+        open_duration=float(env.get('APP_BREAKER_OPEN_DURATION',
+                                    OPEN_DURATION)))
+
+
+def _create_publisher(s3, config, metrics):
+    # Static copies of shares for a CDN to serve (see
+    # chalicelib.publish), only made if a prefix is given.
+    prefix = os.environ.get('APP_PUBLISH_PREFIX')
+    if not prefix:
+        return None
+    return Publisher(s3, os.environ.get('APP_PUBLISH_BUCKET', config.bucket),
+                     prefix,
+                     threshold=int(os.environ.get('APP_PUBLISH_THRESHOLD', 0)),
+                     metrics=metrics)
+
+
+def _create_rate_limiter():
+    # Each budget can be overridden with APP_RATE_LIMIT_<NAME>, where
+    # 'off' disables it.  Buckets are kept in memory, so limits are per
+    # container, unless APP_RATE_LIMIT_TABLE names a DynamoDB table to
+    # share them across containers.
+    budgets = {}
+    for name, default in RATE_LIMITS.items():
+        value = os.environ.get('APP_RATE_LIMIT_%s' % name.upper(), default)
+        if value != 'off':
+            budgets[name] = Budget.parse(value)
+    backend = None
+    table_name = os.environ.get('APP_RATE_LIMIT_TABLE')
+    if table_name:
+        backend = DynamoDBBackend(boto3.client('dynamodb'), table_name)
+    return RateLimiter(budgets, backend=backend)
+
+
+def _max_body_size():
+    return int(os.environ.get('APP_MAX_BODY_SIZE', MAX_BODY_SIZE))
+
+
+def _optional_int(value):
+    if not value:
+        return None
+    return int(value)
+
+
+def _remaining_time():
+    # Not set when the app is run outside of lambda (e.g chalice local).
+    context = getattr(app, 'lambda_context', None)
+    if context is None:
+        return None
+    return context.get_remaining_time_in_millis() / 1000.0
+
+
+def profiled(view):
+    # Handlers are left untouched when profiling is disabled
+    # so there's no overhead.
+    if PROFILER is None:
+        return view
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with PROFILER.profile(app.current_request.headers):
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def rate_limited(*budgets, costs=None):
+    # costs maps a budget name to a function returning the cost of a
+    # request, by default 1 (or the body size for 'bytes').
+    costs = costs or {}
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            before_request(app)
+            request = app.current_request
+            client = _get_client_id((request.context or {}).get('identity'))
+            charges = []
+            for name in budgets:
+                cost = 1
+                if name in costs:
+                    cost = costs[name](request)
+                elif name == 'bytes':
+                    cost = len(request.raw_body or b'')
+                charges.append((name, cost))
+            try:
+                app.context['rate_limiter'].check_all(client, charges)
+            except RateLimitExceeded as e:
+                return _too_many_requests(e)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _too_many_requests(error):
+    app.context['metrics'].incr('ratelimit.%s' % error.budget)
+    return Response(
+        body={'Code': 'TooManyRequestsError', 'Message': str(error)},
+        status_code=429,
+        headers={'Retry-After': str(int(error.retry_after) + 1)})
+
+
+def fails_fast(view):
+    # Requests that can't be served while the storage circuit breaker
+    # is open get a 503 straight away.
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            return view(*args, **kwargs)
+        except CircuitOpenError as e:
+            return Response(
+                body={'Code': 'ServiceUnavailable', 'Message': str(e)},
+                status_code=503,
+                headers={'Retry-After': str(int(e.retry_after) + 1)})
+    return wrapper
+
+
+def _get_client_id(identity):
+    # identity is the request context's identity.  Only API keys
+    # validated by API Gateway appear there, the X-Api-Key header
+    # itself could be anything, so a client could get a fresh bucket
+    # per request (and push everyone else out of the memory backend)
+    # by making them up.
+    identity = identity or {}
+    api_key = identity.get('apiKey')
+    if api_key:
+        # No need to hold on to the API keys themselves.
+        return 'key:%s' % hashlib.sha256(
+            api_key.encode('utf-8')).hexdigest()[:32]
+    return 'ip:%s' % identity.get('sourceIp')
 
 
 @app.route('/anon', methods=['POST'], cors=True)
+@rate_limited('write', 'bytes')
+@profiled
+@fails_fast
 def new_anonymous_query():
     before_request(app)
-    try:
-        body = app.current_request.json_body
-    except ValueError as e:
-        raise BadRequestError("Invalid JSON: %s" % e)
+    body = _parse_json_body(app.current_request)
     _validate_body(body)
     storage = app.context['storage']
     try:
         uuid = storage.put(body)
     except MaxSizeError as e:
         raise BadRequestError(str(e))
+    app.context['search'].add(uuid, body['query'])
     return {'uuid': uuid}
 
 
+@app.route('/anon/batch', methods=['POST'], cors=True)
+@rate_limited('bytes')
+@profiled
+@fails_fast
+def new_anonymous_queries():
+    # Saves {"queries": [<saved query>, ...]} and returns a result per
+    # query, either {"uuid": ...} or {"error": ...}.  Invalid queries
+    # don't stop the rest of the batch from being saved.
+    before_request(app)
+    request = app.current_request
+    body = _parse_json_body(request, batch=True)
+    if not isinstance(body, dict) or \
+            not isinstance(body.get('queries'), list):
+        raise BadRequestError("Request body must contain a list of queries.")
+    queries = body['queries']
+    if len(queries) > MAX_BATCH_ITEMS:
+        raise BadRequestError("Too many queries (%s), must be at most %s." %
+                              (len(queries), MAX_BATCH_ITEMS))
+    # A batch costs a write per query, which is only known once the
+    # body is parsed (bytes are checked before parsing it).
+    client = _get_client_id((request.context or {}).get('identity'))
+    limiter = app.context['rate_limiter']
+    try:
+        limiter.check(client, 'write', max(len(queries), 1))
+    except RateLimitExceeded as e:
+        limiter.refund(client, 'bytes', len(request.raw_body or b''))
+        return _too_many_requests(e)
+    errors = _validate_queries(queries)
+    valid = [query for i, query in enumerate(queries) if i not in errors]
+    try:
+        saved = iter(app.context['storage'].put_many(valid))
+    except MaxSizeError as e:
+        raise BadRequestError(str(e))
+    results = []
+    for i, query in enumerate(queries):
+        if i in errors:
+            results.append({'error': errors[i]})
+            continue
+        uuid = next(saved)
+        if isinstance(uuid, MaxSizeError):
+            results.append({'error': str(uuid)})
+            continue
+        elif isinstance(uuid, Exception):
+            results.append({'error': "Unable to save query, please retry."})
+            continue
+        app.context['search'].add(uuid, query['query'])
+        results.append({'uuid': uuid})
+    return {'results': results}
+
+
+def _parse_json_body(request, batch=False):
+    # The body's structure is checked before it's parsed, so a
+    # pathological document is rejected without paying for parsing it
+    # (or anything done with it afterwards).
+    try:
+        _check_structure(request, batch)
+    except StructureLimitError as e:
+        app.context['metrics'].incr('limits.%s' % e.limit)
+        raise BadRequestError(str(e))
+    try:
+        return request.json_body
+    except ValueError as e:
+        raise BadRequestError("Invalid JSON: %s" % e)
+
+
+def _check_structure(request, batch=False):
+    env = os.environ
+    max_depth = int(env.get('APP_MAX_DEPTH', MAX_DEPTH))
+    max_nodes = int(env.get('APP_MAX_NODES', MAX_NODES))
+    if batch:
+        # Queries are nested two levels down in a batch, which can
+        # hold as many values as the largest batch of full size
+        # queries would.
+        max_depth += 2
+        queries = int(env.get('APP_MAX_BATCH_SIZE',
+                              MAX_BATCH_SIZE)) // _max_body_size()
+        max_nodes *= max(queries, 1)
+    check_structure(request.raw_body or b'', max_depth=max_depth,
+                    max_nodes=max_nodes,
+                    max_string_length=int(env.get('APP_MAX_STRING_LENGTH',
+                                                  MAX_STRING_LENGTH)))
+
+
+def _validate_queries(queries):
+    # Returns a dict of index -> errors for the invalid queries.  One
+    # schema is used for every query, and isn't given the whole list
+    # (with many=True) since that doesn't report which item wasn't an
+    # object.
+    schema = SavedQuery()
+    errors = {}
+    for i, query in enumerate(queries):
+        if not isinstance(query, dict):
+            errors[i] = "Query must be an object."
+            continue
+        result = schema.load(query)
+        if result.errors:
+            errors[i] = result.errors
+    return errors
+
+
 def _validate_body(body):
     if body is None:
         raise BadRequestError("Request body cannot be empty.")
@@ -56,16 +465,209 @@ def _validate_body(body):
         raise BadRequestError(data.errors)
 
 
+@app.route('/eval', methods=['POST'], cors=True)
+@rate_limited('eval')
+@profiled
+def evaluate_query():
+    # Evaluates a saved query's expression against its data, returning
+    # {"result": ...}.
+    before_request(app)
+    request = app.current_request
+    # The same limit as for saving a query.
+    max_body_size = _max_body_size()
+    if len(request.raw_body or b'') > max_body_size:
+        raise BadRequestError("Request body is too large, must be less "
+                              "than %s bytes." % max_body_size)
+    body = _parse_json_body(request)
+    _validate_body(body)
+    try:
+        result = app.context['evaluator'].evaluate(body['query'],
+                                                   body['data'])
+    except EvaluationError as e:
+        raise BadRequestError(str(e))
+    except LimitExceededError as e:
+        return Response(body={'Code': 'UnprocessableEntityError',
+                              'Message': str(e)},
+                        status_code=422)
+    except PoolBusyError as e:
+        return Response(body={'Code': 'ServiceUnavailableError',
+                              'Message': str(e)},
+                        status_code=503, headers={'Retry-After': '1'})
+    return {'result': result}
+
+
+def _line_count(request):
+    # Evaluating a stream of documents costs one evaluation per line.
+    return max((request.raw_body or b'').count(b'\n'), 1)
+
+
+@app.route('/anon/{uuid}/eval', methods=['POST'], cors=True,
+           content_types=['application/x-ndjson', 'application/json'])
+@rate_limited('eval', costs={'eval': _line_count})
+@profiled
+@fails_fast
+def evaluate_saved_query(uuid):
+    # Evaluates a saved query's expression against each document in
+    # a newline delimited JSON body, returning an outcome per line,
+    # {"result": ...} or {"error": ...}, in order.
+    before_request(app)
+    raw_body = app.current_request.raw_body or b''
+    outcomes = _evaluate_saved_query(uuid, BytesIO(raw_body), len(raw_body))
+    return Response(body=b''.join(outcomes).decode('utf-8'),
+                    headers={'Content-Type': 'application/x-ndjson'})
+
+
+def stream_evaluate_saved_query(uuid, body, length, identity=None):
+    # Used instead of evaluate_saved_query by WSGI servers that can
+    # stream requests and responses (see serve.py), so any number of
+    # documents can be evaluated in constant memory.  The number of
+    # lines isn't known up front, so the first one is charged here
+    # (an over budget request falls back to evaluate_saved_query,
+    # which responds with a 429) and the rest as they're read.
+    before_request(app)
+    client = _get_client_id(identity)
+    app.context['rate_limiter'].check(client, 'eval')
+    return _evaluate_saved_query(uuid, body, length, client=client)
+
+
+def _throttled(lines, client):
+    # Charges an evaluation per line after the first.  Once the budget
+    # runs out the response has already started, so rather than
+    # rejecting the rest of the lines they're read as fast as the
+    # budget refills.
+    limiter = app.context['rate_limiter']
+    for i, line in enumerate(lines):
+        while i:
+            try:
+                limiter.check(client, 'eval')
+                break
+            except RateLimitExceeded as e:
+                app.context['metrics'].incr('ratelimit.eval.throttled')
+                time.sleep(e.retry_after)
+        yield line
+
+
+def _evaluate_saved_query(uuid, body, length, client=None):
+    # The expression is fetched and checked before any of the body is
+    # read, so errors are reported before the response starts.
+    expression = app.context['storage'].get_metadata(uuid).get('query')
+    try:
+        jmespath.compile(expression)
+    except (jmespath.exceptions.JMESPathError, TypeError) as e:
+        raise BadRequestError("Unable to compile saved query: %s" % e)
+    lines = iter_lines(body, length, max_line_size=_max_body_size())
+    if client is not None:
+        lines = _throttled(lines, client)
+    outcomes = app.context['evaluator'].evaluate_stream(expression, lines)
+    return (encode_outcome(outcome) for outcome in outcomes)
+
+
 @app.route('/anon/{uuid}', methods=['GET'], cors=True)
+@rate_limited('read')
+@profiled
+@fails_fast
 def get_anonymous_query(uuid):
     before_request(app)
     storage = app.context['storage']
-    result = storage.get(uuid)
-    return result
+    fields = _get_requested_fields(app.current_request)
+    try:
+        if fields is not None:
+            # e.g /anon/{uuid}?fields=query for link previews, which
+            # avoids transferring and parsing the data document.
+            return storage.get_fields(uuid, fields)
+        # The stored JSON is returned as is rather than being parsed
+        # and then serialized again by chalice.
+        raw = storage.get_raw(uuid)
+    except DeadlineExceededError as e:
+        return Response(body={'Code': 'GatewayTimeout', 'Message': str(e)},
+                        status_code=504)
+    return Response(body=raw.decode('utf-8'),
+                    headers={'Content-Type': 'application/json'})
+
+
+@app.route('/anon/{uuid}/paths', methods=['GET'], cors=True)
+@rate_limited('read')
+@fails_fast
+def get_query_paths(uuid):
+    # The paths in a share's data, for autocompleting expressions in
+    # the editor without downloading the data itself.
+    before_request(app)
+    try:
+        return app.context['storage'].get_paths(uuid)
+    except DeadlineExceededError as e:
+        return Response(body={'Code': 'GatewayTimeout', 'Message': str(e)},
+                        status_code=504)
+
+
+@app.route('/anon/recent', methods=['GET'], cors=True)
+@rate_limited('read')
+def recent_queries():
+    before_request(app)
+    limit = _get_limit(app.current_request, RECENT_SIZE)
+    return {'queries': app.context['listings'].recent(limit)}
+
+
+@app.route('/anon/popular', methods=['GET'], cors=True)
+@rate_limited('read')
+def popular_queries():
+    before_request(app)
+    limit = _get_limit(app.current_request, POPULAR_SIZE)
+    return {'queries': app.context['listings'].popular(limit)}
+
+
+@app.route('/search', methods=['GET'], cors=True)
+@rate_limited('read')
+def search_queries():
+    # e.g /search?q=sort_by to find shares using sort_by().
+    before_request(app)
+    params = app.current_request.query_params or {}
+    if not params.get('q'):
+        raise BadRequestError("The q parameter is required.")
+    limit = _get_limit(app.current_request, MAX_SEARCH_RESULTS)
+    results = app.context['search'].search(params['q'], limit)
+    return {'results': [{'uuid': uuid, 'score': round(score, 3)}
+                        for uuid, score in results]}
+
+
+def _get_limit(request, max_limit, default=20):
+    params = request.query_params or {}
+    try:
+        limit = int(params.get('limit', default))
+    except ValueError:
+        raise BadRequestError("limit must be an integer.")
+    return max(0, min(limit, max_limit))
+
+
+def stream_anonymous_query(uuid, identity=None):
+    # Used instead of get_anonymous_query by WSGI servers that can
+    # stream responses (see serve.py).  Returns an iterable of JSON
+    # encoded chunks so the document is never parsed or held in
+    # memory in full.  API Gateway buffers responses so this isn't
+    # used when running in lambda.
+    before_request(app)
+    # Over budget requests fall back to get_anonymous_query, which
+    # responds with a 429 (rejected requests don't use up tokens).
+    app.context['rate_limiter'].check(_get_client_id(identity), 'read')
+    storage = app.context['storage']
+    return storage.iter_raw(uuid)
+
+
+def _get_requested_fields(request):
+    params = request.query_params or {}
+    fields = params.get('fields')
+    if not fields:
+        return None
+    return [f for f in fields.split(',') if f]
 
 
 # This is just used as a sanity check to make sure
 # we can hit our API.  Could also be used for monitoring.
 @app.route('/ping', methods=['GET'], cors=True)
 def ping():
-    return {'ping': 11}
+    response = {'ping': 11}
+    # Only reported once a request has set up storage, so pinging a
+    # cold container stays cheap.
+    breaker = app.context.get('breaker')
+    if breaker is not None:
+        response['storage'] = breaker.state
+    return response
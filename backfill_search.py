@@ -0,0 +1,58 @@
+"""Add every stored share to the search index.
+
+New shares are indexed as they're saved, so this only needs to be run
+once when search is first deployed, or to repair the index (e.g after
+a container was stopped before writing out the shares it had
+buffered).  The same environment variables used in lambda
+(APP_S3_BUCKET, etc.) configure where shares are read from::
+
+    APP_S3_BUCKET=mybucket python backfill_search.py --workers 16
+
+Shares that are already indexed are indexed again, which is harmless
+since searches only count each share once.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+from chalicelib.storage import S3Storage, create_s3_client
+from chalicelib.search import SearchIndex, S3SegmentStore
+
+
+def iter_queries(storage, workers, batch_size=1000):
+    # Yields (uuid, query) for every stored share.  The metadata is
+    # fetched in parallel, a batch at a time so the number of
+    # outstanding requests (and uuids held in memory) is bounded.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batch = []
+        for uuid in storage.iter_uuids():
+            batch.append(uuid)
+            if len(batch) >= batch_size:
+                yield from executor.map(
+                    lambda u: _get_query(storage, u), batch)
+                batch = []
+        yield from executor.map(lambda u: _get_query(storage, u), batch)
+
+
+def _get_query(storage, uuid):
+    return uuid, storage.get_metadata(uuid).get('query')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=16,
+                        help='Number of shares read in parallel.')
+    parser.add_argument('--segment-size', type=int, default=10000,
+                        help='Number of shares per segment written.')
+    args = parser.parse_args()
+    config = app._create_config()
+    s3 = create_s3_client(config)
+    storage = S3Storage(client=s3, config=config)
+    index = SearchIndex(S3SegmentStore(s3, config.bucket, config.prefix))
+    count = index.backfill(iter_queries(storage, args.workers),
+                           segment_size=args.segment_size)
+    print('Indexed %s shares.' % count)
+
+
+if __name__ == '__main__':
+    main()
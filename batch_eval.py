@@ -0,0 +1,64 @@
+"""Evaluate a saved query against every document in an NDJSON file.
+
+Reads newline delimited JSON documents from a file (or stdin) and
+writes an outcome per document to stdout, ``{"result": ...}`` or
+``{"error": ...}``, in the same order::
+
+    APP_S3_BUCKET=mybucket python batch_eval.py <uuid> dump.ndjson
+
+The saved query is fetched with the same environment variables used
+in lambda (APP_S3_BUCKET, etc.).  Documents are evaluated in chunks by
+a pool of worker processes, one per CPU by default, and only a few
+chunks are held in memory at once, so any size of file can be
+processed.
+"""
+import sys
+import argparse
+
+import jmespath
+
+import app
+from chalicelib.storage import S3Storage, create_s3_client
+from chalicelib.evaluate import EvaluationPool, CHUNK_SIZE, TIMEOUT
+from chalicelib.evaluate import iter_lines, encode_outcome
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('uuid', help='The saved query to evaluate.')
+    parser.add_argument('input', nargs='?', default='-',
+                        help='NDJSON file to read (default stdin).')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Number of worker processes (0 for one '
+                             'per CPU).')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='Documents evaluated per job.')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT,
+                        help='Seconds allowed per document.')
+    args = parser.parse_args()
+    config = app._create_config()
+    storage = S3Storage(client=create_s3_client(config), config=config)
+    expression = storage.get_metadata(args.uuid).get('query')
+    try:
+        jmespath.compile(expression)
+    except (jmespath.exceptions.JMESPathError, TypeError) as e:
+        sys.exit("Unable to compile saved query: %s" % e)
+    pool = EvaluationPool(workers=args.workers or None, timeout=args.timeout)
+    if args.input == '-':
+        documents = sys.stdin.buffer
+    else:
+        documents = open(args.input, 'rb')
+    try:
+        outcomes = pool.evaluate_stream(
+            expression, iter_lines(documents,
+                                   max_line_size=config.max_body_size),
+            chunk_size=args.chunk_size)
+        for outcome in outcomes:
+            sys.stdout.buffer.write(encode_outcome(outcome))
+    finally:
+        documents.close()
+        pool.stop()
+
+
+if __name__ == '__main__':
+    main()
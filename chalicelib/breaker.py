@@ -0,0 +1,138 @@
+"""A circuit breaker for calls to a flaky dependency (i.e S3).
+
+While S3 is erroring or slow every request that misses the cache
+would otherwise wait on it, retries included, tying up the container
+and piling more load onto S3.  The breaker counts failed and slow
+calls over a window of ``window`` seconds.  Once at least
+``min_calls`` have been made and ``failure_rate`` of them failed, the
+circuit opens and calls raise CircuitOpenError straight away for
+``open_duration`` seconds.  After that a single call is let through
+as a probe: if it succeeds the circuit closes again, otherwise it
+stays open for another ``open_duration``.
+"""
+import time
+import threading
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+FAILURE_RATE = 0.5
+MIN_CALLS = 20
+WINDOW = 30
+# Calls taking longer than this count as failures even if they
+# succeed, a brownout is as bad as an outage.
+SLOW_CALL_DURATION = 5.0
+OPEN_DURATION = 10
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        # Seconds until the next probe.
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, failure_rate=FAILURE_RATE, min_calls=MIN_CALLS,
+                 window=WINDOW, slow_call_duration=SLOW_CALL_DURATION,
+                 open_duration=OPEN_DURATION, is_failure=None, metrics=None,
+                 clock=time.monotonic):
+        self._failure_rate = failure_rate
+        self._min_calls = min_calls
+        self._window = window
+        self._slow_call_duration = slow_call_duration
+        self._open_duration = open_duration
+        # Returns whether an exception raised by a call means the
+        # dependency is unhealthy, by default any exception does.
+        # e.g a missing key doesn't.
+        self._is_failure = is_failure or (lambda error: True)
+        self._metrics = metrics
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self._opened = None
+        self._probing = False
+        self._reset_window(clock())
+
+    def call(self, func, *args, **kwargs):
+        probe = self._before_call()
+        start = self._clock()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self._after_call(not self._is_failure(e), probe)
+            raise
+        healthy = self._clock() - start <= self._slow_call_duration
+        self._after_call(healthy, probe)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {'state': self.state, 'calls': self._calls,
+                    'failures': self._failures}
+
+    def _before_call(self):
+        # Returns whether the call is a probe, or raises
+        # CircuitOpenError if it isn't allowed.
+        now = self._clock()
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self._opened + self._open_duration - now
+                if remaining > 0:
+                    self._reject()
+                    raise CircuitOpenError(
+                        "Storage is unavailable, retry in %.0f seconds." %
+                        remaining, remaining)
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN:
+                if self._probing:
+                    # Only one probe at a time, it shouldn't be long.
+                    self._reject()
+                    raise CircuitOpenError(
+                        "Storage is unavailable, retry in 1 second.", 1)
+                self._probing = True
+                return True
+            if now - self._window_start >= self._window:
+                self._reset_window(now)
+            return False
+
+    def _after_call(self, healthy, probe):
+        now = self._clock()
+        with self._lock:
+            if probe:
+                self._probing = False
+                if healthy:
+                    self._incr('breaker.closed')
+                    self.state = CLOSED
+                    self._reset_window(now)
+                else:
+                    self._open(now)
+                return
+            if self.state != CLOSED:
+                # Calls made before the circuit opened don't count.
+                return
+            self._calls += 1
+            if not healthy:
+                self._failures += 1
+                self._incr('breaker.failures')
+            if self._calls >= self._min_calls and \
+                    self._failures >= self._failure_rate * self._calls:
+                self._open(now)
+
+    def _open(self, now):
+        self._incr('breaker.opened')
+        self.state = OPEN
+        self._opened = now
+
+    def _reset_window(self, now):
+        self._window_start = now
+        self._calls = 0
+        self._failures = 0
+
+    def _reject(self):
+        self._incr('breaker.rejected')
+
+    def _incr(self, name):
+        if self._metrics is not None:
+            self._metrics.incr(name)
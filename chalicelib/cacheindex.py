@@ -0,0 +1,218 @@
+"""Index snapshots for semidbm.
+
+semidbm builds its in memory index by reading the header of every
+record in its data file, so opening a large db means scanning the
+whole file.  ``write_snapshot()`` saves a copy of the index along
+with the data file offset it covers, and ``SnapshotLoader`` loads
+that copy and then only scans the records written after it.
+
+A snapshot is::
+
+    <magic><version><offset><tail crc><count><entries><crc>
+
+where ``tail crc`` is the crc32 of the data file bytes just before
+``offset``, used to detect that the data file has been rewritten
+since the snapshot was taken, and ``crc`` is the crc32 of
+everything before it.  Entries are ``<key size><offset><size><key>``.
+"""
+import os
+import time
+import struct
+import logging
+from binascii import crc32
+
+
+LOG = logging.getLogger('jmespath-playground.cacheindex')
+SNAPSHOT_FILENAME = 'index-snapshot'
+SNAPSHOT_MAGIC = b'JPIX'
+SNAPSHOT_VERSION = 1
+# How many bytes of the data file (before the snapshot offset) are
+# checked to make sure it's the same file the snapshot was taken of.
+TAIL_CHECK_SIZE = 4096
+_HEADER = struct.Struct('!4sHQIQ')
+_ENTRY = struct.Struct('!IQi')
+_RECORD_HEADER = struct.Struct('!ii')
+_CRC = struct.Struct('!I')
+# Size of a semidbm data file header, and the value size used to
+# record a deleted key.
+_DATA_HEADER_SIZE = 8
+_DELETED = -1
+
+
+class InvalidSnapshotError(Exception):
+    pass
+
+
+def write_snapshot(db, path):
+    # The offset is read before the index so that any record written
+    # in between is covered by the scan after the snapshot is loaded,
+    # rather than being missing from both.
+    offset = db._current_offset
+    items = list(db._index.items())
+    parts = [_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, offset,
+                          _tail_crc(db._data_filename, offset), len(items))]
+    for key, (value_offset, size) in items:
+        parts.append(_ENTRY.pack(len(key), value_offset, size))
+        parts.append(key)
+    contents = b''.join(parts)
+    contents += _CRC.pack(crc32(contents) & 0xffffffff)
+    # Written to a temp file and renamed so a reader never sees a
+    # partially written snapshot.
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'wb') as f:
+        f.write(contents)
+    os.replace(tmp_path, path)
+    return len(items)
+
+
+def read_snapshot(path, data_filename):
+    # Returns (offset, entries) or raises InvalidSnapshotError if the
+    # snapshot is corrupt or doesn't match the data file.
+    try:
+        with open(path, 'rb') as f:
+            contents = f.read()
+    except (IOError, OSError) as e:
+        raise InvalidSnapshotError(str(e))
+    if len(contents) < _HEADER.size + _CRC.size:
+        raise InvalidSnapshotError("Snapshot is truncated.")
+    expected = _CRC.unpack_from(contents, len(contents) - _CRC.size)[0]
+    if crc32(contents[:-_CRC.size]) & 0xffffffff != expected:
+        raise InvalidSnapshotError("Snapshot checksum doesn't match.")
+    magic, version, offset, tail_crc, count = _HEADER.unpack_from(contents)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise InvalidSnapshotError("Unknown snapshot format.")
+    try:
+        data_size = os.path.getsize(data_filename)
+    except OSError as e:
+        raise InvalidSnapshotError(str(e))
+    if data_size < offset or \
+            _tail_crc(data_filename, offset) != tail_crc:
+        raise InvalidSnapshotError("Snapshot is stale.")
+    entries = []
+    position = _HEADER.size
+    for _ in range(count):
+        key_size, value_offset, size = _ENTRY.unpack_from(contents, position)
+        position += _ENTRY.size
+        entries.append((contents[position:position + key_size],
+                        value_offset, size))
+        position += key_size
+    return offset, entries
+
+
+def _tail_crc(filename, offset):
+    start = max(offset - TAIL_CHECK_SIZE, 0)
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        return crc32(f.read(offset - start)) & 0xffffffff
+
+
+def append_records(db, items):
+    # Appends (key, value) records to a semidbm db with a single write,
+    # in the format semidbm's __setitem__ uses, and adds them to its
+    # index.  Values are bytes.
+    parts = []
+    entries = []
+    offset = db._current_offset
+    for key, value in items:
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        keyval = key + value
+        parts.append(_RECORD_HEADER.pack(len(key), len(value)))
+        parts.append(keyval)
+        parts.append(_CRC.pack(crc32(keyval) & 0xffffffff))
+        value_offset = offset + _RECORD_HEADER.size + len(key)
+        entries.append((key, value_offset, len(value)))
+        offset = _record_end(value_offset, len(value))
+    blob = memoryview(b''.join(parts))
+    written = 0
+    while written < len(blob):
+        written += os.write(db._data_fd, blob[written:])
+    # The index is only updated once everything has been written, so a
+    # failed write doesn't leave it pointing at missing records.
+    for key, value_offset, size in entries:
+        db._index[key] = (value_offset, size)
+    db._current_offset = offset
+    return len(entries)
+
+
+def iter_records(filename, offset):
+    # Yields (key, offset, size) for each record in a semidbm data
+    # file from offset onwards, the same as semidbm's loaders.  A
+    # truncated record at the end of the file (e.g from a write that
+    # was interrupted) ends the scan.
+    with open(filename, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        f.seek(offset)
+        while True:
+            header = f.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                return
+            key_size, size = _RECORD_HEADER.unpack(header)
+            key = f.read(key_size)
+            if len(key) != key_size:
+                return
+            value_offset = offset + _RECORD_HEADER.size + key_size
+            offset = _record_end(value_offset, size)
+            if offset > file_size:
+                return
+            f.seek(offset)
+            yield key, value_offset, size
+
+
+def _record_end(value_offset, size):
+    if size == _DELETED:
+        return value_offset + _CRC.size
+    return value_offset + size + _CRC.size
+
+
+def catch_up(db):
+    # Adds the records appended to a db's data file by someone else
+    # (e.g another process) to its index.  Returns the number of
+    # records added.  Records still being written are picked up by
+    # a later call.
+    if os.fstat(db._data_fd).st_size == db._current_offset:
+        return 0
+    count = 0
+    for key, value_offset, size in iter_records(db._data_filename,
+                                                db._current_offset):
+        if size == _DELETED:
+            db._index.pop(key, None)
+        else:
+            db._index[key] = (value_offset, size)
+        db._current_offset = _record_end(value_offset, size)
+        count += 1
+    return count
+
+
+class SnapshotLoader:
+    """A semidbm data loader that starts from an index snapshot.
+
+    Falls back to ``loader`` (a full scan of the data file) if there's
+    no usable snapshot.  ``stats`` records how the index was loaded.
+    """
+
+    def __init__(self, loader, snapshot_path):
+        self._loader = loader
+        self._snapshot_path = snapshot_path
+        self.stats = {}
+
+    def iter_keys(self, filename):
+        start = time.monotonic()
+        try:
+            offset, entries = read_snapshot(self._snapshot_path, filename)
+        except InvalidSnapshotError as e:
+            if os.path.exists(self._snapshot_path):
+                LOG.debug("Ignoring index snapshot %s: %s",
+                          self._snapshot_path, e)
+            self.stats = {'snapshot': False}
+            for entry in self._loader.iter_keys(filename):
+                yield entry
+        else:
+            self.stats = {'snapshot': True, 'snapshot_keys': len(entries),
+                          'scanned_bytes': os.path.getsize(filename) - offset}
+            for entry in entries:
+                yield entry
+            for entry in iter_records(filename,
+                                      max(offset, _DATA_HEADER_SIZE)):
+                yield entry
+        self.stats['load_time'] = time.monotonic() - start
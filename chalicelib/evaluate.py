@@ -0,0 +1,418 @@
+"""Evaluates untrusted JMESPath expressions in a pool of processes.
+
+Expressions are run in worker processes rather than the request
+thread so a slow or pathological expression can be stopped: a worker
+that takes longer than ``timeout`` seconds per document is killed and
+replaced, and each worker's address space is capped at
+``memory_limit`` bytes more than it started with.  Workers are forked
+once and reused, so jobs don't pay for starting a process (or
+importing jmespath).
+
+A job is an expression and a list of JSON encoded documents, and
+returns an outcome per document, either ``{"result": ...}`` or
+``{"error": ...}``.  Outcomes are JSON encoded by the worker, and a
+result larger than ``max_result_size`` bytes gets an error outcome
+instead, since an expression like ``[@, @, @, ...]`` is cheap to
+evaluate (and to send back pickled, since it's the same object over
+and over) but not to encode.  Large inputs, e.g a newline delimited
+JSON dump, are split into jobs of ``CHUNK_SIZE`` documents which run
+in parallel (see ``EvaluationPool.evaluate_stream()``).
+"""
+import os
+import json
+import time
+import queue
+import hashlib
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import jmespath
+
+
+LOG = logging.getLogger('jmespath-playground.evaluate')
+# Seconds a job can run (per document) before its worker is killed.
+TIMEOUT = 1.0
+# Documents per job when evaluating a stream of documents.
+CHUNK_SIZE = 100
+# Documents in a stream larger than this aren't evaluated.
+MAX_DOCUMENT_SIZE = 1024 * 1024
+# Bytes of memory a worker can allocate on top of what it's forked
+# with.
+MEMORY_LIMIT = 256 * 1024 * 1024
+# Bytes an outcome can take JSON encoded.
+MAX_RESULT_SIZE = 1024 * 1024
+# Jobs that can wait for a worker before more are rejected.
+MAX_QUEUE = 16
+# Seconds between a worker's checks that the process that forked it
+# is still around.
+PARENT_CHECK_INTERVAL = 1.0
+# Workers are forked so they start with everything already imported.
+_CONTEXT = multiprocessing.get_context('fork')
+
+
+class EvaluationError(Exception):
+    # The expression is invalid, or failed to evaluate.
+    pass
+
+
+class LimitExceededError(Exception):
+    # The job ran out of time or memory.
+    pass
+
+
+class PoolBusyError(Exception):
+    pass
+
+
+def document_key(expression, document):
+    # The cache key for the outcome of evaluating an expression
+    # against a JSON encoded document.
+    digest = hashlib.sha256(expression.encode('utf-8'))
+    digest.update(b'\x00')
+    digest.update(document)
+    return 'eval:%s' % digest.hexdigest()
+
+
+def encode_document(data):
+    # Keys are sorted so equal documents have the same cache key.
+    return json.dumps(data, sort_keys=True,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def encode_outcome(outcome):
+    # An outcome as a line of newline delimited JSON.
+    return _encode(outcome) + b'\n'
+
+
+def _encode(outcome):
+    return json.dumps(outcome, separators=(',', ':')).encode('utf-8')
+
+
+def _encode_bounded(outcome, max_result_size):
+    encoded = _encode(outcome)
+    if max_result_size is not None and len(encoded) > max_result_size:
+        return _encode({'error': "Result is larger than %s bytes." %
+                        max_result_size})
+    return encoded
+
+
+def iter_lines(stream, length=None, max_line_size=MAX_DOCUMENT_SIZE):
+    # Yields the non blank lines read from a file like object, up to
+    # length bytes if given.  Lines longer than max_line_size are
+    # skipped rather than read into memory, and yielded as None so
+    # they still get an outcome.
+    remaining = length
+    while remaining is None or remaining > 0:
+        size = max_line_size + 1
+        if remaining is not None:
+            size = min(size, remaining)
+        line = stream.readline(size)
+        if not line:
+            return
+        if remaining is not None:
+            remaining -= len(line)
+        if len(line) > max_line_size and not line.endswith(b'\n'):
+            while line and not line.endswith(b'\n') and \
+                    (remaining is None or remaining > 0):
+                size = max_line_size
+                if remaining is not None:
+                    size = min(size, remaining)
+                line = stream.readline(size)
+                if remaining is not None:
+                    remaining -= len(line)
+            yield None
+            continue
+        line = line.strip()
+        if line:
+            yield line
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _limit_memory(memory_limit):
+    # RLIMIT_AS caps the whole address space, which for a forked
+    # process includes everything mapped by its parent, so the limit is
+    # relative to the current size.
+    import resource
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[0])
+    except (IOError, OSError, ValueError):
+        LOG.debug("Unable to read worker memory usage, not limiting it.")
+        return
+    limit = pages * resource.getpagesize() + memory_limit
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _evaluate(expression, documents):
+    try:
+        compiled = jmespath.compile(expression)
+    except jmespath.exceptions.JMESPathError as e:
+        return [{'error': str(e)}] * len(documents)
+    outcomes = []
+    for document in documents:
+        try:
+            outcomes.append({'result': compiled.search(json.loads(document))})
+        except (jmespath.exceptions.JMESPathError, ValueError,
+                RecursionError) as e:
+            outcomes.append({'error': str(e)})
+    return outcomes
+
+
+def _worker_main(conn, parent_conn, memory_limit, max_result_size):
+    parent_conn.close()
+    parent = os.getppid()
+    if memory_limit is not None:
+        _limit_memory(memory_limit)
+    while True:
+        # Exits if the process that forked us has gone away without
+        # closing our pipe (e.g another worker inherited it).
+        if not conn.poll(PARENT_CHECK_INTERVAL):
+            if os.getppid() != parent:
+                return
+            continue
+        try:
+            expression, documents = conn.recv()
+        except EOFError:
+            return
+        try:
+            outcomes = [_encode_bounded(outcome, max_result_size)
+                        for outcome in _evaluate(expression, documents)]
+            conn.send(('ok', outcomes))
+        except MemoryError:
+            # What memory we can get back may not be enough to keep
+            # going, so the worker is replaced.
+            conn.send(('memory', None))
+            return
+
+
+class _Worker:
+    def __init__(self, memory_limit, max_result_size):
+        self._memory_limit = memory_limit
+        self._max_result_size = max_result_size
+        self._start()
+
+    def _start(self):
+        parent_conn, child_conn = _CONTEXT.Pipe()
+        self._process = _CONTEXT.Process(
+            target=_worker_main,
+            args=(child_conn, parent_conn, self._memory_limit,
+                  self._max_result_size),
+            daemon=True)
+        self._process.start()
+        child_conn.close()
+        self._conn = parent_conn
+
+    def run(self, expression, documents, timeout):
+        self._conn.send((expression, documents))
+        try:
+            if not self._conn.poll(timeout):
+                self.restart()
+                raise LimitExceededError(
+                    "Evaluation took longer than %s seconds." % timeout)
+            status, outcomes = self._conn.recv()
+        except (EOFError, OSError):
+            # Killed, most likely by the kernel for using too much
+            # memory.
+            self.restart()
+            raise LimitExceededError("Evaluation failed or ran out of "
+                                     "memory.")
+        if status == 'memory':
+            self.restart()
+            raise LimitExceededError("Evaluation ran out of memory.")
+        return outcomes
+
+    def restart(self):
+        self.stop()
+        self._start()
+
+    def stop(self):
+        self._process.kill()
+        self._process.join()
+        self._conn.close()
+
+
+class EvaluationPool:
+    """A pool of worker processes that evaluate JMESPath expressions.
+
+    At most ``workers`` jobs run at once and ``max_queue`` more wait
+    for a worker, anything beyond that raises PoolBusyError right away
+    rather than piling up.  Outcomes are cached JSON encoded in
+    ``cache`` (anything with ``get_raw``/``set_raw``), keyed by a hash
+    of the expression and the document, except when a job ran out of
+    time or memory, since that depends on how busy the host is.  The
+    cache should be separate from the one shares are cached in, so
+    evaluations can't fill it up.
+
+    Workers are started by the first job (or ``start()``) and kept
+    running, and are started again in a process forked after that.
+    """
+
+    def __init__(self, workers=None, timeout=TIMEOUT,
+                 memory_limit=MEMORY_LIMIT, max_queue=MAX_QUEUE, cache=None,
+                 metrics=None, max_result_size=MAX_RESULT_SIZE):
+        self.size = workers or os.cpu_count() or 1
+        self._timeout = timeout
+        self._memory_limit = memory_limit
+        self._max_result_size = max_result_size
+        self._cache = cache
+        self._metrics = metrics
+        self._slots = threading.BoundedSemaphore(self.size + max_queue)
+        self._lock = threading.Lock()
+        self._idle = queue.Queue()
+        self._workers = []
+        self._pid = None
+        self._waiting = 0
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Workers inherited from the process we were forked from
+            # belong to it.
+            self._idle = queue.Queue()
+            self._workers = []
+            for _ in range(self.size):
+                worker = _Worker(self._memory_limit, self._max_result_size)
+                self._workers.append(worker)
+                self._idle.put(worker)
+            self._pid = os.getpid()
+
+    def stop(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                for worker in self._workers:
+                    worker.stop()
+            self._workers = []
+            self._pid = None
+
+    def evaluate(self, expression, data):
+        """Returns the result of evaluating ``expression`` on ``data``.
+
+        Raises EvaluationError if the expression is invalid or fails.
+        """
+        outcome = self.evaluate_documents(expression,
+                                          [encode_document(data)])[0]
+        if 'error' in outcome:
+            raise EvaluationError(outcome['error'])
+        return outcome['result']
+
+    def evaluate_documents(self, expression, documents):
+        # Returns an outcome per JSON encoded document, in the same
+        # order, running the documents that aren't cached as one job.
+        outcomes = [None] * len(documents)
+        keys = [document_key(expression, d) for d in documents]
+        if self._cache is not None:
+            for i, key in enumerate(keys):
+                outcomes[i] = self._cache.get_raw(key)
+        missing = [i for i, outcome in enumerate(outcomes) if outcome is None]
+        self._incr('eval.cache.hit', len(documents) - len(missing))
+        if missing:
+            self._incr('eval.cache.miss', len(missing))
+            results = self._run(expression, [documents[i] for i in missing])
+            for i, outcome in zip(missing, results):
+                outcomes[i] = outcome
+                if self._cache is not None:
+                    self._cache.set_raw(keys[i], outcome)
+        return [json.loads(outcome) for outcome in outcomes]
+
+    def evaluate_stream(self, expression, documents, chunk_size=CHUNK_SIZE):
+        """Yields an outcome per JSON encoded document, in order.
+
+        ``documents`` is an iterable (e.g from ``iter_lines()``), of
+        which at most two jobs per worker are read ahead, so memory use
+        doesn't depend on how many documents there are.  Outcomes
+        aren't cached, since a dump is unlikely to be evaluated twice
+        and would fill the cache.  A job that runs out of time or
+        memory gets an error outcome for each of its documents
+        rather than ending the stream.
+        """
+        self._incr('eval.streams')
+        window = deque()
+        executor = ThreadPoolExecutor(max_workers=self.size)
+        try:
+            for chunk in _chunks(documents, chunk_size):
+                window.append(executor.submit(self._run_chunk, expression,
+                                              chunk))
+                if len(window) >= self.size * 2:
+                    yield from window.popleft().result()
+            while window:
+                yield from window.popleft().result()
+        finally:
+            for future in window:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _run_chunk(self, expression, chunk):
+        documents = [d for d in chunk if d is not None]
+        try:
+            results = iter([json.loads(outcome) for outcome in
+                            self._run(expression, documents, block=True)])
+        except LimitExceededError as e:
+            results = iter([{'error': str(e)}] * len(documents))
+        return [{'error': "Document is too large."} if d is None
+                else next(results) for d in chunk]
+
+    def stats(self):
+        return {'workers': self.size, 'idle': self._idle.qsize(),
+                'waiting': self._waiting}
+
+    def _run(self, expression, documents, block=False):
+        # Jobs from a stream (block=True) wait for a worker rather than
+        # being rejected, since the stream reads ahead a bounded number
+        # of jobs anyway.
+        if not documents:
+            return []
+        self.start()
+        if not self._slots.acquire(blocking=block):
+            self._incr('eval.rejected')
+            raise PoolBusyError("Too many evaluations in progress.")
+        try:
+            with self._lock:
+                self._waiting += 1
+            start = time.monotonic()
+            try:
+                # A job that can't get a worker within its own time
+                # limit is unlikely to get one soon.
+                worker = self._idle.get(
+                    timeout=None if block else self._timeout)
+            except queue.Empty:
+                self._incr('eval.rejected')
+                raise PoolBusyError("Timed out waiting for an evaluation "
+                                    "worker.")
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+            self._timing('eval.wait', time.monotonic() - start)
+            start = time.monotonic()
+            try:
+                return worker.run(expression, documents,
+                                  self._timeout * len(documents))
+            except LimitExceededError:
+                self._incr('eval.limit_exceeded')
+                raise
+            finally:
+                self._timing('eval.run', time.monotonic() - start)
+                self._idle.put(worker)
+        finally:
+            self._slots.release()
+
+    def _incr(self, name, value=1):
+        if self._metrics is not None:
+            self._metrics.incr(name, value)
+
+    def _timing(self, name, seconds):
+        if self._metrics is not None:
+            self._metrics.timing(name, seconds)
@@ -0,0 +1,81 @@
+"""Structural limits checked before a JSON body is parsed.
+
+The body size limit doesn't bound how expensive a document is to
+handle: 100KB is enough for thousands of levels of nesting (which
+hits recursion limits when it's serialized or searched) or tens of
+thousands of tiny values (each of which is a python object once
+parsed, and is copied again by validation, serialization and the
+cache).  ``check_structure()`` makes a few passes over the raw bytes,
+without parsing them, and rejects a document that's nested more than
+``max_depth`` levels, has more than ``max_nodes`` values or has a
+string more than ``max_string_length`` bytes long.
+
+The scan only looks at strings and punctuation, it doesn't validate
+the JSON, which is left to the parser.  The number of values is
+counted as one more than the number of containers and commas, which
+is exact for documents without empty containers.
+"""
+
+
+MAX_DEPTH = 100
+# A 100KB body can hold around 50,000 values, e.g [0,0,...].
+MAX_NODES = 10000
+MAX_STRING_LENGTH = 64 * 1024
+# Everything but brackets, for bytes.translate().
+NOT_BRACKETS = bytes(b for b in range(256) if b not in b'[]{}')
+# Braces are counted as brackets when measuring depth.
+BRACES_AS_BRACKETS = bytes.maketrans(b'{}', b'[]')
+
+
+class StructureLimitError(ValueError):
+    def __init__(self, message, limit):
+        super().__init__(message)
+        # Which limit was exceeded: 'depth', 'nodes' or 'string_length'.
+        self.limit = limit
+
+
+def check_structure(body, max_depth=MAX_DEPTH, max_nodes=MAX_NODES,
+                    max_string_length=MAX_STRING_LENGTH):
+    # Raises StructureLimitError if the JSON encoded body exceeds any
+    # of the limits, returns the number of values otherwise.  Every
+    # step is a single call into C (splits, counts and replaces),
+    # looping in python per value would cost more than parsing the
+    # body does.
+    if b'\\' in body:
+        # Escapes are overwritten (keeping their length) so the only
+        # quotes left are the ones around strings.  Escaped
+        # backslashes go first, so a string ending in one ("a\\")
+        # doesn't look like it ends in an escaped quote.
+        body = body.replace(b'\\\\', b'__').replace(b'\\"', b'__')
+    parts = body.split(b'"')
+    if len(body) > max_string_length and \
+            max(map(len, parts[1::2]), default=0) > max_string_length:
+        raise StructureLimitError(
+            "Document contains a string longer than %s bytes." %
+            max_string_length, 'string_length')
+    # Strings removed, so any punctuation left is structure.
+    structure = b''.join(parts[0::2])
+    nodes = 1 + structure.count(b',') + structure.count(b'[') + \
+        structure.count(b'{')
+    if nodes > max_nodes:
+        raise StructureLimitError(
+            "Document contains more than %s values." % max_nodes, 'nodes')
+    # Removing every innermost pair of brackets takes off one level
+    # of nesting, so the depth is the number of rounds it takes to
+    # remove them all.  Objects and arrays are both made brackets
+    # first, removing '[]' and then '{}' in the same round would take
+    # two levels off alternately nested documents.
+    brackets = structure.translate(BRACES_AS_BRACKETS, NOT_BRACKETS)
+    depth = 0
+    while brackets:
+        remaining = brackets.replace(b'[]', b'')
+        if len(remaining) == len(brackets):
+            # Unbalanced, which the parser will report.
+            break
+        brackets = remaining
+        depth += 1
+        if depth > max_depth:
+            raise StructureLimitError(
+                "Document is nested more than %s levels deep." % max_depth,
+                'depth')
+    return nodes
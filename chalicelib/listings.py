@@ -0,0 +1,238 @@
+import time
+import logging
+import threading
+from collections import Counter
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from chalicelib.breaker import CircuitOpenError
+
+
+LOG = logging.getLogger('jmespath-playground.listings')
+RECENT_SIZE = 100
+POPULAR_SIZE = 100
+# Popularity scores halve every this many seconds.
+POPULAR_HALF_LIFE = 24 * 60 * 60
+# This many times more shares than are listed are kept in the popular
+# index, so a share that's climbing the ranks isn't dropped before
+# it makes it into the list.
+POPULAR_CANDIDATES = 4
+# Shares whose score decays below this are dropped.
+MIN_POPULAR_SCORE = 0.01
+# Seconds between flushes of pending updates to the index objects.
+FLUSH_INTERVAL = 60
+# Pending updates are flushed early once there are this many.
+FLUSH_SIZE = 1000
+# Seconds an index object read from storage is served from memory.
+REFRESH_INTERVAL = 60
+# Only the start of long queries is kept in the recent index.
+MAX_QUERY_LENGTH = 200
+# Index reads and writes happen while handling saves and reads, and
+# failing them mustn't fail the request.
+_STORAGE_ERRORS = (ClientError, BotoCoreError, CircuitOpenError)
+
+
+class RecentIndex:
+    """The most recently saved queries, newest first.
+
+    Stored as ``{"entries": [[uuid, created, query], ...]}``.
+    """
+
+    name = 'recent'
+
+    def __init__(self, size=RECENT_SIZE):
+        self.size = size
+
+    def empty(self):
+        return {'entries': []}
+
+    def merge(self, index, pending, now):
+        # pending is a list of new entries, oldest first.  It's
+        # reversed so the newest wins ties on created time.
+        entries = []
+        seen = set()
+        for entry in sorted(pending[::-1] + index['entries'],
+                            key=lambda e: e[1], reverse=True):
+            if entry[0] in seen:
+                continue
+            seen.add(entry[0])
+            entries.append(entry)
+            if len(entries) >= self.size:
+                break
+        return {'entries': entries}
+
+    def listing(self, index, limit, now):
+        return [{'uuid': uuid, 'created': created, 'query': query}
+                for uuid, created, query in index['entries'][:limit]]
+
+
+class PopularIndex:
+    """The most read queries, by exponentially decayed read count.
+
+    Stored as ``{"updated": t, "entries": [[uuid, score], ...]}``
+    where scores are as of ``updated``.
+    """
+
+    name = 'popular'
+
+    def __init__(self, size=POPULAR_SIZE, half_life=POPULAR_HALF_LIFE):
+        self.size = size
+        self.half_life = half_life
+
+    def empty(self):
+        return {'updated': None, 'entries': []}
+
+    def merge(self, index, pending, now):
+        # pending is a Counter of reads per uuid.
+        scores = Counter(dict(self._decayed(index, now)))
+        scores.update(pending)
+        entries = [[uuid, round(score, 3)] for uuid, score in
+                   scores.most_common(self.size * POPULAR_CANDIDATES)
+                   if score >= MIN_POPULAR_SCORE]
+        return {'updated': now, 'entries': entries}
+
+    def listing(self, index, limit, now):
+        return [{'uuid': uuid, 'score': round(score, 3)} for uuid, score in
+                self._decayed(index, now)[:min(limit, self.size)]]
+
+    def _decayed(self, index, now):
+        if not index['entries']:
+            return []
+        decay = 0.5 ** (max(now - index['updated'], 0) / self.half_life)
+        return [(uuid, score * decay) for uuid, score in index['entries']]
+
+
+class Listings:
+    """Maintains the recent and popular index objects.
+
+    Saves and reads are recorded in memory and periodically merged
+    into the index objects in ``storage`` (anything with
+    ``get_index``/``put_index``), so each flush is one read and one
+    write per index no matter how many shares there are.  Listings are
+    served from a copy of the index objects that's refreshed at most
+    every ``refresh_interval`` seconds, merged with this container's
+    pending updates.
+
+    Flushes happen while handling saves and reads, so ``storage``
+    should fail fast when S3 is unavailable (e.g by going through a
+    CircuitBreakingStorage).
+
+    Containers flush independently, so two containers flushing at the
+    same moment can lose one's updates.  That's an acceptable trade off
+    for approximate listings.
+    """
+
+    def __init__(self, storage, recent=None, popular=None,
+                 flush_interval=FLUSH_INTERVAL, flush_size=FLUSH_SIZE,
+                 refresh_interval=REFRESH_INTERVAL, clock=time.time):
+        self._storage = storage
+        if recent is None:
+            recent = RecentIndex()
+        if popular is None:
+            popular = PopularIndex()
+        self._recent = recent
+        self._popular = popular
+        self._flush_interval = flush_interval
+        self._flush_size = flush_size
+        self._refresh_interval = refresh_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._pending_recent = []
+        self._pending_reads = Counter()
+        self._last_flush = clock()
+        # Set when a flush fails, so that flushes triggered by
+        # flush_size wait for flush_interval instead of retrying on
+        # every request.
+        self._flush_failed = False
+        # Index name -> (index, time it was loaded).
+        self._loaded = {}
+
+    def record_put(self, uuid, document):
+        query = None
+        if isinstance(document, dict) and \
+                isinstance(document.get('query'), str):
+            query = document['query'][:MAX_QUERY_LENGTH]
+        with self._lock:
+            self._pending_recent.append([uuid, self._clock(), query])
+        self._maybe_flush()
+
+    def record_read(self, uuid):
+        with self._lock:
+            self._pending_reads[uuid] += 1
+        self._maybe_flush()
+
+    def recent(self, limit=RECENT_SIZE):
+        with self._lock:
+            pending = list(self._pending_recent)
+        return self._listing(self._recent, pending, limit)
+
+    def popular(self, limit=POPULAR_SIZE):
+        with self._lock:
+            pending = Counter(self._pending_reads)
+        return self._listing(self._popular, pending, limit)
+
+    def _listing(self, index, pending, limit):
+        now = self._clock()
+        merged = index.merge(self._get(index, now), pending, now)
+        return index.listing(merged, limit, now)
+
+    def _get(self, index, now):
+        loaded = self._loaded.get(index.name)
+        if loaded is not None and now - loaded[1] < self._refresh_interval:
+            return loaded[0]
+        try:
+            current = self._storage.get_index(index.name) or index.empty()
+        except _STORAGE_ERRORS as e:
+            LOG.debug("Unable to load %s index: %s", index.name, e)
+            if loaded is not None:
+                return loaded[0]
+            return index.empty()
+        self._loaded[index.name] = (current, now)
+        return current
+
+    def _maybe_flush(self):
+        with self._lock:
+            pending = len(self._pending_recent) + len(self._pending_reads)
+            elapsed = self._clock() - self._last_flush
+            due = pending and (
+                elapsed >= self._flush_interval or (
+                    pending >= self._flush_size and not self._flush_failed))
+        if due:
+            self.flush()
+
+    def flush(self):
+        now = self._clock()
+        with self._lock:
+            batches = [(self._recent, self._pending_recent),
+                       (self._popular, self._pending_reads)]
+            self._pending_recent = []
+            self._pending_reads = Counter()
+            self._last_flush = now
+            self._flush_failed = False
+        for index, pending in batches:
+            if not pending:
+                continue
+            # The index is read again rather than using our copy, so
+            # updates flushed by other containers aren't overwritten.
+            try:
+                current = self._storage.get_index(index.name) or \
+                    index.empty()
+                merged = index.merge(current, pending, now)
+                self._storage.put_index(index.name, merged)
+            except _STORAGE_ERRORS as e:
+                LOG.debug("Unable to flush %s index: %s", index.name, e)
+                self._requeue(index, pending)
+                continue
+            self._loaded[index.name] = (merged, now)
+
+    def _requeue(self, index, pending):
+        # Failed updates are retried on the next flush.  Only the
+        # newest recent entries could ever be listed, so those are
+        # all that's kept.
+        with self._lock:
+            self._flush_failed = True
+            if index is self._recent:
+                self._pending_recent = (
+                    pending + self._pending_recent)[-self._recent.size:]
+            else:
+                self._pending_reads.update(pending)
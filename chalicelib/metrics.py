@@ -0,0 +1,113 @@
+import json
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+LOG = logging.getLogger('jmespath-playground.metrics')
+# Number of samples kept per timing.  Older samples are discarded
+# so percentiles reflect recent behavior of the container.
+MAX_SAMPLES = 1000
+# Seconds between reports of the metrics to the log.
+REPORT_INTERVAL = 60
+
+
+class Metrics:
+    """In-process counters and timings.
+
+    A single instance lives in ``app.context`` for the lifetime of
+    the container.  Everything here is thread safe because storage
+    objects may record timings from worker threads.
+    """
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+        self._max_samples = max_samples
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def counter(self, name):
+        return self._counters.get(name, 0)
+
+    def timing(self, name, seconds):
+        with self._lock:
+            samples = self._timings.get(name)
+            if samples is None:
+                samples = deque(maxlen=self._max_samples)
+                self._timings[name] = samples
+            samples.append(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timing(name, time.monotonic() - start)
+
+    def percentile(self, name, percentile, min_samples=1):
+        # Returns None if we don't have enough samples to say
+        # anything useful about the distribution.
+        with self._lock:
+            samples = sorted(self._timings.get(name, ()))
+        if not samples or len(samples) < min_samples:
+            return None
+        index = int(round(percentile / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            names = list(self._timings)
+        timings = {}
+        for name in names:
+            timings[name] = {
+                'count': len(self._timings[name]),
+                'p50': self.percentile(name, 50),
+                'p95': self.percentile(name, 95),
+                'p99': self.percentile(name, 99),
+            }
+        return {'counters': counters, 'timings': timings}
+
+
+class Reporter:
+    """Logs a snapshot of the metrics as a single line of JSON.
+
+    Lambda freezes the container between invocations, so rather than
+    relying on a background thread ``maybe_report()`` is called on
+    the request path and reports once ``interval`` seconds have passed
+    since the last report.  The lines can be queried with CloudWatch
+    Logs Insights (``filter type = 'metrics'``).  ``sources`` maps a
+    name to a function returning more stats to include, e.g the
+    circuit breaker's.  Counters are totals since the container
+    started.
+    """
+
+    def __init__(self, metrics, interval=REPORT_INTERVAL, sources=None,
+                 clock=time.monotonic):
+        self._metrics = metrics
+        self._interval = interval
+        self._sources = sources or {}
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._last_report = clock()
+
+    def maybe_report(self):
+        now = self._clock()
+        with self._lock:
+            if now - self._last_report < self._interval:
+                return
+            self._last_report = now
+        self.report()
+
+    def report(self):
+        line = dict(self._metrics.snapshot(), type='metrics')
+        for name, source in self._sources.items():
+            line[name] = source()
+        LOG.info(json.dumps(line, sort_keys=True))
@@ -0,0 +1,95 @@
+"""Structural summaries of documents, used for autocompletion.
+
+A summary lists every distinct path in a document as a JMESPath
+expression, along with the types of the values found there and, for
+arrays, their minimum and maximum lengths.  Array elements share a
+path (``foo[*].bar``), so a summary is usually a small fraction of
+the size of the document::
+
+    {"paths": [{"path": "@", "types": ["object"]},
+               {"path": "people", "types": ["array"], "length": [0, 3]},
+               {"path": "people[*]", "types": ["object"]},
+               {"path": "people[*].age", "types": ["null", "number"]}],
+     "truncated": false}
+
+Paths past ``max_paths`` or nested deeper than ``max_depth`` are left
+out, in which case ``truncated`` is true.
+"""
+import re
+
+
+MAX_PATHS = 500
+MAX_DEPTH = 20
+IDENTIFIER_REGEX = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+ROOT = '@'
+
+
+def summarize(document, max_paths=MAX_PATHS, max_depth=MAX_DEPTH):
+    paths = {}
+    truncated = False
+    # Walked with a stack rather than recursively so deeply nested
+    # documents can't exhaust the interpreter's stack.
+    stack = [(ROOT, document, 0)]
+    while stack:
+        path, value, depth = stack.pop()
+        entry = paths.get(path)
+        if entry is None:
+            if len(paths) >= max_paths:
+                truncated = True
+                continue
+            entry = {'types': set()}
+            paths[path] = entry
+        entry['types'].add(_type_name(value))
+        if isinstance(value, (dict, list)) and depth >= max_depth:
+            truncated = True
+            continue
+        if isinstance(value, dict):
+            for key, child in value.items():
+                stack.append((_child_path(path, key), child, depth + 1))
+        elif isinstance(value, list):
+            length = entry.get('length')
+            if length is None:
+                entry['length'] = [len(value), len(value)]
+            else:
+                length[0] = min(length[0], len(value))
+                length[1] = max(length[1], len(value))
+            element_path = _element_path(path)
+            for child in value:
+                stack.append((element_path, child, depth + 1))
+    summary = []
+    for path in sorted(paths):
+        entry = paths[path]
+        item = {'path': path, 'types': sorted(entry['types'])}
+        if 'length' in entry:
+            item['length'] = entry['length']
+        summary.append(item)
+    return {'paths': summary, 'truncated': truncated}
+
+
+def _type_name(value):
+    # The JMESPath type names.
+    if isinstance(value, dict):
+        return 'object'
+    elif isinstance(value, list):
+        return 'array'
+    elif isinstance(value, str):
+        return 'string'
+    elif isinstance(value, bool):
+        return 'boolean'
+    elif isinstance(value, (int, float)):
+        return 'number'
+    return 'null'
+
+
+def _child_path(path, key):
+    if not IDENTIFIER_REGEX.match(key):
+        key = '"%s"' % key.replace('\\', '\\\\').replace('"', '\\"')
+    if path == ROOT:
+        return key
+    return '%s.%s' % (path, key)
+
+
+def _element_path(path):
+    if path == ROOT:
+        return '[*]'
+    return '%s[*]' % path
@@ -0,0 +1,209 @@
+import os
+import sys
+import hmac
+import time
+import logging
+import hashlib
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+
+LOG = logging.getLogger('jmespath-playground.profiling')
+SIGNATURE_HEADER = 'x-profile-signature'
+# Number of requests captured in a profile.
+DEFAULT_WINDOW = 20
+# Seconds between stack samples.
+DEFAULT_INTERVAL = 0.005
+# Number of frames tracemalloc records per allocation.
+TRACEMALLOC_FRAMES = 10
+TOP_ALLOCATORS = 25
+
+
+class Profiler:
+    """Captures CPU and allocation profiles over a window of requests.
+
+    A window starts either on the first request (``start_on_first``,
+    used when profiling is enabled through the environment) or when a
+    request carries a valid signature header.  While a window is open
+    a background thread samples the stacks of the threads handling
+    requests, and tracemalloc records allocations.  When ``window``
+    requests have completed the collapsed stacks and the top
+    allocators are handed to ``sink(name, contents)``.
+
+    Signatures are ``<expiry>:<hmac>``, where expiry is a unix timestamp
+    and hmac is the hex SHA256 HMAC of the expiry keyed with ``secret``
+    (see ``sign()``).
+    """
+
+    def __init__(self, sink=None, window=DEFAULT_WINDOW,
+                 interval=DEFAULT_INTERVAL, secret=None,
+                 start_on_first=False):
+        self.sink = sink
+        self.window = window
+        self.interval = interval
+        self._secret = secret
+        self._start_on_first = start_on_first
+        self._lock = threading.Lock()
+        self._active = False
+        self._remaining = 0
+        self._threads = set()
+        self._stacks = Counter()
+        self._sampler = None
+
+    @classmethod
+    def from_environ(cls, environ):
+        # Returns None when profiling isn't enabled so that callers
+        # can skip wrapping request handlers entirely.
+        window = environ.get('APP_PROFILE')
+        secret = environ.get('APP_PROFILE_SECRET')
+        if not window and not secret:
+            return None
+        return cls(window=int(window or DEFAULT_WINDOW),
+                   secret=secret.encode('utf-8') if secret else None,
+                   start_on_first=bool(window))
+
+    @contextmanager
+    def profile(self, headers=None):
+        if not self._should_profile(headers or {}):
+            yield
+            return
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._threads.add(thread_id)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._threads.discard(thread_id)
+                self._remaining -= 1
+                finished = self._remaining <= 0 and self._active
+                if finished:
+                    self._active = False
+            if finished:
+                self._finish()
+
+    def _should_profile(self, headers):
+        with self._lock:
+            if self._active:
+                return True
+            if self._start_on_first:
+                self._start_on_first = False
+            elif not self._is_valid_signature(
+                    headers.get(SIGNATURE_HEADER)):
+                return False
+            self._active = True
+            self._remaining = self.window
+        self._start()
+        return True
+
+    def _is_valid_signature(self, signature):
+        if not signature or self._secret is None:
+            return False
+        expiry, _, digest = signature.partition(':')
+        try:
+            if float(expiry) < time.time():
+                return False
+        except ValueError:
+            return False
+        expected = sign(self._secret, expiry).partition(':')[2]
+        return hmac.compare_digest(expected, digest)
+
+    def _start(self):
+        LOG.debug("Starting profile of %s requests.", self.window)
+        self._stacks = Counter()
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self._sampler = _Sampler(self)
+        self._sampler.start()
+
+    def _finish(self):
+        self._sampler.stop()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        name = 'profile-%s-%s' % (int(time.time()), os.getpid())
+        if self.sink is None:
+            LOG.debug("No profile sink configured, discarding %s.", name)
+            return
+        self.sink('%s.folded' % name, format_stacks(self._stacks))
+        self.sink('%s.allocations.txt' % name, format_allocations(snapshot))
+
+    def _sample(self):
+        frames = sys._current_frames()
+        with self._lock:
+            thread_ids = list(self._threads)
+        for thread_id in thread_ids:
+            frame = frames.get(thread_id)
+            if frame is not None:
+                self._stacks[_collapse(frame)] += 1
+
+
+class _Sampler(threading.Thread):
+    def __init__(self, profiler):
+        super().__init__(name='profiler-sampler', daemon=True)
+        self._profiler = profiler
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._profiler.interval):
+            self._profiler._sample()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def sign(secret, expiry):
+    digest = hmac.new(secret, str(expiry).encode('utf-8'),
+                      hashlib.sha256).hexdigest()
+    return '%s:%s' % (expiry, digest)
+
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s' % (os.path.basename(code.co_filename),
+                                code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def format_stacks(stacks):
+    # The collapsed stack format used by flamegraph.pl and speedscope.
+    return ''.join('%s %s\n' % (stack, count)
+                   for stack, count in stacks.most_common())
+
+
+def format_allocations(snapshot, limit=TOP_ALLOCATORS):
+    lines = []
+    for stat in snapshot.statistics('traceback')[:limit]:
+        lines.append('%s KiB in %s blocks' % (
+            round(stat.size / 1024.0, 1), stat.count))
+        lines.extend('    %s' % line for line in stat.traceback.format())
+    return '\n'.join(lines) + '\n'
+
+
+class FileSink:
+    def __init__(self, directory):
+        self._directory = directory
+
+    def __call__(self, name, contents):
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        with open(os.path.join(self._directory, name), 'w') as f:
+            f.write(contents)
+
+
+class S3Sink:
+    def __init__(self, client, bucket, prefix=''):
+        self._client = client
+        self._bucket = bucket
+        self._prefix = prefix.rstrip('/')
+
+    def __call__(self, name, contents):
+        key = 'profiles/%s' % name
+        if self._prefix:
+            key = '%s/%s' % (self._prefix, key)
+        self._client.put_object(Bucket=self._bucket, Key=key,
+                                Body=contents.encode('utf-8'))
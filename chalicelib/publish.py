@@ -0,0 +1,80 @@
+"""Publishes shares as static objects for a CDN to serve.
+
+A saved query never changes once it's been put, so a copy of it can
+be served straight from S3 by a CDN without going through API Gateway
+and lambda.  Published copies are written to their own prefix, which
+is the only part of the bucket that needs to be public::
+
+    <prefix>/<uuid>.json
+
+Each copy is the same JSON ``GET /anon/{uuid}`` returns, gzip
+compressed ahead of time, and stored with the headers the CDN should
+pass on (``Content-Type``, ``Content-Encoding`` and a year long
+immutable ``Cache-Control``).  Shares that haven't been published are
+missing from the prefix, so the CDN should fall back to
+``/anon/{uuid}`` on a 403 or 404.
+
+Which shares are published is up to ``CachingStorage``, either every
+new share when it's saved, or those read more than a threshold number
+of times.
+"""
+import gzip
+import logging
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+
+LOG = logging.getLogger('jmespath-playground.publish')
+CONTENT_TYPE = 'application/json'
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Compressing is done once per share, so it might as well be as small
+# as possible.
+COMPRESS_LEVEL = 9
+
+
+class Publisher:
+    def __init__(self, client, bucket, prefix, threshold=0, metrics=None):
+        self._client = client
+        self._bucket = bucket
+        self._prefix = prefix.rstrip('/')
+        # Shares are published when they're saved if this is 0,
+        # otherwise once they've been read this many times.
+        self.threshold = threshold
+        self._metrics = metrics
+
+    def publish(self, uuid, contents):
+        # contents is the JSON encoded share.  Returns whether it was
+        # published, failures are logged rather than raised since the
+        # share can still be read through the API.
+        body = gzip.compress(contents, compresslevel=COMPRESS_LEVEL)
+        try:
+            self._client.put_object(Bucket=self._bucket, Key=self.key(uuid),
+                                    Body=body, ContentType=CONTENT_TYPE,
+                                    ContentEncoding='gzip',
+                                    CacheControl=CACHE_CONTROL)
+        except (ClientError, BotoCoreError):
+            LOG.debug("Unable to publish %s", uuid, exc_info=True)
+            self._incr('publish.errors')
+            return False
+        self._incr('publish.put')
+        return True
+
+    def is_published(self, uuid):
+        # Checked before publishing a share that's been read enough
+        # times, since another container may have published it
+        # already.  Errors are treated as not published.
+        try:
+            self._client.head_object(Bucket=self._bucket, Key=self.key(uuid))
+        except (ClientError, BotoCoreError):
+            return False
+        return True
+
+    def key(self, uuid):
+        key = '%s.json' % uuid
+        if self._prefix:
+            key = '%s/%s' % (self._prefix, key)
+        return key
+
+    def _incr(self, name):
+        if self._metrics is not None:
+            self._metrics.incr(name)
@@ -0,0 +1,234 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+
+LOG = logging.getLogger('jmespath-playground.ratelimit')
+# Max number of clients tracked by the in memory backend.  The least
+# recently seen clients are dropped first, which at worst gives them
+# a full bucket again.
+MAX_TRACKED_CLIENTS = 10000
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, budget, retry_after):
+        super().__init__("Rate limit exceeded for %s, retry after %.1f "
+                         "seconds." % (budget, retry_after))
+        self.budget = budget
+        self.retry_after = retry_after
+
+
+class Budget:
+    """A token bucket refilled at ``rate`` tokens per second.
+
+    ``capacity`` is the largest burst allowed.  A request costing more
+    than that (e.g a large batch) would never fit, so it's allowed
+    once the bucket is full and leaves the bucket in debt, i.e with
+    negative tokens that have to be refilled before the next request.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+
+    @classmethod
+    def parse(cls, value):
+        # '<rate>/<capacity>', e.g '10/50'
+        rate, _, capacity = value.partition('/')
+        return cls(float(rate), float(capacity or rate))
+
+    def refill(self, tokens, elapsed):
+        return min(self.capacity, tokens + elapsed * self.rate)
+
+    def admits(self, tokens, cost):
+        return tokens >= min(cost, self.capacity)
+
+    def wait_time(self, tokens, cost):
+        return (min(cost, self.capacity) - tokens) / self.rate
+
+    def full_after(self, tokens):
+        # Seconds until a bucket with tokens left is full again.
+        return (self.capacity - tokens) / self.rate
+
+
+class RateLimiter:
+    """Per client token bucket rate limiting.
+
+    ``budgets`` maps a budget name (e.g 'read', 'write', 'bytes') to
+    a ``Budget``.  Bucket state is kept in ``backend``, which defaults
+    to process memory.
+    """
+
+    def __init__(self, budgets, backend=None, clock=time.time):
+        self._budgets = budgets
+        if backend is None:
+            backend = MemoryBackend()
+        self._backend = backend
+        self._clock = clock
+
+    def check(self, client, name, cost=1):
+        budget = self._budgets.get(name)
+        if budget is None:
+            return
+        wait = self._backend.consume('%s:%s' % (name, client), cost,
+                                     budget, self._clock())
+        if wait > 0:
+            raise RateLimitExceeded(name, wait)
+
+    def check_all(self, client, costs):
+        # Checks several budgets for one request, costs being a list
+        # of (name, cost).  If one of them is exceeded, the tokens
+        # already taken from the others are given back, so a rejected
+        # request doesn't use up budget it wasn't allowed to spend.
+        charged = []
+        try:
+            for name, cost in costs:
+                self.check(client, name, cost)
+                charged.append((name, cost))
+        except RateLimitExceeded:
+            for name, cost in charged:
+                self.refund(client, name, cost)
+            raise
+
+    def refund(self, client, name, cost=1):
+        budget = self._budgets.get(name)
+        if budget is None:
+            return
+        self._backend.refund('%s:%s' % (name, client), cost, budget,
+                             self._clock())
+
+
+class MemoryBackend:
+    def __init__(self, max_clients=MAX_TRACKED_CLIENTS):
+        self._buckets = OrderedDict()
+        self._max_clients = max_clients
+        self._lock = threading.Lock()
+
+    def consume(self, key, cost, budget, now):
+        # Returns how long to wait before retrying, or 0 if the
+        # tokens were consumed.
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (budget.capacity, now))
+            tokens = budget.refill(tokens, max(now - updated, 0))
+            wait = 0
+            if budget.admits(tokens, cost):
+                tokens -= cost
+            else:
+                wait = budget.wait_time(tokens, cost)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self._max_clients:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def refund(self, key, cost, budget, now):
+        with self._lock:
+            if key not in self._buckets:
+                return
+            tokens, updated = self._buckets[key]
+            self._buckets[key] = (min(budget.capacity, tokens + cost),
+                                  updated)
+
+
+class DynamoDBBackend:
+    """Token buckets shared by every container through DynamoDB.
+
+    Each bucket is an item keyed by ``pk``.  Updates are made with a
+    conditional write on the item's version, retrying if another
+    container updated the bucket first.  If DynamoDB can't be reached
+    requests are allowed rather than failed, and refunds are dropped.
+    Items have an ``expires`` attribute that can be used as the table's
+    TTL.
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, client, table_name):
+        self._client = client
+        self._table_name = table_name
+
+    def consume(self, key, cost, budget, now):
+        try:
+            for _ in range(self.MAX_ATTEMPTS):
+                wait = self._try_consume(key, cost, budget, now)
+                if wait is not None:
+                    return wait
+        except (ClientError, BotoCoreError) as e:
+            LOG.debug("Unable to check rate limit for %s: %s", key, e)
+            return 0
+        LOG.debug("Contention on rate limit for %s, allowing request.", key)
+        return 0
+
+    def refund(self, key, cost, budget, now):
+        try:
+            for _ in range(self.MAX_ATTEMPTS):
+                if self._try_refund(key, cost, budget):
+                    return
+        except (ClientError, BotoCoreError) as e:
+            LOG.debug("Unable to refund rate limit for %s: %s", key, e)
+            return
+        LOG.debug("Contention on rate limit refund for %s.", key)
+
+    def _get_bucket(self, key):
+        return self._client.get_item(
+            TableName=self._table_name, Key={'pk': {'S': key}},
+            ConsistentRead=True).get('Item')
+
+    def _try_consume(self, key, cost, budget, now):
+        item = self._get_bucket(key)
+        if item is None:
+            tokens, updated, version = budget.capacity, now, 0
+        else:
+            tokens = float(item['tokens']['N'])
+            updated = float(item['updated']['N'])
+            version = int(item['version']['N'])
+        tokens = budget.refill(tokens, max(now - updated, 0))
+        if not budget.admits(tokens, cost):
+            # Nothing to write, the refill is recalculated from the
+            # last update the next time the bucket is checked.
+            return budget.wait_time(tokens, cost)
+        tokens -= cost
+        # Once the bucket is full again the item can be deleted.
+        expires = int(now + budget.full_after(tokens)) + 1
+        if not self._put_bucket(key, tokens, now, version, expires):
+            return None
+        return 0
+
+    def _try_refund(self, key, cost, budget):
+        # Returns False if another container updated the bucket first.
+        item = self._get_bucket(key)
+        if item is None:
+            # Already expired, so the bucket is full anyway.
+            return True
+        tokens = min(budget.capacity, float(item['tokens']['N']) + cost)
+        return self._put_bucket(key, tokens, float(item['updated']['N']),
+                                int(item['version']['N']),
+                                int(item['expires']['N']))
+
+    def _put_bucket(self, key, tokens, updated, version, expires):
+        # Writes the bucket if it's still at version (0 being a new
+        # bucket), returning False if it isn't.
+        kwargs = {}
+        if not version:
+            kwargs['ConditionExpression'] = 'attribute_not_exists(pk)'
+        else:
+            kwargs['ConditionExpression'] = 'version = :version'
+            kwargs['ExpressionAttributeValues'] = {
+                ':version': {'N': str(version)}}
+        try:
+            self._client.put_item(
+                TableName=self._table_name,
+                Item={'pk': {'S': key},
+                      'tokens': {'N': repr(tokens)},
+                      'updated': {'N': repr(updated)},
+                      'version': {'N': str(version + 1)},
+                      'expires': {'N': str(expires)}},
+                **kwargs)
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
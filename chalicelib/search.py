@@ -0,0 +1,487 @@
+"""Full text search over saved query expressions.
+
+Queries are tokenized into identifiers (field and function names,
+e.g ``sort_by``) and indexed in immutable segment files.  New shares
+are buffered in memory and written out as small segments, and small
+segments are periodically merged into larger ones.  Segments are
+stored in S3 and memory mapped from local disk when searching.
+
+A segment is laid out as (all integers little endian)::
+
+    header:    <magic><version><reserved><doc count><term count>
+    docs:      16 byte uuid per doc
+    terms:     <term offset><term length><postings offset><doc freq>
+               per term, sorted by term
+    term blob: the utf-8 encoded terms
+    postings:  per term, <doc freq> u32 doc ids followed by
+               <doc freq> u16 impacts
+
+A posting's impact is its BM25 term weight (without the IDF, which
+depends on every segment) quantized to a u16.  Postings are sorted by
+impact, so a search only needs to read the first ``max_postings`` of
+each term to find the best matches, no matter how many documents
+contain the term.
+"""
+import os
+import re
+import math
+import mmap
+import time
+import uuid
+import struct
+import logging
+import threading
+from collections import defaultdict
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+
+LOG = logging.getLogger('jmespath-playground.search')
+TOKEN_REGEX = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+SEGMENT_MAGIC = b'JPSI'
+SEGMENT_VERSION = 1
+SEGMENT_SUFFIX = '.seg'
+_HEADER = struct.Struct('<4sHHII')
+_TERM = struct.Struct('<IIII')
+_UUID_SIZE = 16
+# BM25 parameters.
+K1 = 1.2
+B = 0.75
+IMPACT_SCALE = 10000
+# Postings read per term per segment when searching.
+MAX_POSTINGS = 1000
+# Pending documents are written out as a segment after this many
+# seconds or documents.
+FLUSH_INTERVAL = 60
+FLUSH_SIZE = 500
+# Seconds between checks for segments written by other containers.
+REFRESH_INTERVAL = 60
+# When there are more segments than this, the MERGE_FACTOR smallest
+# are merged into one.
+MAX_SEGMENTS = 16
+MERGE_FACTOR = 8
+# Segments are written while handling saves, and failing to write
+# them mustn't fail the save.
+_STORE_ERRORS = (ClientError, BotoCoreError)
+
+
+def tokenize(text):
+    return [token.lower() for token in TOKEN_REGEX.findall(text or '')]
+
+
+def _impacts(docs):
+    # docs is a list of (uuid, tokens).  Returns a dict of
+    # term -> {uuid: impact}.
+    if not docs:
+        return {}
+    average_length = sum(len(tokens) for _, tokens in docs) / \
+        float(len(docs)) or 1.0
+    postings = defaultdict(dict)
+    for doc_uuid, tokens in docs:
+        norm = K1 * (1 - B + B * len(tokens) / average_length)
+        counts = defaultdict(int)
+        for token in tokens:
+            counts[token] += 1
+        for term, tf in counts.items():
+            weight = tf * (K1 + 1) / (tf + norm)
+            postings[term][doc_uuid] = min(
+                int(weight * IMPACT_SCALE), 0xffff)
+    return postings
+
+
+def build_segment(docs):
+    """Builds a segment from a list of (uuid, tokens)."""
+    return _write_segment(_impacts(docs), [u for u, _ in docs])
+
+
+def _write_segment(postings, uuids):
+    # postings is term -> {uuid: impact}.
+    doc_ids = {}
+    for doc_uuid in uuids:
+        doc_ids.setdefault(doc_uuid, len(doc_ids))
+    terms = sorted((term.encode('utf-8'), docs)
+                   for term, docs in postings.items())
+    docs_section = b''.join(uuid.UUID(u).bytes for u in doc_ids)
+    blob = b''.join(term for term, _ in terms)
+    postings_start = (_HEADER.size + len(docs_section) +
+                      _TERM.size * len(terms) + len(blob))
+    table = []
+    postings_parts = []
+    term_offset = 0
+    postings_offset = postings_start
+    for term, docs in terms:
+        ranked = sorted(docs.items(), key=lambda d: (-d[1], d[0]))
+        table.append(_TERM.pack(term_offset, len(term), postings_offset,
+                                len(ranked)))
+        postings_parts.append(struct.pack(
+            '<%sI' % len(ranked), *[doc_ids[u] for u, _ in ranked]))
+        postings_parts.append(struct.pack(
+            '<%sH' % len(ranked), *[i for _, i in ranked]))
+        term_offset += len(term)
+        postings_offset += len(ranked) * 6
+    header = _HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, 0,
+                          len(doc_ids), len(terms))
+    return b''.join([header, docs_section] + table + [blob] +
+                    postings_parts)
+
+
+class Segment:
+    """Read access to a segment held in ``buffer`` (bytes or mmap)."""
+
+    def __init__(self, buffer, name=None):
+        magic, version, _, doc_count, term_count = _HEADER.unpack_from(
+            buffer)
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+            raise ValueError("Not a search segment: %s" % name)
+        self.name = name
+        self.doc_count = doc_count
+        self.term_count = term_count
+        self._buffer = buffer
+        self._docs_offset = _HEADER.size
+        self._terms_offset = self._docs_offset + doc_count * _UUID_SIZE
+        self._blob_offset = self._terms_offset + term_count * _TERM.size
+
+    @classmethod
+    def open(cls, filename):
+        with open(filename, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buffer, name=os.path.basename(filename))
+
+    def uuid(self, doc_id):
+        offset = self._docs_offset + doc_id * _UUID_SIZE
+        return str(uuid.UUID(bytes=bytes(
+            self._buffer[offset:offset + _UUID_SIZE])))
+
+    def postings(self, term, limit=None):
+        # Returns a list of (doc id, impact), highest impact first.
+        entry = self._find(term.encode('utf-8'))
+        if entry is None:
+            return []
+        offset, count = entry
+        if limit is not None:
+            read = min(count, limit)
+        else:
+            read = count
+        doc_ids = struct.unpack_from('<%sI' % read, self._buffer, offset)
+        impacts = struct.unpack_from('<%sH' % read, self._buffer,
+                                     offset + count * 4)
+        return list(zip(doc_ids, impacts))
+
+    def doc_freq(self, term):
+        entry = self._find(term.encode('utf-8'))
+        return entry[1] if entry is not None else 0
+
+    def iter_terms(self):
+        for i in range(self.term_count):
+            yield self._term(i).decode('utf-8')
+
+    def _term(self, i):
+        term_offset, length, _, _ = _TERM.unpack_from(
+            self._buffer, self._terms_offset + i * _TERM.size)
+        start = self._blob_offset + term_offset
+        return bytes(self._buffer[start:start + length])
+
+    def _find(self, term):
+        # Binary search of the (sorted) term table.
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            current = self._term(middle)
+            if current < term:
+                low = middle + 1
+            elif current > term:
+                high = middle
+            else:
+                _, _, offset, count = _TERM.unpack_from(
+                    self._buffer, self._terms_offset + middle * _TERM.size)
+                return offset, count
+        return None
+
+
+def merge_segments(segments):
+    # Impacts are reused rather than recomputed, so they stay relative
+    # to the average document length of their original segment.  A
+    # document in more than one segment keeps its highest impact.
+    postings = defaultdict(dict)
+    uuids = []
+    for segment in segments:
+        uuids.extend(segment.uuid(i) for i in range(segment.doc_count))
+        for term in segment.iter_terms():
+            merged = postings[term]
+            for doc_id, impact in segment.postings(term):
+                doc_uuid = segment.uuid(doc_id)
+                if impact > merged.get(doc_uuid, -1):
+                    merged[doc_uuid] = impact
+    return _write_segment(postings, uuids)
+
+
+def _idf(doc_count, doc_freq):
+    return math.log(1 + (doc_count - doc_freq + 0.5) / (doc_freq + 0.5))
+
+
+class S3SegmentStore:
+    def __init__(self, client, bucket, prefix=''):
+        self._client = client
+        self._bucket = bucket
+        self._prefix = prefix.rstrip('/')
+        self._can_delete = None
+
+    def can_delete(self):
+        # Merging segments means deleting the ones that were merged,
+        # which the role might not be allowed to do.  S3 allows
+        # deleting a key that doesn't exist if deletes are allowed at
+        # all, so that's tried once before the first merge.
+        if self._can_delete is None:
+            try:
+                self._client.delete_object(Bucket=self._bucket,
+                                           Key=self._key('.delete-check'))
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != \
+                        'AccessDenied':
+                    raise
+                LOG.warning("Not allowed to delete search segments, "
+                            "segments won't be merged.")
+                self._can_delete = False
+            else:
+                self._can_delete = True
+        return self._can_delete
+
+    def list(self):
+        # Returns a dict of segment name -> size.
+        prefix = self._key('')
+        kwargs = {'Bucket': self._bucket, 'Prefix': prefix}
+        segments = {}
+        while True:
+            response = self._client.list_objects_v2(**kwargs)
+            for item in response.get('Contents', []):
+                name = item['Key'][len(prefix):]
+                if name.endswith(SEGMENT_SUFFIX):
+                    segments[name] = item.get('Size', 0)
+            if not response.get('IsTruncated'):
+                return segments
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+    def get(self, name):
+        response = self._client.get_object(Bucket=self._bucket,
+                                           Key=self._key(name))
+        return response['Body'].read()
+
+    def put(self, name, contents):
+        self._client.put_object(Bucket=self._bucket, Key=self._key(name),
+                                Body=contents)
+
+    def delete(self, name):
+        self._client.delete_object(Bucket=self._bucket, Key=self._key(name))
+
+    def _key(self, name):
+        key = 'search/%s' % name
+        if self._prefix:
+            key = '%s/%s' % (self._prefix, key)
+        return key
+
+
+class SearchIndex:
+    """Searchable index of saved queries backed by segment files.
+
+    ``add()`` buffers new documents, which are searchable right away
+    and written to ``store`` as a new segment every ``flush_interval``
+    seconds or ``flush_size`` documents.  Segments are downloaded to
+    ``local_dir`` and memory mapped (or held in memory if it's None).
+    The list of segments is refreshed from the store at most every
+    ``refresh_interval`` seconds, so a search normally makes no
+    requests at all.
+    """
+
+    def __init__(self, store, local_dir=None, flush_interval=FLUSH_INTERVAL,
+                 flush_size=FLUSH_SIZE, refresh_interval=REFRESH_INTERVAL,
+                 max_postings=MAX_POSTINGS, clock=time.time):
+        self._store = store
+        self._local_dir = local_dir
+        self._flush_interval = flush_interval
+        self._flush_size = flush_size
+        self._refresh_interval = refresh_interval
+        self._max_postings = max_postings
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._pending = []
+        self._last_flush = clock()
+        self._last_refresh = None
+        # Segment name -> (Segment, size in bytes).
+        self._segments = {}
+
+    def add(self, doc_uuid, query):
+        with self._lock:
+            self._pending.append((doc_uuid, tokenize(query)))
+            due = len(self._pending) >= self._flush_size or \
+                self._clock() - self._last_flush >= self._flush_interval
+        if due:
+            self.flush()
+
+    def search(self, text, limit=20):
+        """Returns up to ``limit`` (uuid, score), best match first."""
+        self._maybe_refresh()
+        terms = set(tokenize(text))
+        with self._lock:
+            segments = [s for s, _ in self._segments.values()]
+            pending = list(self._pending)
+        if pending:
+            segments.append(Segment(build_segment(pending)))
+        doc_count = sum(s.doc_count for s in segments)
+        scores = defaultdict(float)
+        for term in terms:
+            idf = _idf(doc_count, sum(s.doc_freq(term) for s in segments))
+            # The same document can be in more than one segment until
+            # they're merged, so only its best impact counts.
+            best = {}
+            for segment in segments:
+                for doc_id, impact in segment.postings(
+                        term, self._max_postings):
+                    doc_uuid = segment.uuid(doc_id)
+                    if impact > best.get(doc_uuid, -1):
+                        best[doc_uuid] = impact
+            for doc_uuid, impact in best.items():
+                scores[doc_uuid] += idf * impact / IMPACT_SCALE
+        ranked = sorted(scores.items(), key=lambda s: (-s[1], s[0]))
+        return ranked[:limit]
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+            self._last_flush = self._clock()
+        if not pending:
+            return None
+        contents = build_segment(pending)
+        name = _segment_name(self._clock())
+        try:
+            self._store.put(name, contents)
+        except _STORE_ERRORS as e:
+            LOG.debug("Unable to write search segment: %s", e)
+            with self._lock:
+                self._pending = pending + self._pending
+            return None
+        self._add_segment(name, contents)
+        self._maybe_merge()
+        return name
+
+    def backfill(self, documents, segment_size=10000):
+        """Indexes an iterable of (uuid, query), e.g every stored share.
+
+        Returns the number of documents indexed.
+        """
+        batch = []
+        count = 0
+        for doc_uuid, query in documents:
+            batch.append((doc_uuid, tokenize(query)))
+            if len(batch) >= segment_size:
+                count += self._write_backfill_segment(batch)
+                batch = []
+        if batch:
+            count += self._write_backfill_segment(batch)
+        self._maybe_merge()
+        return count
+
+    def _write_backfill_segment(self, batch):
+        contents = build_segment(batch)
+        name = _segment_name(self._clock())
+        self._store.put(name, contents)
+        self._add_segment(name, contents)
+        return len(batch)
+
+    def _maybe_refresh(self):
+        now = self._clock()
+        if self._last_refresh is not None and \
+                now - self._last_refresh < self._refresh_interval:
+            return
+        self._last_refresh = now
+        try:
+            self._refresh()
+        except _STORE_ERRORS as e:
+            LOG.debug("Unable to refresh search segments: %s", e)
+
+    def _refresh(self):
+        listed = self._store.list()
+        with self._lock:
+            removed = [name for name in self._segments if name not in listed]
+            for name in removed:
+                self._drop_segment(name)
+            missing = [name for name in listed if name not in self._segments]
+        for name in missing:
+            self._add_segment(name, self._store.get(name))
+
+    def _add_segment(self, name, contents):
+        if self._local_dir is None:
+            segment = Segment(contents, name=name)
+        else:
+            if not os.path.isdir(self._local_dir):
+                os.makedirs(self._local_dir)
+            filename = os.path.join(self._local_dir, name)
+            with open(filename + '.tmp', 'wb') as f:
+                f.write(contents)
+            os.replace(filename + '.tmp', filename)
+            segment = Segment.open(filename)
+        with self._lock:
+            self._segments[name] = (segment, len(contents))
+
+    def _drop_segment(self, name):
+        # The segment isn't closed since a search may still be using
+        # it.  Its mmap is closed once it's no longer referenced, and
+        # removing the file doesn't affect an existing mapping.
+        if self._segments.pop(name, None) is None:
+            return
+        if self._local_dir is not None:
+            try:
+                os.remove(os.path.join(self._local_dir, name))
+            except OSError:
+                pass
+
+    def _maybe_merge(self):
+        while self._merge_smallest():
+            pass
+
+    def _merge_smallest(self):
+        # Returns True if segments were merged.
+        with self._lock:
+            if len(self._segments) <= MAX_SEGMENTS:
+                return False
+            by_size = sorted(self._segments.items(), key=lambda s: s[1][1])
+            merging = [(name, segment)
+                       for name, (segment, _) in by_size[:MERGE_FACTOR]]
+        # A merged segment whose inputs can't be deleted would just
+        # be merged again on the next flush, leaving more and more
+        # copies in the store.
+        try:
+            if not self._store.can_delete():
+                return False
+        except _STORE_ERRORS as e:
+            LOG.debug("Unable to merge search segments: %s", e)
+            return False
+        contents = merge_segments([segment for _, segment in merging])
+        name = _segment_name(self._clock())
+        try:
+            self._store.put(name, contents)
+        except _STORE_ERRORS as e:
+            LOG.debug("Unable to merge search segments: %s", e)
+            return False
+        self._add_segment(name, contents)
+        # Another container may be merging the same segments, in
+        # which case documents are briefly in two segments, which
+        # searches allow for.  The same goes for segments that
+        # couldn't be deleted, which are merged again later.
+        deleted = []
+        try:
+            for old_name, _ in merging:
+                self._store.delete(old_name)
+                deleted.append(old_name)
+        except _STORE_ERRORS as e:
+            LOG.debug("Unable to delete merged search segments: %s", e)
+        with self._lock:
+            for old_name in deleted:
+                self._drop_segment(old_name)
+        return len(deleted) == len(merging)
+
+
+def _segment_name(now):
+    # Names sort by creation time, and are unique across containers.
+    return '%013d-%s%s' % (int(now * 1000), uuid.uuid4().hex[:12],
+                           SEGMENT_SUFFIX)
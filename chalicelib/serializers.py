@@ -0,0 +1,166 @@
+import json
+import logging
+
+
+LOG = logging.getLogger('jmespath-playground.serializers')
+# Tagged values start with this byte followed by a one byte format
+# tag.  A JSON document can't start with a NUL byte, so values
+# without it are JSON written before values were tagged.
+TAG_MARKER = b'\x00'
+TAG_HEADER_SIZE = 2
+# Used in place of a serializer whose (optional) dependency
+# isn't installed.
+FALLBACKS = {
+    'msgpack': 'fastjson',
+    'fastjson': 'json',
+}
+
+
+class UnknownFormatError(ValueError):
+    pass
+
+
+class JSONSerializer:
+    name = 'json'
+    tag = b'j'
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, contents):
+        return json.loads(contents)
+
+
+class FastJSONSerializer(JSONSerializer):
+    # Produces the same format as JSONSerializer, but several
+    # times faster.  Requires orjson.
+    name = 'fastjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, value):
+        try:
+            return self._orjson.dumps(value)
+        except TypeError:
+            # orjson doesn't support everything the json module
+            # does, e.g integers larger than 64 bits.
+            return JSONSerializer.dumps(self, value)
+
+    def loads(self, contents):
+        try:
+            return self._orjson.loads(contents)
+        except ValueError:
+            # e.g NaN, which the json module writes out.
+            return JSONSerializer.loads(self, contents)
+
+
+class MsgpackSerializer:
+    # A binary format, only used for cache values since documents
+    # in S3 are returned to clients as is.  Requires msgpack.
+    name = 'msgpack'
+    tag = b'm'
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def dumps(self, value):
+        return self._msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, contents):
+        return self._msgpack.unpackb(contents, raw=False)
+
+
+SERIALIZERS = {
+    'json': JSONSerializer,
+    'fastjson': FastJSONSerializer,
+    'msgpack': MsgpackSerializer,
+}
+
+
+def get_serializer(name):
+    try:
+        cls = SERIALIZERS[name]
+    except KeyError:
+        raise ValueError("Unknown serializer '%s', must be one of: %s" % (
+            name, ', '.join(sorted(SERIALIZERS))))
+    try:
+        return cls()
+    except ImportError as e:
+        # A warning, since it's most likely a packaging problem (e.g
+        # orjson missing from the deployment package) that costs CPU
+        # time.
+        LOG.warning("Unable to use the %s serializer (%s), using %s "
+                    "instead.", name, e, FALLBACKS[name])
+        return get_serializer(FALLBACKS[name])
+
+
+def is_json(serializer):
+    return serializer.tag == JSONSerializer.tag
+
+
+class TaggedSerializer:
+    """Serializes values with a tag recording their format.
+
+    Values are written with ``serializer`` and read back with
+    whichever serializer their tag names, so values written in
+    different formats (or before values were tagged) can be read
+    while a format change is rolled out.
+    """
+
+    def __init__(self, serializer):
+        self.serializer = serializer
+        if not is_json(serializer):
+            serializer = get_serializer('fastjson')
+        self._json = serializer
+        self._tags = {JSONSerializer.tag: self._json,
+                      self.serializer.tag: self.serializer}
+
+    def dumps(self, value):
+        serializer = self.serializer
+        try:
+            contents = serializer.dumps(value)
+        except (TypeError, ValueError, OverflowError):
+            # Anything the format can't represent (e.g msgpack and
+            # integers larger than 64 bits) is stored as JSON.
+            serializer = self._json
+            contents = serializer.dumps(value)
+        return TAG_MARKER + serializer.tag + contents
+
+    def dumps_json(self, contents):
+        # Tags already JSON encoded bytes.
+        return TAG_MARKER + JSONSerializer.tag + contents
+
+    def loads(self, contents):
+        serializer, payload = self._untag(contents)
+        return serializer.loads(payload)
+
+    def loads_json(self, contents):
+        # Returns the value as JSON encoded bytes, which only requires
+        # decoding it when it's stored in another format.
+        serializer, payload = self._untag(contents)
+        if is_json(serializer):
+            return payload
+        return self._json.dumps(serializer.loads(payload))
+
+    def _untag(self, contents):
+        if contents[:1] != TAG_MARKER:
+            return self._json, contents
+        tag = contents[1:TAG_HEADER_SIZE]
+        serializer = self._tags.get(tag)
+        if serializer is None:
+            serializer = self._load_serializer(tag)
+        return serializer, contents[TAG_HEADER_SIZE:]
+
+    def _load_serializer(self, tag):
+        for cls in SERIALIZERS.values():
+            if cls.tag == tag:
+                try:
+                    serializer = cls()
+                except ImportError:
+                    break
+                self._tags[tag] = serializer
+                return serializer
+        raise UnknownFormatError("Unable to read values tagged %r." % tag)
@@ -1,7 +1,25 @@
 import os
+import re
 import json
+import time
+import hashlib
 import logging
+import threading
 from uuid import uuid4
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from chalicelib.metrics import Metrics
+from chalicelib.paths import summarize
+from chalicelib.breaker import CircuitBreaker, CircuitOpenError
+from chalicelib.cacheindex import SnapshotLoader, SNAPSHOT_FILENAME
+from chalicelib.cacheindex import write_snapshot, catch_up, append_records
+from chalicelib.serializers import TaggedSerializer, UnknownFormatError
+from chalicelib.serializers import TAG_HEADER_SIZE
+from chalicelib.serializers import get_serializer, is_json
 
 
 # We're using a fixed name here because chalice will
@@ -9,34 +27,346 @@ from uuid import uuid4
 # matches the app name.
 LOG = logging.getLogger('jmespath-playground.storage')
 MAX_BODY_SIZE = 1024 * 100
+# Limits on batch saves (see Storage.put_many()): the total size of
+# the documents saved, and how many are uploaded at once.
+MAX_BATCH_SIZE = 1024 * 1024 * 5
+BATCH_CONCURRENCY = 16
 # Make disk space allowed for cache data.
 MAX_DISK_USAGE = 500 * 1024 * 1024
+# Seconds between snapshots of the cache's index, which let a large
+# cache be reopened without scanning all of it.
+SNAPSHOT_INTERVAL = 60
+# Seconds buffered cache writes are held before they're written out,
+# when write buffering is enabled.
+WRITE_BUFFER_INTERVAL = 1.0
+# Lambda can run many concurrent requests through one container's
+# client (e.g. parallel uploads), so allow more than botocore's
+# default of 10 pooled connections.
+MAX_POOL_CONNECTIONS = 50
+# We need this many S3 GET timings before we trust the percentile
+# used to decide when to hedge.
+HEDGE_MIN_SAMPLES = 20
+# The field holding the (potentially large) input document.
+DATA_FIELD = 'data'
+# Size of the ranged GET used to retrieve everything but the data
+# field of a stored document.  Queries are typically much smaller.
+META_RANGE_SIZE = 4096
+# Size of the chunks yielded when streaming a stored document.
+STREAM_CHUNK_SIZE = 16 * 1024
+# Value of the 'layout' metadata for objects containing a manifest
+# of chunks rather than the document itself.
+CHUNKED_LAYOUT = 'chunked'
+# With Config.dedupe_data, 'data' fields at least this many bytes long
+# are stored separately under their content hash, which is recorded
+# in the 'data-ref' metadata of the document's object.
+DEDUPE_MIN_SIZE = 1024
+# Read counts are kept for at most this many shares waiting to reach
+# the publish threshold, after which the counts are halved.
+MAX_TRACKED_READS = 10000
+DATA_REF_METADATA = 'data-ref'
+# Documents in S3 are always JSON, since they're returned to clients
+# as is, but the JSON implementation is configurable.  Cache values
+# can be stored in any format (see chalicelib.serializers).
+DEFAULT_SERIALIZER = 'fastjson'
+UUID_REGEX = re.compile(
+    r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+# Chunks and deduped data are stored under their sha256.
+DIGEST_REGEX = re.compile(r'^[0-9a-f]{64}$')
 
 
 class MaxSizeError(Exception):
     pass
 
 
+class DeadlineExceededError(Exception):
+    pass
+
+
 class Config:
-    def __init__(self, bucket, prefix='', max_body_size=MAX_BODY_SIZE):
+    def __init__(self, bucket, prefix='', max_body_size=MAX_BODY_SIZE,
+                 max_pool_connections=MAX_POOL_CONNECTIONS,
+                 connect_timeout=2, read_timeout=5,
+                 retry_mode='adaptive', max_attempts=3,
+                 tcp_keepalive=True, hedge_reads=False,
+                 hedge_percentile=95, hedge_min_delay=0.05,
+                 deadline_margin=0.5, chunk_size=None, shards=0,
+                 legacy_lookup=True, serializer=DEFAULT_SERIALIZER,
+                 max_batch_size=MAX_BATCH_SIZE,
+                 batch_concurrency=BATCH_CONCURRENCY, dedupe_data=False,
+                 dedupe_min_size=DEDUPE_MIN_SIZE):
         self.bucket = bucket
         self.prefix = prefix
         self.max_body_size = max_body_size
+        # The total size of the documents in one put_many() call, and
+        # the number of them uploaded in parallel.
+        self.max_batch_size = max_batch_size
+        self.batch_concurrency = batch_concurrency
+        # Transport settings for the S3 client.
+        self.max_pool_connections = max_pool_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retry_mode = retry_mode
+        self.max_attempts = max_attempts
+        self.tcp_keepalive = tcp_keepalive
+        # If a GET hasn't completed after the hedge_percentile latency
+        # of recent GETs (but at least hedge_min_delay seconds), a second
+        # GET is issued and whichever finishes first wins.
+        self.hedge_reads = hedge_reads
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        # Seconds of the invocation's remaining time we keep in reserve
+        # for building the response when a read is given a deadline.
+        self.deadline_margin = deadline_margin
+        # Documents larger than chunk_size bytes are split into content
+        # addressed chunks, uploaded in parallel, and tied together
+        # by a manifest stored under the document's key.  None disables
+        # chunking, which is fine as long as max_body_size stays small.
+        self.chunk_size = chunk_size
+        # When shards is non zero, objects are spread over this many
+        # hashed sub-prefixes (prefix/<shard>/<uuid>) so requests aren't
+        # limited by the request rate S3 supports for a single prefix.
+        # With legacy_lookup, objects that aren't found under their
+        # sharded key are looked up under the flat prefix/<uuid> key
+        # used before sharding was enabled.
+        self.shards = shards
+        self.legacy_lookup = legacy_lookup
+        # The name of the JSON serializer used for documents.
+        self.serializer = serializer
+        # When dedupe_data is set, the data field of a document is
+        # stored once per distinct value (if it's at least
+        # dedupe_min_size bytes), so saving a tweaked copy of a
+        # query doesn't store its data again.  Documents stored this
+        # way can't be read by code from before this option existed.
+        self.dedupe_data = dedupe_data
+        self.dedupe_min_size = dedupe_min_size
+
+
+def create_s3_client(config, session=None):
+    # The client is created once per container and stored in
+    # app.context, so its connection pool is reused across invocations.
+    # Keepalive stops idle pooled connections from being dropped
+    # between requests, which would otherwise cost a new TCP + TLS
+    # handshake on the next request.  Only botocore 1.27 and later
+    # support it (older versions reject unknown options), so it's
+    # left out on the version pinned in requirements.txt.
+    import boto3
+    from botocore.config import Config as ClientConfig
+    if session is None:
+        session = boto3.session.Session()
+    options = dict(
+        max_pool_connections=config.max_pool_connections,
+        connect_timeout=config.connect_timeout,
+        read_timeout=config.read_timeout,
+        retries={'mode': config.retry_mode,
+                 'max_attempts': config.max_attempts},
+    )
+    if 'tcp_keepalive' in ClientConfig.OPTION_DEFAULTS:
+        options['tcp_keepalive'] = config.tcp_keepalive
+    return session.client('s3', config=ClientConfig(**options))
+
+
+def select_fields(document, fields):
+    return dict((k, document[k]) for k in fields if k in document)
+
+
+def _strip_data(document):
+    return dict((k, v) for k, v in document.items() if k != DATA_FIELD)
+
+
+def _serialize_document(data, serializer):
+    # Serializes a document with every top level field other than
+    # 'data' first, and returns the encoded body along with the
+    # number of bytes taken up by those fields (or None if data
+    # isn't a dict).
+    if not isinstance(data, dict):
+        return serializer.dumps(data), None
+    meta = _strip_data(data)
+    meta_body = serializer.dumps(meta)
+    if DATA_FIELD not in data:
+        return meta_body, len(meta_body) - 1
+    prefix = meta_body[:-1]
+    if meta:
+        prefix += b','
+    body = b''.join([prefix, b'"%s":' % DATA_FIELD.encode('utf-8'),
+                     serializer.dumps(data[DATA_FIELD]), b'}'])
+    return body, len(prefix)
+
+
+def _join_data(meta_body, data_body):
+    # Adds the JSON encoded data field to a JSON encoded document
+    # without one.
+    if meta_body.rstrip() == b'{}':
+        prefix = b'{'
+    else:
+        prefix = meta_body.rstrip()[:-1] + b','
+    return b''.join([prefix, b'"%s":' % DATA_FIELD.encode('utf-8'),
+                     data_body, b'}'])
+
+
+def _data_key(digest):
+    # The cache key for a data field stored by content hash.
+    return 'data:%s' % digest
+
+
+def _summarize_data(document):
+    # The path summary (see chalicelib.paths) of a document's data
+    # field.
+    if not isinstance(document, dict):
+        return summarize(None)
+    return summarize(document.get(DATA_FIELD))
+
+
+def _encode_json(document):
+    return json.dumps(document, separators=(',', ':')).encode('utf-8')
+
+
+def _iter_chunks(contents, chunk_size):
+    for i in range(0, len(contents), chunk_size):
+        yield contents[i:i + chunk_size]
+
+
+class _RawStream:
+    # The JSON encoded chunks of a document returned by
+    # S3Storage.iter_raw().  length is the size of the document if
+    # it's known up front (i.e it isn't chunked).
+    def __init__(self, chunks, length=None):
+        self._chunks = chunks
+        self.length = length
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+
+def _iter_body(body, chunk_size):
+    try:
+        while True:
+            chunk = body.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        body.close()
+
+
+def _call(func, *args):
+    return func(*args)
+
+
+def _batch_result(future):
+    # The uuid from a batch upload, or the error uploading it.
+    if isinstance(future, Exception):
+        return future
+    try:
+        return future.result()
+    except (ClientError, BotoCoreError, CircuitOpenError) as e:
+        LOG.debug("Unable to save document in batch: %s", e)
+        return e
+
+
+def _get_shard(name, shards):
+    # Shards are named with fixed width hex strings, e.g 00-ff
+    # for 256 shards.
+    digest = hashlib.md5(name.encode('utf-8')).hexdigest()
+    width = len('%x' % (shards - 1))
+    return '%0*x' % (width, int(digest[:8], 16) % shards)
+
+
+def _is_not_found(error):
+    code = error.response.get('Error', {}).get('Code')
+    return code in ('NoSuchKey', '404', 'NotFound')
+
+
+def _is_forbidden(error):
+    code = error.response.get('Error', {}).get('Code')
+    return code in ('AccessDenied', '403', 'Forbidden')
+
+
+def _is_outage(error):
+    # Whether an error means S3 itself is unhealthy, as opposed to a
+    # missing key or a bad request.
+    if isinstance(error, ClientError):
+        if _is_not_found(error):
+            return False
+        status = error.response.get('ResponseMetadata', {}).get(
+            'HTTPStatusCode')
+        return status is None or status >= 500
+    return isinstance(error, (BotoCoreError, DeadlineExceededError))
+
+
+def _is_chunked(response):
+    return response.get('Metadata', {}).get('layout') == CHUNKED_LAYOUT
+
+
+def _get_data_ref(response):
+    return response.get('Metadata', {}).get(DATA_REF_METADATA)
+
+
+def _get_object_size(response):
+    # ContentRange looks like 'bytes 0-4095/12345'.
+    content_range = response.get('ContentRange')
+    if not content_range:
+        return response.get('ContentLength', 0)
+    return int(content_range.rsplit('/', 1)[1])
 
 
 class Storage:
     def get(self, uuid):
         raise NotImplementedError("get")
 
+    def get_fields(self, uuid, fields):
+        if DATA_FIELD in fields:
+            return select_fields(self.get(uuid), fields)
+        return select_fields(self.get_metadata(uuid), fields)
+
+    def get_metadata(self, uuid):
+        # Everything except the data field.
+        return _strip_data(self.get(uuid))
+
+    def get_raw(self, uuid):
+        # The stored document as JSON encoded bytes.
+        return json.dumps(self.get(uuid)).encode('utf-8')
+
+    def iter_raw(self, uuid, chunk_size=STREAM_CHUNK_SIZE):
+        return _iter_chunks(self.get_raw(uuid), chunk_size)
+
     def put(self, data):
         raise NotImplementedError("put")
 
+    def get_paths(self, uuid):
+        # A summary of the paths in a document's data field, for
+        # autocompleting expressions without fetching the whole
+        # document.
+        return _summarize_data(self.get(uuid))
+
+    # Whether data_ref() can return anything but None.
+    dedupes_data = False
+
+    def data_ref(self, data):
+        # The content hash a document's data field is stored under, if
+        # it's stored separately from the rest of the document.
+        return None
+
+    def put_many(self, documents, call=_call):
+        # Returns a list with the uuid of each saved document, or the
+        # exception (e.g a MaxSizeError) raised saving it.  Each save
+        # is made through call(func, *args), e.g CircuitBreaker.call.
+        results = []
+        for data in documents:
+            try:
+                results.append(call(self.put, data))
+            except (MaxSizeError, ClientError, BotoCoreError,
+                    CircuitOpenError) as e:
+                results.append(e)
+        return results
+
 
 class SemiDBMCache:
     # This is a small wrapper around semidbm.
     # It's needed for two reasons:
     # 1. We store the parsed JSON values as cache data so we need to handle the
-    # JSON load/dump ourself.
+    # serialization ourself.  Values are tagged with their format (see
+    # TaggedSerializer) so the format can be changed without clearing
+    # the cache.
     #
     # 2. We have a fixed amount of disk storage to work with.  semidbm doesn't
     # support any notion of max disk space usage so this class needs to manage
@@ -45,11 +375,47 @@ class SemiDBMCache:
     # we're betting that it's unlikely we'll reach the max disk usage
     # before the function is shut down.  It's worth investigating a proper
     # eviction strategy in the future.
+    #
+    # The index is periodically snapshotted (see chalicelib.cacheindex) so
+    # reopening the cache, e.g in a new container that finds the cache
+    # dir left behind by an old one, doesn't require scanning all of it.
+    #
+    # With write_buffer_size set, writes are held in memory (where
+    # they're readable straight away) and written out together with a
+    # single append once they add up to write_buffer_size bytes or
+    # the oldest is write_buffer_interval seconds old (checked by a
+    # timer started with the first of them), rather than with a write
+    # (and every check_frequency writes, a stat) each.  Buffered
+    # writes are also written out by flush() and close(), and are lost
+    # if the process dies first, which for a cache only costs some
+    # misses.
+    #
+    # The cache is shared by the threads fetching and uploading chunks.
+    # semidbm isn't thread safe: a write records the offset of the end
+    # of the file after its os.write() returns, by which time another
+    # thread may have appended, and a read seeks and then reads a file
+    # descriptor other threads are seeking too.  So writes are made
+    # under _write_lock and reads use os.pread(), which doesn't move
+    # the file offset.
 
-    def __init__(self, dbdir, check_frequency=20, max_filesize=MAX_DISK_USAGE):
-        import semidbm
-        self._db = semidbm.open(dbdir, 'c')
+    def __init__(self, dbdir, check_frequency=20, max_filesize=MAX_DISK_USAGE,
+                 max_item_size=None, serializer=None,
+                 snapshot_interval=SNAPSHOT_INTERVAL, write_buffer_size=None,
+                 write_buffer_interval=WRITE_BUFFER_INTERVAL):
+        self._snapshot_path = os.path.join(dbdir, SNAPSHOT_FILENAME)
+        self._db, self.open_stats = self._open(dbdir)
+        LOG.debug("Opened SemiDBMCache: %s", self.open_stats)
+        # None disables snapshots, other than on close().
+        self._snapshot_interval = snapshot_interval
+        self._last_snapshot = time.monotonic()
+        self._dirty = False
+        if serializer is None:
+            serializer = get_serializer(DEFAULT_SERIALIZER)
+        self._serializer = TaggedSerializer(serializer)
         self._max_filesize = max_filesize
+        # Values larger than this aren't cached.  Used so that large,
+        # chunked documents are only cached as individual chunks.
+        self._max_item_size = max_item_size
         # How frequently we check the file size of the cache.
         # If we check every 20 writes, then at worst case we overshoot
         # the max size by MAX_BODY_SIZE * check_frequency, or
@@ -59,6 +425,68 @@ class SemiDBMCache:
         # When we reach the max disk size, we disable
         # writing data to the cache.
         self._writes_enabled = True
+        self._write_buffer_size = write_buffer_size
+        self._write_buffer_interval = write_buffer_interval
+        self._write_lock = threading.RLock()
+        self._pending = {}
+        self._pending_size = 0
+        self._pending_since = None
+        self._flush_timer = None
+
+    def _open(self, dbdir):
+        import semidbm.db
+        # semidbm.open() doesn't let us provide our own loader, so
+        # we have to construct the db ourself.
+        params = semidbm.db._create_default_params()
+        loader = SnapshotLoader(params['data_loader'], self._snapshot_path)
+        params['data_loader'] = loader
+        start = time.monotonic()
+        db = semidbm.db._SemiDBM(dbdir, **params)
+        stats = dict(loader.stats, keys=len(db.keys()),
+                     open_time=time.monotonic() - start)
+        return db, stats
+
+    def snapshot(self):
+        self._last_snapshot = time.monotonic()
+        try:
+            count = write_snapshot(self._db, self._snapshot_path)
+        except (IOError, OSError) as e:
+            # Without a snapshot the cache is scanned when it's
+            # reopened, which is slower but otherwise fine.
+            LOG.debug("Unable to write SemiDBMCache index snapshot: %s", e)
+            return
+        LOG.debug("Wrote SemiDBMCache index snapshot with %s keys.", count)
+        self._dirty = False
+
+    def close(self):
+        self.flush()
+        if self._dirty:
+            self.snapshot()
+        self._db.close()
+
+    def flush(self):
+        # Writes out any buffered writes.
+        with self._write_lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self._pending:
+                return
+            items = list(self._pending.items())
+            self._append(items)
+            self._pending = {}
+            self._pending_size = 0
+            self._dirty = True
+            # The data file is only ever appended to, so its size is
+            # the offset of its end, no need to stat it.
+            filesize = self._db._current_offset
+            if filesize > self._max_filesize:
+                self._disable_writes(filesize)
+            else:
+                self._maybe_snapshot()
+
+    def _append(self, items):
+        append_records(self._db, items)
 
     def get(self, key, default=None):
         try:
@@ -67,21 +495,97 @@ class SemiDBMCache:
             return default
 
     def __getitem__(self, key):
-        d = self._db[key].decode('utf-8')
-        return json.loads(d)
+        try:
+            return self._serializer.loads(self._get_bytes(key))
+        except UnknownFormatError:
+            # Written in a format we can't read, treat it as a miss.
+            raise KeyError(key)
+
+    def get_raw(self, key):
+        # Returns the JSON encoded bytes for a key, only decoding
+        # them if they're stored in another format, or None if the
+        # key isn't cached.
+        try:
+            return self._serializer.loads_json(self._get_bytes(key))
+        except (KeyError, UnknownFormatError):
+            return None
+
+    def set_raw(self, key, value):
+        # Stores already JSON encoded bytes.
+        self._set_bytes(key, self._serializer.dumps_json(value))
+
+    def set_many(self, items):
+        # Stores an iterable of (key, value).
+        for key, value in items:
+            self[key] = value
+
+    def _get_bytes(self, key):
+        if self._pending:
+            value = self._pending.get(key)
+            if value is not None:
+                return value
+        return self._read(key)
+
+    def _read(self, key):
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        offset, size = self._db._index[key]
+        return os.pread(self._db._data_fd, size, offset)
 
     def __contains__(self, key):
+        if key in self._pending:
+            return True
+        # semidbm encodes keys when they're set and looked up, but
+        # not when checking for them.
+        if isinstance(key, str):
+            key = key.encode('utf-8')
         return key in self._db
 
     def __setitem__(self, key, value):
+        self._set_bytes(key, self._serializer.dumps(value))
+
+    def _set_bytes(self, key, v):
         if not self._writes_enabled:
             return
-        v = json.dumps(value).encode('utf-8')
-        self._db[key] = v
-        self._counter += 1
-        if self._counter >= self._check_frequency:
-            self._check_max_size_reached()
-            self._counter = 0
+        if self._max_item_size is not None and \
+                len(v) - TAG_HEADER_SIZE > self._max_item_size:
+            return
+        if self._write_buffer_size is not None:
+            self._buffer(key, v)
+            return
+        with self._write_lock:
+            self._db[key] = v
+            self._dirty = True
+            self._counter += 1
+            if self._counter >= self._check_frequency:
+                self._check_max_size_reached()
+                self._counter = 0
+            self._maybe_snapshot()
+
+    def _buffer(self, key, v):
+        with self._write_lock:
+            now = time.monotonic()
+            if not self._pending:
+                self._pending_since = now
+                # Written out on time even if nothing else is.
+                self._flush_timer = threading.Timer(
+                    self._write_buffer_interval, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+            previous = self._pending.get(key)
+            if previous is not None:
+                self._pending_size -= len(previous)
+            self._pending[key] = v
+            self._pending_size += len(v)
+            if self._pending_size >= self._write_buffer_size or \
+                    now - self._pending_since >= self._write_buffer_interval:
+                self.flush()
+
+    def _maybe_snapshot(self):
+        if self._snapshot_interval is not None and \
+                time.monotonic() - self._last_snapshot >= \
+                self._snapshot_interval:
+            self.snapshot()
 
     def _check_max_size_reached(self):
         # There's no public interface for getting the
@@ -90,63 +594,947 @@ class SemiDBMCache:
         filesize = os.path.getsize(self._db._data_filename)
         LOG.debug('SemiDBMCache filesize: %s', filesize)
         if filesize > self._max_filesize:
-            LOG.debug("SemiDBMCache filesize (%s) exceeded %s, "
-                      "disabling writes to cache.", filesize,
-                      self._max_filesize)
-            self._writes_enabled = False
+            self._disable_writes(filesize)
+
+    def _disable_writes(self, filesize):
+        LOG.debug("SemiDBMCache filesize (%s) exceeded %s, "
+                  "disabling writes to cache.", filesize,
+                  self._max_filesize)
+        self._writes_enabled = False
+        # There won't be any more writes, so this snapshot stays
+        # current.
+        self.snapshot()
+
+
+class SharedSemiDBMCache(SemiDBMCache):
+    """A SemiDBMCache that can be used by several processes at once.
+
+    semidbm assumes it's the only writer, so every process appending to
+    the same data file would corrupt each other's index.  Here writes
+    are serialized across processes with an flock() on a lock file in
+    the cache dir, and before appending a writer catches its index up
+    with the records other processes have appended, so the offsets it
+    records are correct.  Readers catch up when a key isn't in their
+    index.
+
+    Processes forked after the cache is opened must call
+    ``after_fork()``, since sharing file descriptors (and their file
+    offsets) with the parent isn't safe.
+    """
+
+    LOCK_FILENAME = 'lock'
+
+    def __init__(self, dbdir, **kwargs):
+        super().__init__(dbdir, **kwargs)
+        self._lock_path = os.path.join(dbdir, self.LOCK_FILENAME)
+        self._open_lock()
+
+    def _open_lock(self):
+        # flock() locks belong to an open file description, so the
+        # threads of a process share one and also need a thread lock.
+        self._lock_fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT)
+        self._thread_lock = threading.RLock()
+        self._lock_depth = 0
+
+    def after_fork(self):
+        import semidbm.compat
+        db = self._db
+        os.close(db._data_fd)
+        db._data_fd = os.open(db._data_filename,
+                              semidbm.compat.DATA_OPEN_FLAGS)
+        os.close(self._lock_fd)
+        self._open_lock()
+        # The parent process writes out what it had buffered (and its
+        # timer thread wasn't forked).
+        self._pending = {}
+        self._pending_size = 0
+        self._flush_timer = None
+
+    @contextmanager
+    def _locked(self):
+        import fcntl
+        with self._thread_lock:
+            self._lock_depth += 1
+            if self._lock_depth == 1:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _get_bytes(self, key):
+        try:
+            return super()._get_bytes(key)
+        except KeyError:
+            with self._thread_lock:
+                if not catch_up(self._db):
+                    raise
+            return self._read(key)
+
+    def _set_bytes(self, key, v):
+        if self._write_buffer_size is not None:
+            # Buffered writes only take the lock when they're written
+            # out, see _append().
+            super()._set_bytes(key, v)
+            return
+        with self._locked():
+            catch_up(self._db)
+            super()._set_bytes(key, v)
+
+    def _append(self, items):
+        with self._locked():
+            catch_up(self._db)
+            super()._append(items)
+
+    def set_many(self, items):
+        if self._write_buffer_size is not None:
+            super().set_many(items)
+            return
+        # Serialized up front so the lock is only held for the writes,
+        # which are made under a single acquisition.
+        items = [(key, self._serializer.dumps(value))
+                 for key, value in items]
+        with self._locked():
+            for key, v in items:
+                self._set_bytes(key, v)
+
+    def snapshot(self):
+        with self._locked():
+            catch_up(self._db)
+            super().snapshot()
+
+    def close(self):
+        super().close()
+        os.close(self._lock_fd)
 
 
 class CachingStorage(Storage):
-    """Wraps a storage object with a disk cache."""
+    """Wraps a storage object with a disk cache.
+
+    Reads and saves are recorded with ``listings`` (see
+    chalicelib.listings), if given, whether or not they hit the cache.
+
+    Documents whose data field the real storage keeps under its
+    content hash (see ``Storage.data_ref()``) are cached the same way:
+    the data once under ``data:<hash>``, and the rest of each document
+    along with the hash under ``<uuid>:ref``.
 
-    def __init__(self, real_storage, cache):
+    Shares are published for a CDN with ``publisher`` (see
+    chalicelib.publish), if given, when they're saved or once they've
+    been read ``publisher.threshold`` times by this container.
+    Published shares are marked with a ``<uuid>:published`` entry so
+    they're only published once.
+
+    Streamed documents (see ``iter_raw()``) that miss the cache are
+    cached as they're read if they're at most ``max_stream_size``
+    bytes, larger ones aren't buffered.
+    """
+
+    def __init__(self, real_storage, cache, metrics=None, listings=None,
+                 publisher=None, max_stream_size=MAX_BODY_SIZE):
         self._real_storage = real_storage
         self._cache = cache
+        if metrics is None:
+            metrics = Metrics()
+        self._metrics = metrics
+        self._listings = listings
+        self._publisher = publisher
+        self._max_stream_size = max_stream_size
+        self._reads = Counter()
 
     def get(self, uuid):
-        cached = self._cache.get(uuid)
+        cached = self._get_cached(uuid)
         if cached is not None:
             LOG.debug("cache hit for %s", uuid)
+            self._metrics.incr('cache.hit')
+            self._record_read(uuid)
+            self._maybe_publish(uuid, lambda: _encode_json(cached))
             return cached
         LOG.debug("cache miss for %s, retrieving from source.", uuid)
+        self._metrics.incr('cache.miss')
         result = self._real_storage.get(uuid)
-        self._cache[uuid] = result
+        self._cache_document(uuid, result)
+        self._record_read(uuid)
+        self._maybe_publish(uuid, lambda: _encode_json(result))
         return result
 
+    def get_metadata(self, uuid):
+        cached = self._cache.get(uuid)
+        if cached is not None:
+            self._record_read(uuid)
+            return _strip_data(cached)
+        ref = self._cache.get('%s:ref' % uuid)
+        if ref is not None:
+            self._record_read(uuid)
+            return ref['meta']
+        # Metadata is cached under its own key so it can't be
+        # mistaken for the full document.
+        meta_key = '%s:meta' % uuid
+        meta = self._cache.get(meta_key)
+        if meta is None:
+            meta = self._real_storage.get_metadata(uuid)
+            self._cache[meta_key] = meta
+        self._record_read(uuid)
+        return meta
+
+    def get_raw(self, uuid):
+        cached = self._get_cached_raw(uuid)
+        if cached is not None:
+            self._metrics.incr('cache.hit')
+            self._record_read(uuid)
+            self._maybe_publish(uuid, lambda: cached)
+            return cached
+        self._metrics.incr('cache.miss')
+        if self._real_storage.dedupes_data:
+            # The document has to be parsed to be cached in parts.
+            document = self._real_storage.get(uuid)
+            self._cache_document(uuid, document)
+            result = _encode_json(document)
+        else:
+            result = self._real_storage.get_raw(uuid)
+            self._cache.set_raw(uuid, result)
+        self._record_read(uuid)
+        self._maybe_publish(uuid, lambda: result)
+        return result
+
+    def iter_raw(self, uuid, chunk_size=STREAM_CHUNK_SIZE):
+        cached = self._get_cached_raw(uuid)
+        if cached is not None:
+            self._metrics.incr('cache.hit')
+            self._record_read(uuid)
+            self._maybe_publish(uuid, lambda: cached)
+            return _iter_chunks(cached, chunk_size)
+        self._metrics.incr('cache.miss')
+        chunks = self._real_storage.iter_raw(uuid, chunk_size)
+        self._record_read(uuid)
+        # Populating the cache requires the whole document in memory,
+        # which is what streaming avoids, so only documents known to
+        # be small are cached (and published) here.
+        length = getattr(chunks, 'length', None)
+        if length is not None and length <= self._max_stream_size:
+            return self._tee(uuid, chunks)
+        return chunks
+
+    def _tee(self, uuid, chunks):
+        parts = []
+        for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+        # Only cached once the whole document has been read, a client
+        # that disconnects part way through doesn't leave part of it.
+        contents = b''.join(parts)
+        if self._real_storage.dedupes_data:
+            self._cache_document(uuid, json.loads(contents))
+        else:
+            self._cache.set_raw(uuid, contents)
+        self._maybe_publish(uuid, lambda: contents)
+
     def put(self, data):
         uuid = self._real_storage.put(data)
-        self._cache[uuid] = data
+        self._cache_document(uuid, data)
+        if self._listings is not None:
+            self._listings.record_put(uuid, data)
+        if self._publishes_on_put():
+            self._publish(uuid, _encode_json(data))
         return uuid
 
+    def get_paths(self, uuid):
+        key = '%s:paths' % uuid
+        paths = self._cache.get(key)
+        if paths is None:
+            paths = self._real_storage.get_paths(uuid)
+            self._cache[key] = paths
+        return paths
+
+    def put_many(self, documents):
+        results = self._real_storage.put_many(documents)
+        saved = [(uuid, data) for uuid, data in zip(results, documents)
+                 if isinstance(uuid, str)]
+        # A dict so data shared by several documents is only written
+        # once.
+        entries = {}
+        for uuid, data in saved:
+            entries.update(self._document_entries(uuid, data))
+        self._cache.set_many(entries.items())
+        if self._listings is not None:
+            for uuid, data in saved:
+                self._listings.record_put(uuid, data)
+        if self._publishes_on_put():
+            for uuid, data in saved:
+                self._publish(uuid, _encode_json(data))
+        return results
+
+    def _record_read(self, uuid):
+        if self._listings is not None:
+            self._listings.record_read(uuid)
+
+    def _publishes_on_put(self):
+        return self._publisher is not None and self._publisher.threshold == 0
+
+    def _maybe_publish(self, uuid, contents):
+        # contents is a callable returning the JSON encoded share, so
+        # it's only encoded if it's about to be published.  With a
+        # threshold of 0 shares are only published when they're saved,
+        # reads don't publish anything.
+        if self._publisher is None or self._publishes_on_put() or \
+                '%s:published' % uuid in self._cache:
+            return
+        self._reads[uuid] += 1
+        if self._reads[uuid] < self._publisher.threshold:
+            if len(self._reads) > MAX_TRACKED_READS:
+                # Shares read once are dropped, so this only holds
+                # on to the ones that are likely to get there.
+                self._reads = Counter(dict(
+                    (u, count // 2) for u, count in self._reads.items()
+                    if count > 1))
+            return
+        # Removed whether or not publishing succeeds, so a failure is
+        # retried after another threshold's worth of reads.
+        del self._reads[uuid]
+        # The published marker is only in this container's cache, so
+        # the share may have been published by another one.
+        if self._publisher.is_published(uuid):
+            self._cache['%s:published' % uuid] = True
+            return
+        self._publish(uuid, contents())
+
+    def _publish(self, uuid, contents):
+        if self._publisher.publish(uuid, contents):
+            self._cache['%s:published' % uuid] = True
+
+    def _cache_document(self, uuid, data):
+        for key, value in self._document_entries(uuid, data):
+            self._cache[key] = value
+
+    def _document_entries(self, uuid, data):
+        # The (key, value) pairs a document is cached as.
+        digest = self._real_storage.data_ref(data)
+        if digest is None:
+            return [(uuid, data)]
+        entries = [('%s:ref' % uuid,
+                    {'meta': _strip_data(data), 'data': digest})]
+        # The cache is append only, so data that's already cached
+        # (e.g by another copy of the query) isn't written again.
+        if _data_key(digest) not in self._cache:
+            entries.append((_data_key(digest), data[DATA_FIELD]))
+        return entries
+
+    def _get_cached(self, uuid):
+        cached = self._cache.get(uuid)
+        if cached is not None:
+            return cached
+        ref = self._cache.get('%s:ref' % uuid)
+        if ref is None:
+            return None
+        try:
+            data = self._cache[_data_key(ref['data'])]
+        except KeyError:
+            return None
+        return dict(ref['meta'], **{DATA_FIELD: data})
+
+    def _get_cached_raw(self, uuid):
+        cached = self._cache.get_raw(uuid)
+        if cached is not None:
+            return cached
+        ref = self._cache.get('%s:ref' % uuid)
+        if ref is None:
+            return None
+        data = self._cache.get_raw(_data_key(ref['data']))
+        if data is None:
+            return None
+        return _join_data(json.dumps(ref['meta'], separators=(',', ':'))
+                          .encode('utf-8'), data)
+
+
+class CircuitBreakingStorage(Storage):
+    """Wraps a storage object with a circuit breaker.
+
+    While the breaker (see chalicelib.breaker) is open, reads and
+    writes raise CircuitOpenError rather than waiting on S3, so a
+    CachingStorage wrapped around this still serves what it has
+    cached and fails fast on everything else.  Writes aren't queued
+    since the uuid of a share isn't known until it's been saved.  Only
+    errors from S3 itself (and slow calls) count against it, not
+    missing keys.  ``breaker_kwargs`` are passed to CircuitBreaker.
+    """
+
+    def __init__(self, real_storage, metrics=None, **breaker_kwargs):
+        self._real_storage = real_storage
+        self.breaker = CircuitBreaker(is_failure=_is_outage, metrics=metrics,
+                                      **breaker_kwargs)
+
+    def get(self, uuid):
+        return self.breaker.call(self._real_storage.get, uuid)
+
+    def get_metadata(self, uuid):
+        return self.breaker.call(self._real_storage.get_metadata, uuid)
+
+    def get_raw(self, uuid):
+        return self.breaker.call(self._real_storage.get_raw, uuid)
+
+    def iter_raw(self, uuid, chunk_size=STREAM_CHUNK_SIZE):
+        # Only the first request is made up front, the rest of the
+        # body is read outside of the breaker.
+        return self.breaker.call(self._real_storage.iter_raw, uuid,
+                                 chunk_size)
+
+    def get_paths(self, uuid):
+        return self.breaker.call(self._real_storage.get_paths, uuid)
+
+    def put(self, data):
+        return self.breaker.call(self._real_storage.put, data)
+
+    def put_many(self, documents):
+        # Each upload is a breaker call of its own, so a large batch
+        # isn't counted as one slow call, and the documents that fail
+        # are counted even though they're returned rather than raised.
+        results = self._real_storage.put_many(documents,
+                                              call=self.breaker.call)
+        errors = [r for r in results if isinstance(r, CircuitOpenError)]
+        if errors and len(errors) == len(results):
+            raise errors[0]
+        return results
+
+    def get_index(self, name):
+        return self.breaker.call(self._real_storage.get_index, name)
+
+    def put_index(self, name, index):
+        return self.breaker.call(self._real_storage.put_index, name, index)
+
+    @property
+    def dedupes_data(self):
+        return self._real_storage.dedupes_data
+
+    def data_ref(self, data):
+        return self._real_storage.data_ref(data)
+
 
 class S3Storage(Storage):
-    def __init__(self, client, config):
+    def __init__(self, client, config, metrics=None, remaining_time=None,
+                 chunk_cache=None):
         self._config = config
         self._client = client
+        if metrics is None:
+            metrics = Metrics()
+        self._metrics = metrics
+        # A callable returning the number of seconds left in the
+        # current invocation, or None if there's no limit.
+        self._remaining_time = remaining_time
+        # Chunks of large documents are cached individually, by
+        # digest, in this cache (anything with get_raw/set_raw).
+        self._chunk_cache = chunk_cache
+        self._executor = None
+        self._batch_executor = None
+        self._serializer = get_serializer(config.serializer)
+        if not is_json(self._serializer):
+            raise ValueError("Documents must be stored as JSON, not %s." %
+                             self._serializer.name)
 
     def get(self, uuid):
-        bucket = self._config.bucket
-        key = self._create_s3_key(uuid)
-        contents = self._client.get_object(
-            Bucket=bucket, Key=key)['Body'].read()
-        return json.loads(contents)
+        return self._serializer.loads(self.get_raw(uuid))
+
+    def get_raw(self, uuid):
+        _, (contents, response) = self._read_document(uuid, self._read)
+        if _is_chunked(response):
+            contents = self._read_chunks(self._serializer.loads(contents))
+        digest = _get_data_ref(response)
+        if digest is not None:
+            contents = _join_data(contents, self.get_data(digest))
+        return contents
+
+    def iter_raw(self, uuid, chunk_size=STREAM_CHUNK_SIZE):
+        # The request is made up front so errors (e.g a missing key)
+        # are raised here rather than part way through a response.
+        self._metrics.incr('s3.get.requests')
+        _, response = self._read_document(
+            uuid, lambda key: self._client.get_object(
+                Bucket=self._config.bucket, Key=key))
+        digest = _get_data_ref(response)
+        if digest is not None:
+            # The rest of the document is small, and the data is held
+            # in memory (and cached) as a whole anyway.
+            contents = response['Body'].read()
+            if _is_chunked(response):
+                contents = self._read_chunks(self._serializer.loads(contents))
+            contents = _join_data(contents, self.get_data(digest))
+            return _RawStream(_iter_chunks(contents, chunk_size),
+                              len(contents))
+        if _is_chunked(response):
+            # Chunks are cached individually as they're fetched.
+            manifest = self._serializer.loads(response['Body'].read())
+            return _RawStream(self._iter_chunks(manifest, chunk_size))
+        return _RawStream(_iter_body(response['Body'], chunk_size),
+                          response.get('ContentLength'))
+
+    def get_data(self, digest):
+        # Returns the JSON encoded data field stored under a content
+        # hash.
+        cache_key = _data_key(digest)
+        cached = self._get_cached_chunk(cache_key, digest)
+        if cached is not None:
+            return cached
+        self._metrics.incr('s3.get.data')
+        _, (contents, response) = self._read_with_fallback(
+            self._create_data_key(digest),
+            self._create_legacy_key('data/%s' % digest), self._read)
+        if _is_chunked(response):
+            contents = self._read_chunks(self._serializer.loads(contents))
+        if hashlib.sha256(contents).hexdigest() != digest:
+            raise ValueError("Data %s is corrupt." % digest)
+        if self._chunk_cache is not None:
+            self._chunk_cache.set_raw(cache_key, contents)
+        return contents
+
+    def _iter_chunks(self, manifest, chunk_size):
+        # Chunks are fetched one at a time so only a single chunk
+        # is held in memory.
+        for digest in manifest['chunks']:
+            for part in _iter_chunks(self._get_chunk(digest), chunk_size):
+                yield part
+
+    def _read_chunks(self, manifest, count=None):
+        digests = manifest['chunks'][:count]
+        executor = self._get_executor()
+        return b''.join(executor.map(self._get_chunk, digests))
+
+    def _get_chunk(self, digest):
+        cache_key = 'chunk:%s' % digest
+        cached = self._get_cached_chunk(cache_key, digest)
+        if cached is not None:
+            return cached
+        self._metrics.incr('s3.get.chunks')
+        _, (contents, _) = self._read_with_fallback(
+            self._create_chunk_key(digest),
+            self._create_legacy_key('chunks/%s' % digest), self._fetch)
+        if hashlib.sha256(contents).hexdigest() != digest:
+            raise ValueError("Chunk %s is corrupt." % digest)
+        if self._chunk_cache is not None:
+            self._chunk_cache.set_raw(cache_key, contents)
+        return contents
+
+    def _get_cached_chunk(self, cache_key, digest):
+        # Content addressed values are checked against their hash on
+        # the way out of the cache too, a corrupt entry is treated as
+        # a miss (and overwritten once it's been fetched again).
+        if self._chunk_cache is None:
+            return None
+        cached = self._chunk_cache.get_raw(cache_key)
+        if cached is not None and \
+                hashlib.sha256(cached).hexdigest() != digest:
+            self._metrics.incr('cache.corrupt')
+            return None
+        return cached
+
+    def get_metadata(self, uuid):
+        # Objects are written with every field except 'data' at the start
+        # of the body, and the 'meta-length' metadata tells us where
+        # those fields end.  This lets us pull just those fields with a
+        # ranged GET, which is usually a single small request.
+        key, (contents, response) = self._read_document(
+            uuid, lambda key: self._read(
+                key, Range='bytes=0-%s' % (META_RANGE_SIZE - 1)))
+        self._metrics.incr('s3.get.ranged')
+        meta_length = response.get('Metadata', {}).get('meta-length')
+        if meta_length is None:
+            # Objects written before we recorded the meta length.  If
+            # the range happened to cover the whole object we can use
+            # it, otherwise we need the entire object.
+            if _is_chunked(response) or \
+                    _get_object_size(response) > len(contents):
+                return Storage.get_metadata(self, uuid)
+            return _strip_data(self._serializer.loads(contents))
+        meta_length = int(meta_length)
+        if _is_chunked(response):
+            if _get_object_size(response) > len(contents):
+                contents, _ = self._read(key)
+            manifest = self._serializer.loads(contents)
+            count = meta_length // manifest['chunk_size'] + 1
+            contents = self._read_chunks(manifest, count)
+        elif meta_length > len(contents):
+            remaining, _ = self._read(
+                key, Range='bytes=%s-%s' % (len(contents), meta_length - 1))
+            contents += remaining
+        return self._serializer.loads(
+            contents[:meta_length].rstrip(b',') + b'}')
+
+    def _read_document(self, uuid, read):
+        # Calls read(key) with the key for a uuid, falling back to the
+        # legacy flat key if needed.  Returns the key that was found
+        # along with the result of read().
+        return self._read_with_fallback(self._create_s3_key(uuid),
+                                        self._create_legacy_key(uuid), read)
+
+    def _read_with_fallback(self, key, legacy_key, read):
+        # Chunks and deduped data saved before sharding was enabled
+        # are also under flat keys, e.g 'chunks/<digest>'.
+        try:
+            return key, read(key)
+        except ClientError as e:
+            if not _is_not_found(e) or not self._config.legacy_lookup or \
+                    legacy_key == key:
+                raise
+        self._metrics.incr('s3.get.legacy')
+        return legacy_key, read(legacy_key)
+
+    def _read(self, key, **kwargs):
+        self._metrics.incr('s3.get.requests')
+        deadline = self._get_deadline()
+        if not self._config.hedge_reads and deadline is None:
+            return self._fetch(key, **kwargs)
+        executor = self._get_executor()
+        futures = [executor.submit(self._fetch, key, **kwargs)]
+        if self._config.hedge_reads:
+            delay = self._get_hedge_delay()
+            if deadline is not None:
+                delay = min(delay, max(deadline - time.monotonic(), 0))
+            done, _ = wait(futures, timeout=delay)
+            if not done:
+                self._metrics.incr('s3.get.hedged')
+                futures.append(executor.submit(self._fetch, key, **kwargs))
+        pending = set(futures)
+        error = None
+        while pending:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+            done, pending = wait(pending, timeout=timeout,
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                self._metrics.incr('s3.get.deadline_exceeded')
+                raise DeadlineExceededError(
+                    "Timed out retrieving %s from S3." % key)
+            for future in done:
+                error = future.exception()
+                if error is None:
+                    if future is not futures[0]:
+                        self._metrics.incr('s3.get.hedge_wins')
+                    return future.result()
+        raise error
+
+    def _get_deadline(self):
+        if self._remaining_time is None:
+            return None
+        remaining = self._remaining_time()
+        if remaining is None:
+            return None
+        return time.monotonic() + remaining - self._config.deadline_margin
+
+    def _get_hedge_delay(self):
+        delay = self._metrics.percentile(
+            's3.get', self._config.hedge_percentile,
+            min_samples=HEDGE_MIN_SAMPLES)
+        if delay is None:
+            return self._config.hedge_min_delay
+        return max(delay, self._config.hedge_min_delay)
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self._config.max_pool_connections)
+        return self._executor
+
+    def _fetch(self, key, **kwargs):
+        # We time the request up until the response headers arrive
+        # separately from reading the body.  The first part is S3's
+        # own latency plus connection setup (a TCP + TLS handshake) if
+        # nothing in the pool was reusable, botocore doesn't expose
+        # when a connection is made so the two aren't separated.  The
+        # second part is the actual transfer.
+        start = time.monotonic()
+        response = self._client.get_object(
+            Bucket=self._config.bucket, Key=key, **kwargs)
+        first_byte = time.monotonic()
+        contents = response['Body'].read()
+        end = time.monotonic()
+        self._metrics.timing('s3.get.first_byte', first_byte - start)
+        self._metrics.timing('s3.get.transfer', end - first_byte)
+        self._metrics.timing('s3.get', end - start)
+        return contents, response
 
     def put(self, data):
-        bucket = self._config.bucket
-        uuid = str(uuid4())
-        key = self._create_s3_key(uuid)
-        body = json.dumps(data, separators=(',', ':'))
-        if len(body) > self._config.max_body_size:
+        return self._upload(*self._serialize(data))
+
+    @property
+    def dedupes_data(self):
+        return self._config.dedupe_data
+
+    def data_ref(self, data):
+        split = self._split_data(data)
+        if split is None:
+            return None
+        return split[1]
+
+    def _split_data(self, data):
+        # Returns the JSON encoded data field and its hash if it's to
+        # be stored by content hash, otherwise None.
+        if not self._config.dedupe_data or not isinstance(data, dict) or \
+                DATA_FIELD not in data:
+            return None
+        body = self._serializer.dumps(data[DATA_FIELD])
+        if len(body) < self._config.dedupe_min_size:
+            return None
+        return body, hashlib.sha256(body).hexdigest()
+
+    def put_many(self, documents, call=_call):
+        # Every document is serialized and checked before anything is
+        # uploaded, so a batch that's too large in total is rejected
+        # without saving part of it.  Each upload is made through
+        # call(func, *args), e.g CircuitBreaker.call.
+        results = []
+        total = 0
+        for data in documents:
+            try:
+                serialized = self._serialize(data)
+            except MaxSizeError as e:
+                results.append(e)
+                continue
+            total += len(serialized[0])
+            if serialized[2] is not None:
+                total += len(serialized[2][0])
+            results.append(serialized)
+        if total > self._config.max_batch_size:
+            raise MaxSizeError("Batch is too large (%s), must be less "
+                               "than %s bytes." % (
+                                   total, self._config.max_batch_size))
+        # A separate executor from the one _put_chunks() uses, so a
+        # batch of chunked documents can't tie up every worker waiting
+        # on chunk uploads queued behind it.
+        if self._batch_executor is None:
+            self._batch_executor = ThreadPoolExecutor(
+                max_workers=self._config.batch_concurrency)
+        futures = [self._batch_executor.submit(call, self._upload, *result)
+                   if isinstance(result, tuple) else result
+                   for result in results]
+        self._metrics.incr('s3.put.batches')
+        return [_batch_result(future) for future in futures]
+
+    def _serialize(self, data):
+        # Returns the encoded document (without its data field if
+        # that's stored separately), the length of its fields other
+        # than data, the encoded data field and its hash if it's
+        # stored separately, and the encoded path summary.
+        split = self._split_data(data)
+        if split is not None:
+            body, meta_length = _serialize_document(_strip_data(data),
+                                                    self._serializer)
+            size = len(body) + len(split[0])
+        else:
+            body, meta_length = _serialize_document(data, self._serializer)
+            size = len(body)
+        if size > self._config.max_body_size:
             raise MaxSizeError("Request body is too large (%s), "
                                "must be less than %s bytes." % (
-                                   len(body), self._config.max_body_size))
-        self._client.put_object(Bucket=bucket, Key=key, Body=body)
+                                   size, self._config.max_body_size))
+        paths = self._serializer.dumps(_summarize_data(data))
+        return body, meta_length, split, paths
+
+    def _upload(self, body, meta_length, split=None, paths=None):
+        uuid = str(uuid4())
+        metadata = {}
+        if meta_length is not None:
+            metadata['meta-length'] = str(meta_length)
+        # The path summary is uploaded at the same time as the
+        # document so saving doesn't take any longer.
+        paths_future = None
+        if paths is not None:
+            paths_future = self._get_executor().submit(
+                self._put_paths, uuid, paths)
+        if split is not None:
+            self._put_data(*split)
+            metadata[DATA_REF_METADATA] = split[1]
+        with self._metrics.timer('s3.put'):
+            self._put_object(self._create_s3_key(uuid), body, metadata)
+        if paths_future is not None:
+            paths_future.result()
         return uuid
 
+    def _put_paths(self, uuid, paths):
+        # Best effort, a missing summary is computed from the document
+        # when it's first asked for.
+        self._metrics.incr('s3.put.paths')
+        try:
+            self._client.put_object(Bucket=self._config.bucket,
+                                    Key=self._create_paths_key(uuid),
+                                    Body=paths)
+        except ClientError:
+            LOG.debug("Unable to save path summary for %s", uuid,
+                      exc_info=True)
+
+    def get_paths(self, uuid):
+        self._metrics.incr('s3.get.paths')
+        try:
+            contents, _ = self._fetch(self._create_paths_key(uuid))
+        except ClientError as e:
+            if not _is_not_found(e):
+                raise
+        else:
+            return self._serializer.loads(contents)
+        # Shares saved before summaries were, or whose summary failed
+        # to upload, are summarized now and the summary saved for next
+        # time.
+        paths = _summarize_data(self.get(uuid))
+        self._metrics.incr('s3.paths.backfilled')
+        self._put_paths(uuid, self._serializer.dumps(paths))
+        return paths
+
+    def _put_object(self, key, body, metadata):
+        chunk_size = self._config.chunk_size
+        if chunk_size is not None and len(body) > chunk_size:
+            manifest = self._put_chunks(body, chunk_size)
+            body = self._serializer.dumps(manifest)
+            metadata['layout'] = CHUNKED_LAYOUT
+        self._client.put_object(Bucket=self._config.bucket, Key=key,
+                                Body=body, Metadata=metadata)
+
+    def _put_data(self, body, digest):
+        # Data is only uploaded if it isn't stored already.  Knowing it
+        # is cached saves checking with a HEAD request.
+        cache_key = _data_key(digest)
+        if self._chunk_cache is not None and cache_key in self._chunk_cache:
+            self._metrics.incr('s3.put.data_deduped')
+            return
+        key = self._create_data_key(digest)
+        try:
+            self._client.head_object(Bucket=self._config.bucket, Key=key)
+        except ClientError as e:
+            # Without s3:ListBucket, S3 answers a HEAD for a missing key
+            # with a 403.  Uploading the data again is harmless since
+            # the key is its digest.
+            if not _is_not_found(e) and not _is_forbidden(e):
+                raise
+            self._metrics.incr('s3.put.data')
+            self._put_object(key, body, {})
+        else:
+            self._metrics.incr('s3.put.data_deduped')
+        if self._chunk_cache is not None:
+            self._chunk_cache.set_raw(cache_key, body)
+
+    def _put_chunks(self, body, chunk_size):
+        chunks = [body[i:i + chunk_size]
+                  for i in range(0, len(body), chunk_size)]
+        digests = [hashlib.sha256(chunk).hexdigest() for chunk in chunks]
+        executor = self._get_executor()
+        # list() so any upload errors are raised here.
+        list(executor.map(self._put_chunk, digests, chunks))
+        return {'size': len(body), 'chunk_size': chunk_size,
+                'chunks': digests}
+
+    def _put_chunk(self, digest, chunk):
+        self._metrics.incr('s3.put.chunks')
+        self._client.put_object(Bucket=self._config.bucket,
+                                Key=self._create_chunk_key(digest),
+                                Body=chunk)
+        if self._chunk_cache is not None:
+            self._chunk_cache.set_raw('chunk:%s' % digest, chunk)
+
+    def iter_uuids(self):
+        # Yields the uuid of every stored document, in both the
+        # sharded and the legacy layout.
+        prefix = self._create_legacy_key('')
+        for key in self._iter_keys(prefix):
+            parts = key[len(prefix):].split('/')
+            if UUID_REGEX.match(parts[-1]) and len(parts) <= 2:
+                yield parts[-1]
+
+    def migrate_legacy_keys(self, delete=False):
+        # Copies documents, chunks and deduped data stored under legacy
+        # flat keys to their sharded keys.  Legacy objects are only
+        # deleted if requested, so this can be run before every
+        # container has been updated to look up sharded keys.  Returns
+        # the number of objects migrated.
+        if not self._config.shards:
+            return 0
+        layouts = [
+            ('', UUID_REGEX, self._create_s3_key),
+            ('chunks/', DIGEST_REGEX, self._create_chunk_key),
+            ('data/', DIGEST_REGEX, self._create_data_key),
+        ]
+        bucket = self._config.bucket
+        migrated = 0
+        for subdir, regex, create_key in layouts:
+            prefix = self._create_legacy_key(subdir)
+            for key in self._iter_keys(prefix, delimiter='/'):
+                name = key[len(prefix):]
+                if not regex.match(name):
+                    continue
+                self._client.copy_object(
+                    Bucket=bucket, Key=create_key(name),
+                    CopySource={'Bucket': bucket, 'Key': key})
+                if delete:
+                    self._client.delete_object(Bucket=bucket, Key=key)
+                migrated += 1
+        return migrated
+
+    def get_index(self, name):
+        # Index objects (see chalicelib.listings) are small JSON
+        # documents stored alongside the saved queries.  Returns None
+        # if the index hasn't been written yet.
+        self._metrics.incr('s3.get.index')
+        try:
+            contents, _ = self._fetch(self._create_index_key(name))
+        except ClientError as e:
+            if _is_not_found(e):
+                return None
+            raise
+        return self._serializer.loads(contents)
+
+    def put_index(self, name, index):
+        self._metrics.incr('s3.put.index')
+        self._client.put_object(Bucket=self._config.bucket,
+                                Key=self._create_index_key(name),
+                                Body=self._serializer.dumps(index))
+
+    def _iter_keys(self, prefix, delimiter=None):
+        kwargs = {'Bucket': self._config.bucket, 'Prefix': prefix}
+        if delimiter is not None:
+            kwargs['Delimiter'] = delimiter
+        while True:
+            response = self._client.list_objects_v2(**kwargs)
+            for item in response.get('Contents', []):
+                yield item['Key']
+            if not response.get('IsTruncated'):
+                break
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
     def _create_s3_key(self, uuid):
+        shards = self._config.shards
+        if not shards:
+            return self._create_legacy_key(uuid)
+        return self._create_legacy_key(
+            '%s/%s' % (_get_shard(uuid, shards), uuid))
+
+    def _create_legacy_key(self, uuid):
         prefix = self._config.prefix
         if not prefix:
             return uuid
         elif prefix.endswith('/'):
             prefix = prefix[:-1]
         return '%s/%s' % (prefix, uuid)
+
+    def _create_chunk_key(self, digest):
+        shards = self._config.shards
+        if not shards:
+            return self._create_legacy_key('chunks/%s' % digest)
+        return self._create_legacy_key(
+            'chunks/%s/%s' % (_get_shard(digest, shards), digest))
+
+    def _create_data_key(self, digest):
+        shards = self._config.shards
+        if not shards:
+            return self._create_legacy_key('data/%s' % digest)
+        return self._create_legacy_key(
+            'data/%s/%s' % (_get_shard(digest, shards), digest))
+
+    def _create_paths_key(self, uuid):
+        # The .json suffix keeps these from being mistaken for
+        # documents by iter_uuids() when there are no shards.
+        shards = self._config.shards
+        if not shards:
+            return self._create_legacy_key('paths/%s.json' % uuid)
+        return self._create_legacy_key(
+            'paths/%s/%s.json' % (_get_shard(uuid, shards), uuid))
+
+    def _create_index_key(self, name):
+        return self._create_legacy_key('indexes/%s.json' % name)
@@ -0,0 +1,182 @@
+import re
+import base64
+import logging
+import threading
+from http import HTTPStatus
+from urllib.parse import parse_qs
+
+
+LOG = logging.getLogger('jmespath-playground.wsgi')
+JSON_CONTENT_TYPE = 'application/json'
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+
+class WSGIAdapter:
+    """Serve a chalice app from any WSGI server.
+
+    Each request is converted into the API Gateway proxy event the
+    chalice app normally receives from lambda.  GET routes listed in
+    ``streaming_routes`` are handled differently: their handler returns
+    an iterable of JSON encoded bytes which is handed to the WSGI
+    server as is, so the response is never buffered in full.  POST
+    routes listed in ``streaming_uploads`` are the same, except their
+    handler is also given the request body as a file like object (and
+    its length) and the response is newline delimited JSON.  Streaming
+    handlers are also given the ``identity`` the request would have in
+    its event's request context (i.e its source IP), for rate limiting.
+    If a streaming handler raises an exception we fall back to the regular
+    chalice route so errors are reported the same way.  Handlers must
+    do anything that can fail before they read the body.
+
+    Chalice stores the request being handled on the app object
+    (``app.current_request``), so requests are dispatched to the
+    chalice app one at a time.  Streaming routes don't use chalice and
+    can run concurrently.
+    """
+
+    def __init__(self, app, streaming_routes=None, streaming_uploads=None):
+        self._app = app
+        self._lock = threading.Lock()
+        # Routes without parameters are matched first, which mirrors
+        # API Gateway preferring '/anon/foo' over '/anon/{uuid}'.
+        paths = sorted(app.routes, key=lambda p: p.count('{'))
+        self._routes = [(_compile_route(path), path) for path in paths]
+        if streaming_routes is None:
+            streaming_routes = {}
+        self._streaming_routes = streaming_routes
+        self._streaming_uploads = streaming_uploads or {}
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        path = environ.get('PATH_INFO') or '/'
+        resource_path, uri_params = self._match_route(path)
+        if resource_path is None:
+            return self._send(start_response, 404, [
+                ('Content-Type', JSON_CONTENT_TYPE)],
+                b'{"Code":"NotFoundError","Message":"Not found"}')
+        if method == 'GET' and resource_path in self._streaming_routes \
+                and not environ.get('QUERY_STRING'):
+            chunks = self._try_stream(resource_path, uri_params,
+                                      identity=_identity(environ))
+            if chunks is not None:
+                start_response('200 OK', [
+                    ('Content-Type', JSON_CONTENT_TYPE),
+                    ('Access-Control-Allow-Origin', '*'),
+                ])
+                return chunks
+        if method == 'POST' and resource_path in self._streaming_uploads:
+            chunks = self._try_stream(
+                resource_path, uri_params,
+                streams=self._streaming_uploads,
+                body=environ['wsgi.input'], length=_content_length(environ),
+                identity=_identity(environ))
+            if chunks is not None:
+                start_response('200 OK', [
+                    ('Content-Type', NDJSON_CONTENT_TYPE),
+                    ('Access-Control-Allow-Origin', '*'),
+                ])
+                return chunks
+        event = create_event(environ, resource_path, uri_params)
+        with self._lock:
+            response = self._app(event, None)
+        body = response.get('body') or ''
+        if response.get('isBase64Encoded'):
+            body = base64.b64decode(body)
+        elif not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        headers = [(k, v) for k, v in response.get('headers', {}).items()]
+        for name, values in response.get('multiValueHeaders', {}).items():
+            headers.extend((name, v) for v in values)
+        return self._send(start_response, response['statusCode'],
+                          headers, body)
+
+    def _try_stream(self, resource_path, uri_params, streams=None,
+                    **kwargs):
+        if streams is None:
+            streams = self._streaming_routes
+        handler = streams[resource_path]
+        try:
+            return handler(**dict(uri_params, **kwargs))
+        except Exception as e:
+            LOG.debug("Streaming %s failed (%s), falling back to "
+                      "buffered response.", resource_path, e)
+            return None
+
+    def _match_route(self, path):
+        for regex, resource_path in self._routes:
+            match = regex.match(path)
+            if match is not None:
+                return resource_path, match.groupdict()
+        return None, None
+
+    def _send(self, start_response, status_code, headers, body):
+        headers = headers + [('Content-Length', str(len(body)))]
+        start_response(_status_line(status_code), headers)
+        return [body]
+
+
+def create_event(environ, resource_path, uri_params):
+    # Builds the API Gateway lambda proxy event for a WSGI request.
+    method = environ['REQUEST_METHOD']
+    headers = {}
+    for key, value in environ.items():
+        if key.startswith('HTTP_'):
+            headers[key[5:].replace('_', '-').lower()] = value
+    body = _read_body(environ)
+    # wsgiref fills in text/plain when a request has no Content-Type,
+    # which chalice would reject for a GET that has no body anyway.
+    if environ.get('CONTENT_TYPE') and body:
+        headers['content-type'] = environ['CONTENT_TYPE']
+    multi_query = parse_qs(environ.get('QUERY_STRING', ''))
+    query = dict((k, v[-1]) for k, v in multi_query.items())
+    return {
+        'httpMethod': method,
+        'path': environ.get('PATH_INFO') or '/',
+        'resource': resource_path,
+        'headers': headers,
+        'multiValueHeaders': dict((k, [v]) for k, v in headers.items()),
+        'queryStringParameters': query or None,
+        'multiValueQueryStringParameters': multi_query or None,
+        'pathParameters': uri_params or None,
+        'stageVariables': None,
+        'body': body.decode('utf-8') if body else None,
+        'isBase64Encoded': False,
+        'requestContext': {
+            'httpMethod': method,
+            'resourcePath': resource_path,
+            'path': environ.get('PATH_INFO') or '/',
+            'identity': _identity(environ),
+        },
+    }
+
+
+def _identity(environ):
+    return {'sourceIp': environ.get('REMOTE_ADDR', '127.0.0.1')}
+
+
+def _read_body(environ):
+    length = _content_length(environ)
+    if length <= 0:
+        return b''
+    return environ['wsgi.input'].read(length)
+
+
+def _content_length(environ):
+    try:
+        return max(int(environ.get('CONTENT_LENGTH') or 0), 0)
+    except ValueError:
+        return 0
+
+
+def _compile_route(path):
+    # '/anon/{uuid}' -> '^/anon/(?P<uuid>[^/]+)$'
+    pattern = re.sub(r'\\{(\w+)\\}', r'(?P<\1>[^/]+)', re.escape(path))
+    return re.compile('^%s$' % pattern)
+
+
+def _status_line(status_code):
+    try:
+        phrase = HTTPStatus(status_code).phrase
+    except ValueError:
+        phrase = ''
+    return ('%s %s' % (status_code, phrase)).strip()
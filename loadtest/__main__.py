@@ -0,0 +1,68 @@
+"""Run an offline load test against the app.
+
+The app runs in-process against a simulated S3 client, so no AWS
+credentials or network access are needed.  Any ``APP_*`` environment
+variables set when running this are used to configure the app, e.g::
+
+    APP_S3_SHARDS=16 python -m loadtest --requests 5000 --prefix-rps 200
+
+"""
+import json
+import random
+import argparse
+
+from loadtest.runner import LoadTest, format_report
+from loadtest.s3 import LatencyModel, SimulatedS3Client
+from loadtest.traffic import TrafficMix
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Number of simulated lambda containers.')
+    parser.add_argument('--seed-documents', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=1000,
+                        help='Number of distinct client IPs.')
+    parser.add_argument('--read-ratio', type=float, default=0.9)
+    parser.add_argument('--zipf', type=float, default=1.1,
+                        help='Zipf exponent for document popularity.')
+    parser.add_argument('--burst-every', type=int, default=500)
+    parser.add_argument('--burst-size', type=int, default=50)
+    parser.add_argument('--latency-median', type=float, default=0.02)
+    parser.add_argument('--latency-sigma', type=float, default=0.5)
+    parser.add_argument('--tail-probability', type=float, default=0.0)
+    parser.add_argument('--tail-latency', type=float, default=1.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--prefix-rps', type=int, default=None,
+                        help='Throttle each S3 prefix past this rate.')
+    parser.add_argument('--random-seed', type=int, default=None)
+    parser.add_argument('--verbose', action='store_true',
+                        help='Show the app\'s log output.')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the report as JSON.')
+    args = parser.parse_args()
+    rng = random.Random(args.random_seed)
+    latency = LatencyModel(median=args.latency_median,
+                           sigma=args.latency_sigma,
+                           tail_probability=args.tail_probability,
+                           tail_latency=args.tail_latency, rng=rng)
+    client = SimulatedS3Client(latency=latency, error_rate=args.error_rate,
+                               prefix_rps=args.prefix_rps, rng=rng)
+    traffic = TrafficMix(read_ratio=args.read_ratio,
+                         burst_every=args.burst_every,
+                         burst_size=args.burst_size, rng=rng)
+    load_test = LoadTest(client, concurrency=args.concurrency,
+                         traffic=traffic,
+                         seed_documents=args.seed_documents,
+                         zipf_s=args.zipf, clients=args.clients,
+                         verbose=args.verbose, rng=rng)
+    report = load_test.run(args.requests)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
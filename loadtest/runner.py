@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import queue
+import random
+import logging
+import shutil
+import tempfile
+import threading
+import importlib.util
+from io import BytesIO
+from wsgiref.util import setup_testing_defaults
+
+from chalicelib.wsgi import WSGIAdapter
+from loadtest.traffic import TrafficMix, ZipfSampler
+
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'app.py')
+
+
+class Container:
+    """A simulated lambda container.
+
+    Each container loads its own copy of the app module, so it has its
+    own ``app.context`` (S3 client, cache, metrics) and handles one
+    request at a time, just like a lambda container.  Every container
+    shares the same simulated S3 client.
+    """
+
+    def __init__(self, index, client, workdir):
+        spec = importlib.util.spec_from_file_location(
+            'loadtest_app_%s' % index, APP_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module.CACHE_DIR = os.path.join(workdir, 'cache-%s' % index)
+        module.create_s3_client = lambda config: client
+        self.module = module
+        self._adapter = WSGIAdapter(module.app)
+
+    @property
+    def metrics(self):
+        return self.module.app.context.get('metrics')
+
+    def request(self, method, path, body=None, client_ip='127.0.0.1'):
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+        body = body or b''
+        environ = {}
+        setup_testing_defaults(environ)
+        environ.update({
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'CONTENT_LENGTH': str(len(body)),
+            'CONTENT_TYPE': 'application/json',
+            'wsgi.input': BytesIO(body),
+            'REMOTE_ADDR': client_ip,
+        })
+        status = []
+
+        def start_response(status_line, headers):
+            status.append(int(status_line.split()[0]))
+
+        contents = b''.join(self._adapter(environ, start_response))
+        return status[0], contents
+
+
+class LoadTest:
+    """Replays a traffic mix against a pool of simulated containers.
+
+    ``concurrency`` is the number of containers, and therefore the
+    number of requests in flight at any time.
+    """
+
+    def __init__(self, client, concurrency=8, traffic=None, seed_documents=200,
+                 zipf_s=1.1, clients=1000, verbose=False, rng=None):
+        if rng is None:
+            rng = random.Random()
+        if traffic is None:
+            traffic = TrafficMix(rng=rng)
+        self.client = client
+        self.concurrency = concurrency
+        self.traffic = traffic
+        self.seed_documents = seed_documents
+        self.verbose = verbose
+        # Requests come from this many distinct client IPs.
+        self.clients = clients
+        self._rng = rng
+        self._sampler = ZipfSampler(s=zipf_s, rng=rng)
+        self._uuids = []
+        self._uuids_lock = threading.Lock()
+        self._results = []
+
+    def run(self, requests):
+        os.environ.setdefault('APP_S3_BUCKET', 'loadtest')
+        workdir = tempfile.mkdtemp(prefix='jp-loadtest-')
+        try:
+            containers = [Container(i, self.client, workdir)
+                          for i in range(self.concurrency)]
+            # The app runs with debug logging, which would drown out the
+            # report (and slow down the run) unless asked for.
+            if not self.verbose:
+                logging.getLogger(containers[0].module.app.app_name).setLevel(
+                    logging.CRITICAL)
+            self._seed(containers[0])
+            # Only the calls made while replaying traffic are reported.
+            before = (dict(self.client.calls), dict(self.client.errors))
+            elapsed = self._replay(containers, requests)
+            return self._report(containers, elapsed, before)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def _seed(self, container):
+        for i in range(self.seed_documents):
+            # Seed documents come from distinct clients so they aren't
+            # rate limited.
+            status, body = container.request(
+                'POST', '/anon', self.traffic.document(),
+                client_ip='192.168.%s.%s' % (i >> 8 & 255, i & 255))
+            if status == 200:
+                self._add_uuid(json.loads(body)['uuid'])
+
+    def _replay(self, containers, requests):
+        idle = queue.Queue()
+        for container in containers:
+            idle.put(container)
+        work = queue.Queue(maxsize=self.concurrency * 2)
+        threads = [threading.Thread(target=self._worker, args=(idle, work))
+                   for _ in containers]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for operation in self.traffic.operations(requests):
+            work.put(operation)
+        for _ in threads:
+            work.put(None)
+        for thread in threads:
+            thread.join()
+        return time.monotonic() - start
+
+    def _worker(self, idle, work):
+        while True:
+            operation = work.get()
+            if operation is None:
+                return
+            container = idle.get()
+            try:
+                self._execute(container, operation)
+            finally:
+                idle.put(container)
+
+    def _execute(self, container, operation):
+        kind, document = operation
+        with self._uuids_lock:
+            client = self._rng.randrange(self.clients)
+            if kind == 'get':
+                uuid = self._uuids[self._sampler.sample()]
+        client_ip = '10.%s.%s.%s' % (
+            client >> 16 & 255, client >> 8 & 255, client & 255)
+        start = time.monotonic()
+        if kind == 'get':
+            status, _ = container.request('GET', '/anon/%s' % uuid,
+                                          client_ip=client_ip)
+        else:
+            status, body = container.request('POST', '/anon', document,
+                                             client_ip=client_ip)
+            if status == 200:
+                self._add_uuid(json.loads(body)['uuid'])
+        self._results.append((kind, status, time.monotonic() - start))
+
+    def _add_uuid(self, uuid):
+        with self._uuids_lock:
+            self._uuids.append(uuid)
+            self._sampler.grow()
+
+    def _report(self, containers, elapsed, before):
+        calls_before, errors_before = before
+        report = {
+            'requests': len(self._results),
+            'elapsed': elapsed,
+            'throughput': len(self._results) / elapsed if elapsed else 0,
+            'operations': {},
+            's3_calls': _difference(self.client.calls, calls_before),
+            's3_errors': _difference(self.client.errors, errors_before),
+        }
+        for kind in ('get', 'post'):
+            latencies = sorted(r[2] for r in self._results if r[0] == kind)
+            statuses = {}
+            for result in self._results:
+                if result[0] == kind:
+                    statuses[result[1]] = statuses.get(result[1], 0) + 1
+            report['operations'][kind] = {
+                'count': len(latencies),
+                'statuses': statuses,
+                'p50': _percentile(latencies, 50),
+                'p95': _percentile(latencies, 95),
+                'p99': _percentile(latencies, 99),
+                'max': latencies[-1] if latencies else None,
+            }
+        hits = misses = 0
+        for container in containers:
+            if container.metrics is not None:
+                hits += container.metrics.counter('cache.hit')
+                misses += container.metrics.counter('cache.miss')
+        report['cache_hit_ratio'] = (
+            hits / float(hits + misses) if hits + misses else None)
+        return report
+
+
+def _difference(current, before):
+    difference = {}
+    for name, count in current.items():
+        if count - before.get(name, 0):
+            difference[name] = count - before.get(name, 0)
+    return difference
+
+
+def _percentile(sorted_values, percentile):
+    if not sorted_values:
+        return None
+    index = int(round(percentile / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def format_report(report):
+    lines = [
+        'Requests:        %s in %.2fs' % (report['requests'],
+                                          report['elapsed']),
+        'Throughput:      %.1f req/s' % report['throughput'],
+    ]
+    if report['cache_hit_ratio'] is not None:
+        lines.append('Cache hit ratio: %.1f%%' % (
+            report['cache_hit_ratio'] * 100))
+    for kind, stats in sorted(report['operations'].items()):
+        if not stats['count']:
+            continue
+        lines.append(
+            '%-4s %6s reqs  p50 %7.1fms  p95 %7.1fms  p99 %7.1fms  '
+            'max %7.1fms  statuses %s' % (
+                kind.upper(), stats['count'], stats['p50'] * 1000,
+                stats['p95'] * 1000, stats['p99'] * 1000,
+                stats['max'] * 1000, stats['statuses']))
+    lines.append('S3 calls:        %s' % report['s3_calls'])
+    if report['s3_errors']:
+        lines.append('S3 errors:       %s' % report['s3_errors'])
+    return '\n'.join(lines)
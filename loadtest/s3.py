@@ -0,0 +1,183 @@
+import io
+import math
+import time
+import random
+import threading
+from collections import Counter
+
+from botocore.exceptions import ClientError
+
+
+class LatencyModel:
+    """Latency of a simulated S3 request, in seconds.
+
+    Latencies are log-normally distributed around ``median``, with an
+    additional ``tail_probability`` chance of a request taking
+    ``tail_latency`` seconds to model the occasional very slow
+    response.  ``bytes_per_second`` adds a transfer time proportional
+    to the size of the body.
+    """
+
+    def __init__(self, median=0.02, sigma=0.5, tail_probability=0.0,
+                 tail_latency=1.0, bytes_per_second=50 * 1024 * 1024,
+                 rng=None):
+        self.median = median
+        self.sigma = sigma
+        self.tail_probability = tail_probability
+        self.tail_latency = tail_latency
+        self.bytes_per_second = bytes_per_second
+        if rng is None:
+            rng = random.Random()
+        self._rng = rng
+
+    def sample(self, size=0):
+        if self.median <= 0:
+            latency = 0.0
+        else:
+            latency = self._rng.lognormvariate(math.log(self.median),
+                                               self.sigma)
+        if self._rng.random() < self.tail_probability:
+            latency += self.tail_latency
+        if self.bytes_per_second:
+            latency += size / float(self.bytes_per_second)
+        return latency
+
+
+class SimulatedS3Client:
+    """An in memory stand in for an S3 client.
+
+    Supports the subset of the S3 API used by ``S3Storage`` and can
+    inject latency, per-prefix throttling (``SlowDown`` errors once a
+    prefix exceeds ``prefix_rps`` requests per second), and random
+    ``InternalError`` failures.  Every call is counted by operation.
+    """
+
+    def __init__(self, latency=None, error_rate=0.0, prefix_rps=None,
+                 rng=None):
+        if rng is None:
+            rng = random.Random()
+        if latency is None:
+            latency = LatencyModel(rng=rng)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.prefix_rps = prefix_rps
+        self.calls = Counter()
+        self.errors = Counter()
+        self._rng = rng
+        self._objects = {}
+        self._lock = threading.Lock()
+        # prefix -> (window start, requests in window)
+        self._prefix_windows = {}
+
+    def get_object(self, Bucket, Key, Range=None):
+        self._before_call('GetObject', Key)
+        with self._lock:
+            stored = self._objects.get((Bucket, Key))
+        if stored is None:
+            raise _error('NoSuchKey', 'GetObject', 404)
+        body, metadata = stored
+        response = {'Metadata': dict(metadata),
+                    'ContentLength': len(body)}
+        if Range is not None:
+            start, end = Range[len('bytes='):].split('-')
+            response['ContentRange'] = 'bytes %s-%s/%s' % (
+                start, end, len(body))
+            body = body[int(start):int(end) + 1]
+        self._sleep(len(body))
+        response['Body'] = io.BytesIO(body)
+        return response
+
+    def put_object(self, Bucket, Key, Body, Metadata=None, **kwargs):
+        self._before_call('PutObject', Key)
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        self._sleep(len(Body))
+        with self._lock:
+            self._objects[(Bucket, Key)] = (Body, Metadata or {})
+        return {}
+
+    def head_object(self, Bucket, Key):
+        self._before_call('HeadObject', Key)
+        self._sleep()
+        with self._lock:
+            stored = self._objects.get((Bucket, Key))
+        if stored is None:
+            raise _error('404', 'HeadObject', 404)
+        return {'ContentLength': len(stored[0]),
+                'Metadata': dict(stored[1])}
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self._before_call('CopyObject', Key)
+        self._sleep()
+        with self._lock:
+            source = (CopySource['Bucket'], CopySource['Key'])
+            if source not in self._objects:
+                raise _error('NoSuchKey', 'CopyObject', 404)
+            self._objects[(Bucket, Key)] = self._objects[source]
+        return {}
+
+    def delete_object(self, Bucket, Key):
+        self._before_call('DeleteObject', Key)
+        self._sleep()
+        with self._lock:
+            self._objects.pop((Bucket, Key), None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None,
+                        ContinuationToken=None, MaxKeys=1000):
+        self._before_call('ListObjectsV2', Prefix)
+        self._sleep()
+        with self._lock:
+            keys = sorted(k for b, k in self._objects
+                          if b == Bucket and k.startswith(Prefix))
+        if Delimiter is not None:
+            keys = [k for k in keys if Delimiter not in k[len(Prefix):]]
+        if ContinuationToken is not None:
+            keys = [k for k in keys if k > ContinuationToken]
+        page = keys[:MaxKeys]
+        response = {'Contents': [{'Key': k} for k in page],
+                    'IsTruncated': len(keys) > MaxKeys}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page[-1]
+        return response
+
+    def object_count(self):
+        with self._lock:
+            return len(self._objects)
+
+    def _before_call(self, operation, key):
+        with self._lock:
+            self.calls[operation] += 1
+        if self._is_throttled(key):
+            self.errors['SlowDown'] += 1
+            raise _error('SlowDown', operation, 503)
+        if self.error_rate and self._rng.random() < self.error_rate:
+            self.errors['InternalError'] += 1
+            raise _error('InternalError', operation, 500)
+
+    def _is_throttled(self, key):
+        if not self.prefix_rps:
+            return False
+        prefix = key.rsplit('/', 1)[0] if '/' in key else ''
+        now = time.monotonic()
+        with self._lock:
+            start, count = self._prefix_windows.get(prefix, (now, 0))
+            if now - start >= 1:
+                start, count = now, 0
+            count += 1
+            self._prefix_windows[prefix] = (start, count)
+        return count > self.prefix_rps
+
+    def _sleep(self, size=0):
+        delay = self.latency.sample(size)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _error(code, operation, status_code):
+    return ClientError({
+        'Error': {'Code': code, 'Message': code},
+        'ResponseMetadata': {'HTTPStatusCode': status_code},
+    }, operation)
@@ -0,0 +1,92 @@
+"""Compare the serializers available for documents and cache values.
+
+Documents are generated the same way as the load test's, so they
+have a realistic mix of sizes::
+
+    python -m loadtest.serializers --documents 500
+
+Serializers whose dependency isn't installed are skipped.
+"""
+import time
+import random
+import argparse
+
+from chalicelib.serializers import SERIALIZERS, TaggedSerializer
+from loadtest.traffic import TrafficMix
+
+
+def available_serializers(names=None):
+    serializers = []
+    for name in names or sorted(SERIALIZERS):
+        try:
+            serializers.append(SERIALIZERS[name]())
+        except ImportError:
+            continue
+    return serializers
+
+
+def benchmark(documents, serializers, repeat=3):
+    """Times serializing and deserializing every document.
+
+    Returns a dict per serializer with the total encoded size and the
+    best of ``repeat`` times (in seconds) for dumps, loads and
+    ``to_json``, which is what serving a cached value from the raw
+    path costs (free for JSON formats).
+    """
+    results = []
+    for serializer in serializers:
+        tagged = TaggedSerializer(serializer)
+        encoded = [tagged.dumps(document) for document in documents]
+        results.append({
+            'name': serializer.name,
+            'size': sum(len(e) for e in encoded),
+            'dumps': _best_of(repeat, tagged.dumps, documents),
+            'loads': _best_of(repeat, tagged.loads, encoded),
+            'to_json': _best_of(repeat, tagged.loads_json, encoded),
+        })
+    return results
+
+
+def _best_of(repeat, func, values):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for value in values:
+            func(value)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def format_results(results, count):
+    lines = ['%-10s %10s %12s %12s %12s' % (
+        'format', 'KiB', 'dumps us', 'loads us', 'to_json us')]
+    for result in results:
+        lines.append('%-10s %10.1f %12.1f %12.1f %12.1f' % (
+            result['name'], result['size'] / 1024.0,
+            result['dumps'] / count * 1e6, result['loads'] / count * 1e6,
+            result['to_json'] / count * 1e6))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--documents', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--median-doc-size', type=int, default=2048)
+    parser.add_argument('--random-seed', type=int, default=0)
+    parser.add_argument('serializers', nargs='*',
+                        help='Serializers to compare (default all).')
+    args = parser.parse_args()
+    traffic = TrafficMix(median_doc_size=args.median_doc_size,
+                         rng=random.Random(args.random_seed))
+    documents = [traffic.document() for _ in range(args.documents)]
+    results = benchmark(documents, available_serializers(args.serializers),
+                        repeat=args.repeat)
+    print('Per document averages over %s documents:' % len(documents))
+    print(format_results(results, len(documents)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import bisect
+import random
+
+
+QUERIES = [
+    'foo.bar',
+    'people[?age > `20`].name',
+    'sort_by(people, &age)[-1].name',
+    'locations[?state == \'WA\'].name | sort(@) | join(\', \', @)',
+    'reservations[].instances[].[tags[?Key==\'Name\'].Values[0], state.name]',
+    'max_by(people, &age).name',
+    '{names: people[].name, count: length(people)}',
+    'length(people[?contains(name, \'a\')])',
+]
+NAMES = ['alice', 'bob', 'carol', 'dave', 'erin', 'frank', 'grace']
+STATES = ['WA', 'OR', 'CA', 'NY', 'TX']
+
+
+class ZipfSampler:
+    """Samples indices where index k has weight 1 / (k + 1) ** s.
+
+    Index 0 is the most popular.  ``grow()`` adds new, least popular
+    indices as documents are created during a run.
+    """
+
+    def __init__(self, s=1.1, rng=None):
+        self.s = s
+        if rng is None:
+            rng = random.Random()
+        self._rng = rng
+        self._cumulative = []
+
+    def __len__(self):
+        return len(self._cumulative)
+
+    def grow(self, count=1):
+        total = self._cumulative[-1] if self._cumulative else 0.0
+        for _ in range(count):
+            total += 1.0 / (len(self._cumulative) + 1) ** self.s
+            self._cumulative.append(total)
+
+    def sample(self):
+        point = self._rng.random() * self._cumulative[-1]
+        return bisect.bisect_left(self._cumulative, point)
+
+
+class TrafficMix:
+    """Generates the sequence of operations for a run.
+
+    Operations are reads with probability ``read_ratio`` and writes
+    otherwise, and every ``burst_every`` operations a burst of
+    ``burst_size`` writes is inserted.  Reads are yielded as
+    ``('get', None)`` since which document is read is decided when it
+    runs (see ``ZipfSampler``); writes are ``('post', document)``.
+    """
+
+    def __init__(self, read_ratio=0.9, burst_every=500, burst_size=50,
+                 median_doc_size=2048, max_doc_size=100 * 1024, rng=None):
+        self.read_ratio = read_ratio
+        self.burst_every = burst_every
+        self.burst_size = burst_size
+        self.median_doc_size = median_doc_size
+        self.max_doc_size = max_doc_size
+        if rng is None:
+            rng = random.Random()
+        self._rng = rng
+
+    def operations(self, count):
+        emitted = 0
+        while emitted < count:
+            if self.burst_every and emitted and \
+                    emitted % self.burst_every == 0:
+                for _ in range(min(self.burst_size, count - emitted)):
+                    yield ('post', self.document())
+                    emitted += 1
+                if emitted >= count:
+                    break
+            if self._rng.random() < self.read_ratio:
+                yield ('get', None)
+            else:
+                yield ('post', self.document())
+            emitted += 1
+
+    def document(self):
+        # Document sizes are roughly log-normal, like real shares where
+        # most inputs are small but a few are pasted API responses.
+        size = min(int(self._rng.lognormvariate(0, 1) *
+                       self.median_doc_size), self.max_doc_size)
+        people = []
+        estimated = 0
+        while estimated < size:
+            person = {
+                'name': self._rng.choice(NAMES),
+                'age': self._rng.randint(18, 80),
+                'state': self._rng.choice(STATES),
+                'tags': [{'Key': 'Name', 'Values': ['v%s' % i]}
+                         for i in range(self._rng.randint(0, 3))],
+            }
+            people.append(person)
+            estimated += 60 + 30 * len(person['tags'])
+        return {'query': self._rng.choice(QUERIES),
+                'data': {'people': people}}
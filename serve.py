@@ -0,0 +1,121 @@
+"""Serve the playground backend from a local WSGI server.
+
+Unlike ``chalice local``, GET /anon/{uuid} responses are streamed
+from the cache or S3 in chunks instead of being buffered in full, and
+POST /anon/{uuid}/eval reads its input and writes its results as it
+goes.  The same environment variables used in lambda (APP_S3_BUCKET,
+etc.) configure the app.
+
+With ``--workers`` the app is initialized once and then forked into
+several worker processes which all accept connections on the same
+socket, so throughput scales with the number of cores.
+"""
+import os
+import sys
+import signal
+import argparse
+import traceback
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, make_server
+
+import app
+from chalicelib.wsgi import WSGIAdapter
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+def create_wsgi_app():
+    return WSGIAdapter(app.app, streaming_routes={
+        '/anon/{uuid}': app.stream_anonymous_query,
+    }, streaming_uploads={
+        '/anon/{uuid}/eval': app.stream_evaluate_saved_query,
+    })
+
+
+def serve_forked(server, workers):
+    # Everything expensive to set up (imports, botocore's service
+    # models, the cache's index) is done once here and shared with
+    # the workers copy-on-write.  Workers that exit are replaced until
+    # we're asked to stop.
+    app.before_request(app.app)
+    children = set()
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while True:
+        while not stopping and len(children) < workers:
+            children.add(_fork_worker(server))
+        if not children:
+            break
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+    server.server_close()
+
+
+def _fork_worker(server):
+    pid = os.fork()
+    if pid:
+        return pid
+    # Stopping raises SystemExit out of serve_forever() so the worker
+    # can clean up before it exits.
+    signal.signal(signal.SIGTERM, _exit)
+    signal.signal(signal.SIGINT, _exit)
+    status = 1
+    try:
+        app.after_fork()
+        server.serve_forever()
+        status = 0
+    except SystemExit:
+        status = 0
+    except Exception:
+        traceback.print_exc()
+    finally:
+        try:
+            app.before_exit()
+        finally:
+            # Never return into the parent's loop.
+            os._exit(status)
+
+
+def _exit(signum, frame):
+    sys.exit(0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes, 0 for one '
+                             'per CPU.')
+    args = parser.parse_args()
+    workers = args.workers or os.cpu_count() or 1
+    if workers > 1:
+        # The workers share the cache dir.
+        os.environ['APP_CACHE_SHARED'] = 'true'
+    server = make_server(args.host, args.port, create_wsgi_app(),
+                         server_class=ThreadingWSGIServer)
+    print("Serving on http://%s:%s with %s worker(s)" % (
+        args.host, args.port, workers))
+    if workers == 1:
+        # SIGTERM's default action would skip the atexit handlers that
+        # write out the cache.
+        signal.signal(signal.SIGTERM, _exit)
+        server.serve_forever()
+    else:
+        serve_forked(server, workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,15 @@
-from chalicelib.storage import SemiDBMCache
+import os
+import sys
+import json
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from chalicelib.storage import SemiDBMCache, SharedSemiDBMCache
+from chalicelib.storage import S3Storage, CachingStorage, Config
+from chalicelib.serializers import get_serializer
+from chalicelib.publish import Publisher
+from tests.unit.test_storage import FakeS3Client
 
 
 def test_can_cache_through_semidbm(tmpdir):
@@ -17,6 +28,94 @@ def test_check_frequency_noop_when_below_size_threshold(tmpdir):
         assert db[str(i)] == {'count': i}
 
 
+def test_contains(tmpdir):
+    db = SemiDBMCache(str(tmpdir))
+    db['foo'] = {'count': 1}
+    assert 'foo' in db
+    assert 'bar' not in db
+
+
+def test_cached_data_not_uploaded_again(tmpdir):
+    client = FakeS3Client()
+    config = Config(bucket='bucket', dedupe_data=True, dedupe_min_size=10)
+    storage = S3Storage(client, config, chunk_cache=SemiDBMCache(str(tmpdir)))
+    data = {'query': 'foo', 'data': {'foo': 'x' * 100}}
+    storage.put(data)
+    client.calls = []
+    storage.put(dict(data, query='bar'))
+    # Known to be stored from the cache, without a HEAD request.
+    assert not [c for c in client.calls if c[0] == 'head_object']
+
+
+def test_published_shares_remembered(tmpdir):
+    client = FakeS3Client()
+    cache = SemiDBMCache(str(tmpdir))
+    cache['uuid'] = {'query': 'foo', 'data': 'bar'}
+    storage = CachingStorage(
+        S3Storage(client, Config(bucket='bucket')), cache,
+        publisher=Publisher(client, 'bucket', 'public', threshold=1))
+    storage.get('uuid')
+    client.calls = []
+    storage.get('uuid')
+    assert client.calls == []
+
+
+def test_concurrent_raw_writes_and_reads(tmpdir):
+    # Chunks are cached from several threads at once.
+    db = SemiDBMCache(str(tmpdir))
+    values = {}
+    for i in range(200):
+        value = b'"%s"' % (b'%d' % i * 5000)
+        values[hashlib.sha256(value).hexdigest()] = value
+
+    def write_and_read(key):
+        db.set_raw(key, values[key])
+        return db.get_raw(key)
+
+    # Switching threads as often as possible makes interleaving likely.
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(write_and_read, values))
+    finally:
+        sys.setswitchinterval(interval)
+    assert results == list(values.values())
+    for key, value in values.items():
+        assert db.get_raw(key) == value
+
+
+def test_can_get_and_set_raw_values(tmpdir):
+    db = SemiDBMCache(str(tmpdir))
+    db['foo'] = {'count': 1}
+    assert json.loads(db.get_raw('foo')) == {'count': 1}
+    db.set_raw('bar', b'{"count":2}')
+    assert db['bar'] == {'count': 2}
+    assert db.get_raw('missing') is None
+
+
+def test_can_change_format_of_existing_cache(tmpdir):
+    db = SemiDBMCache(str(tmpdir), serializer=get_serializer('json'))
+    db['foo'] = {'count': 1}
+    db.set_raw('bar', b'{"count":2}')
+    db = SemiDBMCache(str(tmpdir), serializer=get_serializer('msgpack'))
+    db['baz'] = {'count': 3}
+    assert db['foo'] == {'count': 1}
+    assert db['bar'] == {'count': 2}
+    assert db['baz'] == {'count': 3}
+    assert json.loads(db.get_raw('baz')) == {'count': 3}
+
+
+def test_large_items_not_cached(tmpdir):
+    db = SemiDBMCache(str(tmpdir), max_item_size=20)
+    db['small'] = {'count': 1}
+    db['large'] = {'count': 'a' * 20}
+    db.set_raw('large-raw', b'a' * 21)
+    assert b'small' in db
+    assert b'large' not in db
+    assert b'large-raw' not in db
+
+
 def test_cache_noop_when_max_size_reached(tmpdir):
     db = SemiDBMCache(str(tmpdir), check_frequency=1, max_filesize=100)
     for i in range(20):
@@ -25,3 +124,185 @@ def test_cache_noop_when_max_size_reached(tmpdir):
     # We've exhausted the max_filesize so any setitems will be noops.
     db[b'100'] = {'count': 100}
     assert b'100' not in db
+
+
+def test_reopens_from_index_snapshot(tmpdir):
+    db = SemiDBMCache(str(tmpdir))
+    for i in range(20):
+        db[str(i)] = {'count': i}
+    db.close()
+    db = SemiDBMCache(str(tmpdir))
+    assert db.open_stats['snapshot']
+    assert db.open_stats['keys'] == 20
+    assert db.open_stats['scanned_bytes'] == 0
+    for i in range(20):
+        assert db[str(i)] == {'count': i}
+
+
+def test_scans_records_written_after_snapshot(tmpdir):
+    db = SemiDBMCache(str(tmpdir))
+    db['before'] = {'count': 1}
+    db['updated'] = {'count': 1}
+    db.snapshot()
+    db['after'] = {'count': 2}
+    db['updated'] = {'count': 2}
+    db._db.sync()
+    db = SemiDBMCache(str(tmpdir))
+    assert db.open_stats['snapshot']
+    assert db.open_stats['scanned_bytes'] > 0
+    assert db['before'] == {'count': 1}
+    assert db['after'] == {'count': 2}
+    assert db['updated'] == {'count': 2}
+
+
+def test_corrupt_snapshot_falls_back_to_scan(tmpdir):
+    db = SemiDBMCache(str(tmpdir))
+    db['foo'] = {'count': 1}
+    db.close()
+    snapshot = tmpdir.join('index-snapshot')
+    contents = snapshot.read_binary()
+    snapshot.write_binary(contents[:-1] + bytes([contents[-1] ^ 1]))
+    db = SemiDBMCache(str(tmpdir))
+    assert not db.open_stats['snapshot']
+    assert db['foo'] == {'count': 1}
+
+
+def test_stale_snapshot_falls_back_to_scan(tmpdir):
+    db = SemiDBMCache(str(tmpdir))
+    db['foo'] = {'count': 1}
+    db.close()
+    # A new data file, e.g after the cache dir was cleared, with the
+    # old snapshot still around.
+    snapshot = tmpdir.join('index-snapshot').read_binary()
+    tmpdir.join('data').remove()
+    db = SemiDBMCache(str(tmpdir))
+    db['bar'] = {'count': 2}
+    db._db.sync()
+    tmpdir.join('index-snapshot').write_binary(snapshot)
+    db = SemiDBMCache(str(tmpdir))
+    assert not db.open_stats['snapshot']
+    assert db.get('foo') is None
+    assert db['bar'] == {'count': 2}
+
+
+def test_shared_cache_sees_writes_from_other_handles(tmpdir):
+    first = SharedSemiDBMCache(str(tmpdir))
+    second = SharedSemiDBMCache(str(tmpdir))
+    first['foo'] = {'count': 1}
+    assert second['foo'] == {'count': 1}
+    # Interleaved writes must not corrupt either handle's offsets.
+    for i in range(10):
+        first['first-%s' % i] = {'count': i}
+        second['second-%s' % i] = {'count': i}
+    assert first['second-9'] == {'count': 9}
+    assert second.get_raw('first-9') == b'{"count":9}'
+    reopened = SemiDBMCache(str(tmpdir))
+    for i in range(10):
+        assert reopened['first-%s' % i] == {'count': i}
+        assert reopened['second-%s' % i] == {'count': i}
+
+
+def test_shared_cache_set_many(tmpdir):
+    first = SharedSemiDBMCache(str(tmpdir))
+    second = SharedSemiDBMCache(str(tmpdir))
+    second['before'] = {'count': 0}
+    first.set_many([('foo', {'count': 1}), ('bar', {'count': 2})])
+    assert second['bar'] == {'count': 2}
+    assert first['before'] == {'count': 0}
+
+
+def test_shared_cache_across_forked_processes(tmpdir):
+    db = SharedSemiDBMCache(str(tmpdir))
+    db['parent'] = {'count': 0}
+    pids = []
+    for worker in range(2):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                db.after_fork()
+                for i in range(20):
+                    db['%s-%s' % (worker, i)] = {'count': i}
+                if db['parent'] == {'count': 0}:
+                    status = 0
+            finally:
+                os._exit(status)
+        pids.append(pid)
+    for pid in pids:
+        assert os.waitpid(pid, 0)[1] == 0
+    for worker in range(2):
+        for i in range(20):
+            assert db['%s-%s' % (worker, i)] == {'count': i}
+
+
+def test_buffered_writes_readable_before_flush(tmpdir):
+    db = SemiDBMCache(str(tmpdir), write_buffer_size=1024 * 1024,
+                      write_buffer_interval=60)
+    db['foo'] = {'count': 1}
+    db.set_raw('bar', b'{"count":2}')
+    assert db['foo'] == {'count': 1}
+    assert db.get_raw('bar') == b'{"count":2}'
+    assert 'foo' in db
+    assert b'foo' not in db._db
+    db.close()
+    db = SemiDBMCache(str(tmpdir))
+    assert db['foo'] == {'count': 1}
+    assert db['bar'] == {'count': 2}
+
+
+def test_buffered_writes_flushed_by_size(tmpdir):
+    db = SemiDBMCache(str(tmpdir), write_buffer_size=100,
+                      write_buffer_interval=60)
+    for i in range(10):
+        db['key-%s' % i] = {'value': 'x' * 20}
+    # Written out in batches, each as a single append.
+    assert b'key-0' in db._db
+    assert len(db._pending) < 10
+    db.flush()
+    assert db._db._current_offset == os.path.getsize(str(tmpdir.join('data')))
+    reopened = SemiDBMCache(str(tmpdir))
+    for i in range(10):
+        assert reopened['key-%s' % i] == {'value': 'x' * 20}
+
+
+def test_buffered_writes_flushed_by_age(tmpdir):
+    db = SemiDBMCache(str(tmpdir), write_buffer_size=1024 * 1024,
+                      write_buffer_interval=0)
+    db['foo'] = {'count': 1}
+    assert b'foo' in db._db
+
+
+def test_buffered_writes_flushed_by_timer(tmpdir):
+    db = SemiDBMCache(str(tmpdir), write_buffer_size=1024 * 1024,
+                      write_buffer_interval=0.05)
+    db['foo'] = {'count': 1}
+    assert b'foo' not in db._db
+    deadline = time.monotonic() + 5
+    while b'foo' not in db._db and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert b'foo' in db._db
+    assert not db._pending
+
+
+def test_buffered_writes_stop_at_max_size(tmpdir):
+    db = SemiDBMCache(str(tmpdir), max_filesize=100, write_buffer_size=50)
+    db['foo'] = {'value': 'x' * 100}
+    db['bar'] = {'value': 'x' * 100}
+    assert 'foo' in db
+    assert 'bar' not in db
+
+
+def test_shared_cache_buffered_writes(tmpdir):
+    first = SharedSemiDBMCache(str(tmpdir), write_buffer_size=1024 * 1024,
+                               write_buffer_interval=60)
+    second = SharedSemiDBMCache(str(tmpdir))
+    first.set_many([('foo', {'count': 1}), ('bar', {'count': 2})])
+    second['before'] = {'count': 0}
+    assert second.get('foo') is None
+    first.flush()
+    assert second['bar'] == {'count': 2}
+    assert first['before'] == {'count': 0}
+    second['after'] = {'count': 3}
+    reopened = SemiDBMCache(str(tmpdir))
+    assert reopened['foo'] == {'count': 1}
+    assert reopened['after'] == {'count': 3}
@@ -0,0 +1,356 @@
+import json
+from unittest import mock
+from io import BytesIO
+from wsgiref.util import setup_testing_defaults
+
+from pytest import fixture
+
+import app
+from chalicelib.listings import Listings
+from chalicelib.metrics import Metrics
+from chalicelib.ratelimit import Budget, RateLimiter
+from chalicelib.search import SearchIndex, S3SegmentStore
+from chalicelib.evaluate import EvaluationPool
+from chalicelib.storage import CachingStorage, Config, S3Storage
+from chalicelib.storage import CircuitBreakingStorage
+from chalicelib.wsgi import WSGIAdapter
+from tests.unit.test_storage import FakeRawCache, FakeS3Client
+
+
+@fixture
+def s3_client():
+    return FakeS3Client()
+
+
+@fixture
+def client(s3_client):
+    metrics = Metrics()
+    storage = S3Storage(s3_client, Config(bucket='bucket', prefix='test'),
+                        metrics=metrics)
+    listings = Listings(storage)
+    evaluator = EvaluationPool(workers=1, cache=FakeRawCache())
+    app.app.context = {
+        'evaluator': evaluator,
+        'metrics': metrics,
+        'listings': listings,
+        'search': SearchIndex(S3SegmentStore(s3_client, 'bucket', 'test')),
+        'storage': CachingStorage(storage, FakeRawCache(),
+                                  listings=listings),
+        'rate_limiter': RateLimiter({
+            'read': Budget(1, 5), 'write': Budget(1, 5),
+            'bytes': Budget(1000, 1000)}),
+    }
+    yield WSGIAdapter(app.app, streaming_routes={
+        '/anon/{uuid}': app.stream_anonymous_query,
+    }, streaming_uploads={
+        '/anon/{uuid}/eval': app.stream_evaluate_saved_query,
+    })
+    evaluator.stop()
+    app.app.context = {}
+
+
+def request(wsgi_app, path, method='GET', body=None, query='',
+            content_type='application/json'):
+    if body is not None and not isinstance(body, bytes):
+        body = json.dumps(body).encode('utf-8')
+    body = body or b''
+    environ = {}
+    setup_testing_defaults(environ)
+    environ.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'CONTENT_LENGTH': str(len(body)),
+        'CONTENT_TYPE': content_type,
+        'wsgi.input': BytesIO(body),
+    })
+    response = {}
+
+    def start_response(status, headers):
+        response['status'] = int(status.split()[0])
+        response['headers'] = dict(headers)
+
+    contents = b''.join(wsgi_app(environ, start_response))
+    if response['headers'].get('Content-Type') == 'application/x-ndjson':
+        return response['status'], response['headers'], [
+            json.loads(line) for line in contents.splitlines()]
+    return response['status'], response['headers'], json.loads(contents)
+
+
+def test_can_save_and_retrieve_query(client):
+    doc = {'query': 'foo', 'data': {'foo': 'bar'}}
+    status, _, body = request(client, '/anon', method='POST', body=doc)
+    assert status == 200
+    status, _, retrieved = request(client, '/anon/%s' % body['uuid'])
+    assert status == 200
+    assert retrieved == doc
+
+
+def test_buffered_get_returns_stored_json(client):
+    doc = {'query': 'foo', 'data': {'foo': 'bar'}}
+    _, _, body = request(client, '/anon', method='POST', body=doc)
+    # Without the streaming route, requests go through chalice.
+    buffered = WSGIAdapter(app.app)
+    status, headers, retrieved = request(buffered,
+                                         '/anon/%s' % body['uuid'])
+    assert status == 200
+    assert headers['Content-Type'] == 'application/json'
+    assert retrieved == doc
+
+
+def test_can_request_specific_fields(client):
+    doc = {'query': 'foo', 'data': {'foo': 'bar'}}
+    _, _, body = request(client, '/anon', method='POST', body=doc)
+    status, _, retrieved = request(client, '/anon/%s' % body['uuid'],
+                                   query='fields=query')
+    assert status == 200
+    assert retrieved == {'query': 'foo'}
+
+
+def test_deeply_nested_query_rejected(client):
+    data = {}
+    for _ in range(120):
+        data = {'a': data}
+    status, _, body = request(client, '/anon', method='POST',
+                              body={'query': 'foo', 'data': data})
+    assert status == 400
+    assert 'levels deep' in body['Message']
+    assert app.app.context['metrics'].counter('limits.depth') == 1
+
+
+def test_query_with_many_tiny_values_rejected(client):
+    data = [{}] * 20000
+    status, _, body = request(client, '/anon', method='POST',
+                              body={'query': 'foo', 'data': data})
+    assert status == 400
+    assert app.app.context['metrics'].counter('limits.nodes') == 1
+
+
+def test_invalid_query_rejected(client):
+    status, _, _ = request(client, '/anon', method='POST',
+                           body={'query': 'foo'})
+    assert status == 400
+
+
+def test_reads_are_rate_limited(client):
+    doc = {'query': 'foo', 'data': {'foo': 'bar'}}
+    _, _, body = request(client, '/anon', method='POST', body=doc)
+    buffered = WSGIAdapter(app.app)
+    path = '/anon/%s' % body['uuid']
+    statuses = [request(buffered, path)[0] for _ in range(6)]
+    assert statuses == [200] * 5 + [429]
+    _, headers, error = request(buffered, path)
+    assert int(headers['Retry-After']) >= 1
+    assert error['Code'] == 'TooManyRequestsError'
+    assert app.app.context['metrics'].counter('ratelimit.read') == 2
+
+
+def test_streamed_reads_are_rate_limited(client):
+    doc = {'query': 'foo', 'data': {'foo': 'bar'}}
+    _, _, body = request(client, '/anon', method='POST', body=doc)
+    path = '/anon/%s' % body['uuid']
+    statuses = [request(client, path)[0] for _ in range(6)]
+    assert statuses == [200] * 5 + [429]
+
+
+def test_clients_identified_by_validated_api_key():
+    first = app._get_client_id({'sourceIp': '1.2.3.4', 'apiKey': 'a'})
+    second = app._get_client_id({'sourceIp': '1.2.3.4', 'apiKey': 'b'})
+    assert first.startswith('key:')
+    assert first != second
+    assert app._get_client_id({'sourceIp': '1.2.3.4'}) == 'ip:1.2.3.4'
+
+
+def test_bytes_written_are_rate_limited(client):
+    doc = {'query': 'foo', 'data': 'a' * 600}
+    status, _, _ = request(client, '/anon', method='POST', body=doc)
+    assert status == 200
+    status, _, _ = request(client, '/anon', method='POST', body=doc)
+    assert status == 429
+
+
+def test_rejected_writes_keep_their_write_tokens(client):
+    doc = {'query': 'foo', 'data': 'a' * 600}
+    status, _, _ = request(client, '/anon', method='POST', body=doc)
+    assert status == 200
+    # Rejected for bytes, which would otherwise use the 4 writes left.
+    for _ in range(4):
+        status, _, _ = request(client, '/anon', method='POST', body=doc)
+        assert status == 429
+    status, _, _ = request(client, '/anon', method='POST',
+                           body={'query': 'foo', 'data': {}})
+    assert status == 200
+
+
+def test_ping(client):
+    status, _, body = request(client, '/ping')
+    assert status == 200
+    assert body['ping'] == 11
+
+
+def test_can_list_recent_and_popular_queries(client):
+    uuids = []
+    for query in ('foo', 'bar'):
+        _, _, body = request(client, '/anon', method='POST',
+                             body={'query': query, 'data': {}})
+        uuids.append(body['uuid'])
+    request(client, '/anon/%s' % uuids[0])
+    status, _, recent = request(client, '/anon/recent', query='limit=1')
+    assert status == 200
+    assert [q['query'] for q in recent['queries']] == ['bar']
+    status, _, popular = request(client, '/anon/popular')
+    assert status == 200
+    assert [q['uuid'] for q in popular['queries']] == [uuids[0]]
+
+
+def test_can_get_paths(client):
+    doc = {'query': 'foo', 'data': {'foo': [{'bar': 1}]}}
+    _, _, body = request(client, '/anon', method='POST', body=doc)
+    status, _, paths = request(client, '/anon/%s/paths' % body['uuid'])
+    assert status == 200
+    assert [p['path'] for p in paths['paths']] == [
+        '@', 'foo', 'foo[*]', 'foo[*].bar']
+    assert not paths['truncated']
+
+
+def test_unavailable_while_circuit_open(client, s3_client):
+    breaker_storage = CircuitBreakingStorage(
+        S3Storage(s3_client, Config(bucket='bucket', prefix='test')))
+    app.app.context['breaker'] = breaker_storage.breaker
+    app.app.context['storage'] = CachingStorage(breaker_storage,
+                                                FakeRawCache())
+    _, _, body = request(client, '/anon', method='POST',
+                         body={'query': 'foo', 'data': {}})
+    _, _, ping = request(client, '/ping')
+    assert ping['storage'] == 'closed'
+    breaker_storage.breaker._open(breaker_storage.breaker._clock())
+    # Cached shares are still served.
+    status, _, _ = request(client, '/anon/%s' % body['uuid'])
+    assert status == 200
+    status, headers, _ = request(client, '/anon', method='POST',
+                                 body={'query': 'foo', 'data': {}})
+    assert status == 503
+    assert int(headers['Retry-After']) > 0
+    _, _, ping = request(client, '/ping')
+    assert ping['storage'] == 'open'
+
+
+def test_can_search_queries(client):
+    uuids = []
+    for query in ('sort_by(@, &name)', 'foo.bar'):
+        _, _, body = request(client, '/anon', method='POST',
+                             body={'query': query, 'data': {}})
+        uuids.append(body['uuid'])
+    status, _, found = request(client, '/search', query='q=sort_by')
+    assert status == 200
+    assert [r['uuid'] for r in found['results']] == [uuids[0]]
+    status, _, _ = request(client, '/search')
+    assert status == 400
+
+
+def test_can_save_batch_of_queries(client):
+    queries = [{'query': 'foo', 'data': {'foo': 1}},
+               {'query': 'bar'},
+               'baz',
+               {'query': 'sort_by(@, &a)', 'data': []}]
+    status, _, body = request(client, '/anon/batch', method='POST',
+                              body={'queries': queries})
+    assert status == 200
+    results = body['results']
+    assert results[1] == {'error': {'data': [
+        'Missing data for required field.']}}
+    assert results[2] == {'error': 'Query must be an object.'}
+    _, _, retrieved = request(client, '/anon/%s' % results[0]['uuid'])
+    assert retrieved == queries[0]
+    _, _, found = request(client, '/search', query='q=sort_by')
+    assert [r['uuid'] for r in found['results']] == [results[3]['uuid']]
+
+
+def test_batch_costs_a_write_per_query(client):
+    queries = [{'query': 'foo', 'data': {}}] * 3
+    status, _, _ = request(client, '/anon/batch', method='POST',
+                           body={'queries': queries})
+    assert status == 200
+    status, _, _ = request(client, '/anon/batch', method='POST',
+                           body={'queries': queries})
+    assert status == 429
+    # Larger than the whole budget, but allowed with a full bucket,
+    # after which the client waits for the 4 writes over budget too.
+    app.app.context['rate_limiter'] = RateLimiter({'write': Budget(1, 5)})
+    status, _, body = request(client, '/anon/batch', method='POST',
+                              body={'queries': queries * 3})
+    assert status == 200
+    assert len(body['results']) == 9
+    status, headers, _ = request(client, '/anon', method='POST',
+                                 body=queries[0])
+    assert status == 429
+    assert headers['Retry-After'] == '5'
+
+
+def test_batch_cost_counts_parsed_queries(client):
+    app.app.context['rate_limiter'] = RateLimiter({'write': Budget(1, 5)})
+    # Escaped keys are still queries.
+    batch = b'{"queries": [%s]}' % b','.join(
+        [b'{"\\u0071uery": "foo", "data": {}}'] * 50)
+    status, _, body = request(client, '/anon/batch', method='POST',
+                              body=batch)
+    assert status == 200
+    assert len(body['results']) == 50
+    status, _, _ = request(client, '/anon/batch', method='POST',
+                           body=batch)
+    assert status == 429
+
+
+def test_batch_must_be_list_of_queries(client):
+    status, _, _ = request(client, '/anon/batch', method='POST',
+                           body={'queries': 'foo'})
+    assert status == 400
+
+
+def test_can_evaluate_query(client):
+    status, _, body = request(client, '/eval', method='POST', body={
+        'query': 'foo[*].bar', 'data': {'foo': [{'bar': 1}, {'bar': 2}]}})
+    assert status == 200
+    assert body == {'result': [1, 2]}
+    status, _, body = request(client, '/eval', method='POST',
+                              body={'query': 'foo[', 'data': {}})
+    assert status == 400
+
+
+def test_can_evaluate_saved_query_over_documents(client):
+    _, _, saved = request(client, '/anon', method='POST',
+                          body={'query': 'a', 'data': {}})
+    lines = b'{"a": 1}\n\n{"a": 2}\nnot json\n{"b": 3}\n'
+    path = '/anon/%s/eval' % saved['uuid']
+    expected = [{'result': 1}, {'result': 2}, {'error': mock.ANY},
+                {'result': None}]
+    # Streamed by the WSGI adapter, and buffered through chalice.
+    for wsgi_app in (client, WSGIAdapter(app.app)):
+        status, headers, outcomes = request(
+            wsgi_app, path, method='POST', body=lines,
+            content_type='application/x-ndjson')
+        assert status == 200
+        assert outcomes == expected
+
+
+def test_streamed_evaluation_is_throttled(client):
+    _, _, saved = request(client, '/anon', method='POST',
+                          body={'query': 'a', 'data': {}})
+    app.app.context['rate_limiter'] = RateLimiter({'eval': Budget(20, 2)})
+    status, _, outcomes = request(
+        client, '/anon/%s/eval' % saved['uuid'], method='POST',
+        body=b'{"a": 1}\n{"a": 2}\n{"a": 3}\n{"a": 4}\n',
+        content_type='application/x-ndjson')
+    assert status == 200
+    assert outcomes == [{'result': i} for i in range(1, 5)]
+    metrics = app.app.context['metrics']
+    assert metrics.counter('ratelimit.eval.throttled') >= 1
+
+
+def test_evaluate_invalid_saved_query(client):
+    _, _, saved = request(client, '/anon', method='POST',
+                          body={'query': 'a[', 'data': {}})
+    status, _, _ = request(client, '/anon/%s/eval' % saved['uuid'],
+                           method='POST', body=b'{}\n',
+                           content_type='application/x-ndjson')
+    assert status == 400
@@ -0,0 +1,125 @@
+from pytest import fixture, raises
+
+from chalicelib.breaker import CircuitBreaker, CircuitOpenError
+from chalicelib.breaker import CLOSED, OPEN, HALF_OPEN
+from chalicelib.metrics import Metrics
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Unhealthy(Exception):
+    pass
+
+
+@fixture
+def clock():
+    return FakeClock()
+
+
+def create_breaker(clock, **kwargs):
+    kwargs.setdefault('min_calls', 4)
+    return CircuitBreaker(
+        clock=clock, open_duration=10, window=30,
+        is_failure=lambda e: isinstance(e, Unhealthy), **kwargs)
+
+
+def fail():
+    raise Unhealthy()
+
+
+def succeed():
+    return 'ok'
+
+
+def trip(breaker):
+    for _ in range(4):
+        with raises(Unhealthy):
+            breaker.call(fail)
+
+
+def test_opens_once_failure_rate_reached(clock):
+    metrics = Metrics()
+    breaker = create_breaker(clock, metrics=metrics)
+    breaker.call(succeed)
+    breaker.call(succeed)
+    with raises(Unhealthy):
+        breaker.call(fail)
+    assert breaker.state == CLOSED
+    with raises(Unhealthy):
+        breaker.call(fail)
+    assert breaker.state == OPEN
+    with raises(CircuitOpenError) as e:
+        breaker.call(succeed)
+    assert e.value.retry_after == 10
+    assert metrics.counter('breaker.opened') == 1
+    assert metrics.counter('breaker.rejected') == 1
+
+
+def test_other_errors_dont_count(clock):
+    breaker = create_breaker(clock)
+    for _ in range(10):
+        with raises(KeyError):
+            breaker.call({}.__getitem__, 'missing')
+    assert breaker.state == CLOSED
+
+
+def test_slow_calls_count_as_failures(clock):
+    breaker = create_breaker(clock, slow_call_duration=1)
+
+    def slow():
+        clock.now += 2
+    for _ in range(4):
+        breaker.call(slow)
+    assert breaker.state == OPEN
+
+
+def test_failures_counted_per_window(clock):
+    breaker = create_breaker(clock)
+    for _ in range(3):
+        with raises(Unhealthy):
+            breaker.call(fail)
+    clock.now += 31
+    breaker.call(succeed)
+    assert breaker.stats() == {'state': CLOSED, 'calls': 1, 'failures': 0}
+
+
+def test_successful_probe_closes(clock):
+    metrics = Metrics()
+    breaker = create_breaker(clock, metrics=metrics)
+    trip(breaker)
+    clock.now += 10
+    assert breaker.call(succeed) == 'ok'
+    assert breaker.state == CLOSED
+    assert metrics.counter('breaker.closed') == 1
+
+
+def test_failed_probe_reopens(clock):
+    breaker = create_breaker(clock)
+    trip(breaker)
+    clock.now += 10
+    with raises(Unhealthy):
+        breaker.call(fail)
+    assert breaker.state == OPEN
+    clock.now += 5
+    with raises(CircuitOpenError):
+        breaker.call(succeed)
+
+
+def test_one_probe_at_a_time(clock):
+    breaker = create_breaker(clock)
+    trip(breaker)
+    clock.now += 10
+
+    def probe():
+        assert breaker.state == HALF_OPEN
+        with raises(CircuitOpenError):
+            breaker.call(succeed)
+        return 'probed'
+    assert breaker.call(probe) == 'probed'
+    assert breaker.state == CLOSED
@@ -0,0 +1,167 @@
+import time
+from io import BytesIO
+
+from pytest import fixture, raises
+
+from chalicelib import evaluate
+from chalicelib.evaluate import EvaluationPool, EvaluationError
+from chalicelib.evaluate import LimitExceededError, PoolBusyError
+from chalicelib.evaluate import encode_document, iter_lines
+from chalicelib.metrics import Metrics
+from tests.unit.test_storage import FakeRawCache
+
+
+_evaluate = evaluate._evaluate
+
+
+@fixture
+def metrics():
+    return Metrics()
+
+
+@fixture
+def pool(metrics):
+    pool = EvaluationPool(workers=1, timeout=2, cache=FakeRawCache(),
+                          metrics=metrics)
+    yield pool
+    pool.stop()
+
+
+def test_can_evaluate_expression(pool):
+    assert pool.evaluate('foo.bar', {'foo': {'bar': 1}}) == 1
+    assert pool.evaluate('sort(@)', [3, 1, 2]) == [1, 2, 3]
+    assert pool.evaluate('missing', {}) is None
+
+
+def test_invalid_expression(pool):
+    with raises(EvaluationError):
+        pool.evaluate('foo[', {})
+    with raises(EvaluationError):
+        pool.evaluate('abs(foo)', {'foo': 'bar'})
+    # The worker is still usable.
+    assert pool.evaluate('foo', {'foo': 'bar'}) == 'bar'
+
+
+def test_outcomes_are_cached(pool, metrics):
+    assert pool.evaluate('a', {'a': 1, 'b': 2}) == 1
+    # Key order doesn't matter.
+    assert pool.evaluate('a', {'b': 2, 'a': 1}) == 1
+    assert metrics.counter('eval.cache.miss') == 1
+    assert metrics.counter('eval.cache.hit') == 1
+
+
+def test_evaluate_documents_in_order(pool):
+    documents = [encode_document({'a': i}) for i in range(5)]
+    outcomes = pool.evaluate_documents('a', documents + [b'not json'])
+    assert [o.get('result') for o in outcomes] == list(range(5)) + [None]
+    assert 'error' in outcomes[-1]
+
+
+def slow_evaluate(expression, documents):
+    if expression == 'slow':
+        time.sleep(10)
+    return _evaluate(expression, documents)
+
+
+def test_slow_job_is_killed(monkeypatch, metrics):
+    # Workers are forked, so they pick up the patched function.
+    monkeypatch.setattr(evaluate, '_evaluate', slow_evaluate)
+    pool = EvaluationPool(workers=1, timeout=0.2, metrics=metrics)
+    try:
+        start = time.monotonic()
+        with raises(LimitExceededError):
+            pool.evaluate('slow', {})
+        assert time.monotonic() - start < 2
+        assert metrics.counter('eval.limit_exceeded') == 1
+        # The killed worker was replaced.
+        assert pool.evaluate('foo', {'foo': 1}) == 1
+    finally:
+        pool.stop()
+
+
+def greedy_evaluate(expression, documents):
+    return [{'result': 'x' * (512 * 1024 * 1024)}]
+
+
+def test_memory_is_limited(monkeypatch):
+    monkeypatch.setattr(evaluate, '_evaluate', greedy_evaluate)
+    pool = EvaluationPool(workers=1, memory_limit=64 * 1024 * 1024)
+    try:
+        with raises(LimitExceededError):
+            pool.evaluate('foo', {})
+    finally:
+        pool.stop()
+
+
+def test_large_results_rejected(metrics):
+    cache = FakeRawCache()
+    pool = EvaluationPool(workers=1, max_result_size=100, cache=cache)
+    try:
+        assert pool.evaluate('[@, @]', 'x' * 40) == ['x' * 40] * 2
+        with raises(EvaluationError) as e:
+            pool.evaluate('[@, @, @]', 'x' * 40)
+        assert '100 bytes' in str(e.value)
+    finally:
+        pool.stop()
+    # Outcomes are cached as the worker encoded them.
+    assert b'{"error":"Result is larger than 100 bytes."}' in \
+        cache.state.values()
+
+
+def test_rejects_jobs_when_queue_full(monkeypatch, metrics):
+    monkeypatch.setattr(evaluate, '_evaluate', slow_evaluate)
+    pool = EvaluationPool(workers=1, timeout=0.2, max_queue=0,
+                          metrics=metrics)
+    pool.start()
+    try:
+        # Take the only slot.
+        pool._slots.acquire()
+        with raises(PoolBusyError):
+            pool.evaluate('foo', {})
+        assert metrics.counter('eval.rejected') == 1
+    finally:
+        pool.stop()
+
+
+def test_evaluate_stream_in_order(pool, metrics):
+    documents = [encode_document({'a': i}) for i in range(25)]
+    outcomes = list(pool.evaluate_stream('a', iter(documents),
+                                         chunk_size=3))
+    assert outcomes == [{'result': i} for i in range(25)]
+    # Streams aren't cached.
+    assert metrics.counter('eval.cache.miss') == 0
+
+
+def test_evaluate_stream_reads_ahead_boundedly(pool):
+    read = []
+
+    def documents():
+        for i in range(1000):
+            read.append(i)
+            yield encode_document(i)
+
+    outcomes = pool.evaluate_stream('@', documents(), chunk_size=10)
+    assert next(outcomes) == {'result': 0}
+    # Two chunks per worker are read ahead.
+    assert len(read) <= 20
+    assert len(list(outcomes)) == 999
+
+
+def test_slow_chunk_gets_error_outcomes(monkeypatch):
+    monkeypatch.setattr(evaluate, '_evaluate', slow_evaluate)
+    pool = EvaluationPool(workers=1, timeout=0.1)
+    try:
+        outcomes = list(pool.evaluate_stream(
+            'slow', [b'1', None, b'2'], chunk_size=2))
+    finally:
+        pool.stop()
+    assert [list(o) for o in outcomes] == [['error']] * 3
+    assert outcomes[1] == {'error': 'Document is too large.'}
+
+
+def test_iter_lines():
+    stream = BytesIO(b'{"a": 1}\n\n' + b'x' * 30 + b'\n[2]\n[3]')
+    assert list(iter_lines(stream, max_line_size=10)) == [
+        b'{"a": 1}', None, b'[2]', b'[3]']
+    stream = BytesIO(b'[1]\n[2]\n[3]\n')
+    assert list(iter_lines(stream, length=8)) == [b'[1]', b'[2]']
@@ -0,0 +1,52 @@
+import json
+
+from pytest import raises
+
+from chalicelib.limits import check_structure, StructureLimitError
+
+
+def test_counts_values():
+    assert check_structure(b'1') == 1
+    assert check_structure(b'[1, 2, 3]') == 4
+    assert check_structure(json.dumps(
+        {'query': 'foo', 'data': {'foo': [1, 2]}}).encode('utf-8')) == 6
+
+
+def test_punctuation_in_strings_ignored():
+    body = json.dumps({'a': '[[[{,,,]"\\', 'b': ['\\"', '"]']})
+    assert check_structure(body.encode('utf-8'), max_depth=2) == 5
+
+
+def test_depth_limit():
+    check_structure(b'[' * 10 + b']' * 10, max_depth=10)
+    with raises(StructureLimitError) as e:
+        check_structure(b'{"a":' * 11 + b'1' + b'}' * 11, max_depth=10)
+    assert e.value.limit == 'depth'
+
+
+def test_depth_limit_with_mixed_nesting():
+    check_structure(b'{"a":[' * 5 + b']}' * 5, max_depth=10)
+    with raises(StructureLimitError):
+        check_structure(b'{"a":[' * 6 + b']}' * 6, max_depth=10)
+    with raises(StructureLimitError):
+        check_structure(b'{"a":[' * 100 + b']}' * 100, max_depth=100)
+
+
+def test_node_limit():
+    # An array, its objects and their values.
+    check_structure(json.dumps([{'a': 1}] * 4).encode('utf-8'), max_nodes=9)
+    with raises(StructureLimitError) as e:
+        check_structure(json.dumps([{'a': 1}] * 5).encode('utf-8'),
+                        max_nodes=9)
+    assert e.value.limit == 'nodes'
+
+
+def test_string_length_limit():
+    check_structure(b'{"a": "%s"}' % (b'x' * 10), max_string_length=10)
+    with raises(StructureLimitError) as e:
+        check_structure(b'["%s"]' % (b'x' * 11), max_string_length=10)
+    assert e.value.limit == 'string_length'
+
+
+def test_unbalanced_input_left_to_parser():
+    assert check_structure(b']]}"unterminated') == 1
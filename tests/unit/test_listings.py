@@ -0,0 +1,146 @@
+from botocore.exceptions import ClientError, EndpointConnectionError
+from pytest import fixture
+
+from chalicelib.breaker import CircuitOpenError
+from chalicelib.listings import Listings, PopularIndex, RecentIndex
+
+
+class FakeIndexStorage:
+    def __init__(self):
+        self.indexes = {}
+        self.calls = []
+        self.fail = False
+        self.error = None
+
+    def get_index(self, name):
+        self.calls.append(('get_index', name))
+        if self.error is not None:
+            raise self.error
+        if self.fail:
+            raise ClientError({'Error': {'Code': 'InternalError'}},
+                              'GetObject')
+        return self.indexes.get(name)
+
+    def put_index(self, name, index):
+        self.calls.append(('put_index', name))
+        self.indexes[name] = index
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@fixture
+def storage():
+    return FakeIndexStorage()
+
+
+@fixture
+def clock():
+    return FakeClock()
+
+
+@fixture
+def listings(storage, clock):
+    return Listings(storage, recent=RecentIndex(size=3),
+                    popular=PopularIndex(size=2, half_life=100),
+                    flush_interval=10, refresh_interval=10, clock=clock)
+
+
+def test_recent_is_newest_first_and_bounded(listings, clock):
+    for i in range(5):
+        clock.now += 1
+        listings.record_put('uuid-%s' % i, {'query': 'q%s' % i, 'data': {}})
+    recent = listings.recent(10)
+    assert [r['uuid'] for r in recent] == ['uuid-4', 'uuid-3', 'uuid-2']
+    assert recent[0]['query'] == 'q4'
+
+
+def test_updates_are_flushed_in_batches(listings, storage, clock):
+    listings.record_put('a', {'query': 'a'})
+    listings.record_read('a')
+    listings.record_read('a')
+    assert storage.calls == []
+    clock.now += 10
+    listings.record_read('b')
+    assert sorted(storage.calls) == [
+        ('get_index', 'popular'), ('get_index', 'recent'),
+        ('put_index', 'popular'), ('put_index', 'recent')]
+    assert storage.indexes['recent']['entries'][0][0] == 'a'
+    assert dict(storage.indexes['popular']['entries']) == {'a': 2, 'b': 1}
+
+
+def test_flush_merges_with_other_containers(storage, clock):
+    first = Listings(storage, clock=clock)
+    second = Listings(storage, clock=clock)
+    first.record_put('a', {'query': 'a'})
+    first.flush()
+    clock.now += 1
+    second.record_put('b', {'query': 'b'})
+    second.flush()
+    assert [e[0] for e in storage.indexes['recent']['entries']] == ['b', 'a']
+
+
+def test_listings_served_from_memory(listings, storage, clock):
+    listings.recent()
+    listings.popular()
+    listings.recent()
+    listings.popular()
+    assert len(storage.calls) == 2
+    clock.now += 10
+    listings.recent()
+    assert len(storage.calls) == 3
+
+
+def test_popular_scores_decay(listings, storage, clock):
+    for _ in range(4):
+        listings.record_read('old')
+    listings.flush()
+    # Two half lives later 'old' is down to 1 read's worth.
+    clock.now += 200
+    for _ in range(2):
+        listings.record_read('new')
+    listings.record_read('other')
+    popular = listings.popular()
+    assert [p['uuid'] for p in popular] == ['new', 'old']
+    assert popular[1]['score'] == 1
+
+
+def test_storage_errors_are_not_raised(listings, storage):
+    storage.fail = True
+    listings.record_put('a', {'query': 'a'})
+    listings.flush()
+    assert [r['uuid'] for r in listings.recent()] == ['a']
+
+
+def test_failed_flushes_wait_for_interval(storage, clock):
+    listings = Listings(storage, flush_size=2, flush_interval=10,
+                        clock=clock)
+    storage.fail = True
+    listings.record_read('a')
+    listings.record_read('b')
+    assert len(storage.calls) == 1
+    listings.record_read('c')
+    assert len(storage.calls) == 1
+    storage.fail = False
+    clock.now += 10
+    listings.record_read('d')
+    assert dict(storage.indexes['popular']['entries']) == {
+        'a': 1, 'b': 1, 'c': 1, 'd': 1}
+
+
+def test_unreachable_storage_doesnt_fail_requests(listings, storage, clock):
+    for error in [EndpointConnectionError(endpoint_url='https://s3'),
+                  CircuitOpenError('Circuit open', 10)]:
+        storage.error = error
+        clock.now += 10
+        listings.record_put('a', {'query': 'a'})
+        # Still listed from the requeued pending updates.
+        assert [r['uuid'] for r in listings.recent()] == ['a']
+    storage.error = None
+    listings.flush()
+    assert [e[0] for e in storage.indexes['recent']['entries']] == ['a']
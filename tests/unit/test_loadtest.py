@@ -0,0 +1,82 @@
+import random
+
+from botocore.exceptions import ClientError
+from pytest import raises
+
+from loadtest.runner import LoadTest
+from loadtest.s3 import LatencyModel, SimulatedS3Client
+from loadtest.serializers import available_serializers, benchmark
+from loadtest.serializers import format_results
+from loadtest.traffic import TrafficMix, ZipfSampler
+
+
+def no_latency():
+    return LatencyModel(median=0, bytes_per_second=None)
+
+
+def test_simulated_client_round_trip():
+    client = SimulatedS3Client(latency=no_latency())
+    client.put_object(Bucket='b', Key='k', Body='{}', Metadata={'a': '1'})
+    response = client.get_object(Bucket='b', Key='k')
+    assert response['Body'].read() == b'{}'
+    assert response['Metadata'] == {'a': '1'}
+    assert client.calls == {'PutObject': 1, 'GetObject': 1}
+    with raises(ClientError):
+        client.get_object(Bucket='b', Key='missing')
+
+
+def test_simulated_client_throttles_per_prefix():
+    client = SimulatedS3Client(latency=no_latency(), prefix_rps=5)
+    for i in range(5):
+        client.put_object(Bucket='b', Key='hot/%s' % i, Body='')
+    with raises(ClientError) as e:
+        client.put_object(Bucket='b', Key='hot/5', Body='')
+    assert e.value.response['Error']['Code'] == 'SlowDown'
+    # Other prefixes have their own budget.
+    client.put_object(Bucket='b', Key='cold/0', Body='')
+    assert client.errors['SlowDown'] == 1
+
+
+def test_simulated_client_injects_errors():
+    client = SimulatedS3Client(latency=no_latency(), error_rate=1.0)
+    with raises(ClientError):
+        client.put_object(Bucket='b', Key='k', Body='')
+    assert client.errors['InternalError'] == 1
+
+
+def test_zipf_sampler_favors_low_ranks():
+    sampler = ZipfSampler(s=1.2, rng=random.Random(0))
+    sampler.grow(100)
+    samples = [sampler.sample() for _ in range(2000)]
+    assert all(0 <= s < 100 for s in samples)
+    assert samples.count(0) > samples.count(50) * 10
+
+
+def test_traffic_mix_includes_bursts():
+    traffic = TrafficMix(read_ratio=1.0, burst_every=10, burst_size=5,
+                         rng=random.Random(0))
+    operations = [op[0] for op in traffic.operations(30)]
+    assert len(operations) == 30
+    assert operations.count('post') == 10
+
+
+def test_can_run_load_test(tmpdir):
+    rng = random.Random(0)
+    client = SimulatedS3Client(latency=no_latency(), rng=rng)
+    load_test = LoadTest(client, concurrency=2, seed_documents=5,
+                         traffic=TrafficMix(median_doc_size=100, rng=rng),
+                         rng=rng)
+    report = load_test.run(50)
+    assert report['requests'] == 50
+    assert report['operations']['get']['statuses'] == {
+        200: report['operations']['get']['count']}
+    assert 0 < report['cache_hit_ratio'] <= 1
+
+
+def test_can_benchmark_serializers():
+    documents = [TrafficMix(rng=random.Random(1)).document()
+                 for _ in range(3)]
+    results = benchmark(documents, available_serializers(['json']), repeat=1)
+    assert [r['name'] for r in results] == ['json']
+    assert results[0]['size'] > 0
+    assert 'json' in format_results(results, len(documents))
@@ -0,0 +1,58 @@
+import json
+import logging
+
+from chalicelib.metrics import Metrics, Reporter
+
+
+def test_can_count():
+    metrics = Metrics()
+    metrics.incr('foo')
+    metrics.incr('foo', 2)
+    assert metrics.counter('foo') == 3
+    assert metrics.counter('unknown') == 0
+
+
+def test_percentile_of_timings():
+    metrics = Metrics()
+    for i in range(1, 101):
+        metrics.timing('op', i)
+    assert metrics.percentile('op', 50) == 51
+    assert metrics.percentile('op', 99) == 99
+    assert metrics.percentile('op', 50, min_samples=200) is None
+    assert metrics.percentile('unknown', 50) is None
+
+
+def test_timings_are_bounded():
+    metrics = Metrics(max_samples=10)
+    for i in range(100):
+        metrics.timing('op', i)
+    assert metrics.snapshot()['timings']['op']['count'] == 10
+    assert metrics.percentile('op', 0) == 90
+
+
+def test_timer_records_elapsed_time():
+    metrics = Metrics()
+    with metrics.timer('op'):
+        pass
+    assert metrics.snapshot()['timings']['op']['count'] == 1
+
+
+def test_reporter_logs_periodically(caplog):
+    now = [0]
+    metrics = Metrics()
+    reporter = Reporter(metrics, interval=60, clock=lambda: now[0],
+                        sources={'breaker': lambda: {'state': 'closed'}})
+    metrics.incr('s3.get.requests')
+    metrics.timing('s3.get', 0.5)
+    with caplog.at_level(logging.INFO, 'jmespath-playground.metrics'):
+        reporter.maybe_report()
+        assert not caplog.records
+        now[0] = 60
+        reporter.maybe_report()
+        reporter.maybe_report()
+    assert len(caplog.records) == 1
+    line = json.loads(caplog.records[0].getMessage())
+    assert line['type'] == 'metrics'
+    assert line['counters'] == {'s3.get.requests': 1}
+    assert line['timings']['s3.get']['p50'] == 0.5
+    assert line['breaker'] == {'state': 'closed'}
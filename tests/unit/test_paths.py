@@ -0,0 +1,62 @@
+from chalicelib.paths import summarize
+
+
+def paths_of(summary):
+    return dict((item['path'], item) for item in summary['paths'])
+
+
+def test_summarizes_nested_document():
+    summary = summarize({'people': [{'name': 'a', 'age': 1},
+                                    {'name': 'b', 'age': None}],
+                         'count': 2})
+    assert summary == {
+        'paths': [
+            {'path': '@', 'types': ['object']},
+            {'path': 'count', 'types': ['number']},
+            {'path': 'people', 'types': ['array'], 'length': [2, 2]},
+            {'path': 'people[*]', 'types': ['object']},
+            {'path': 'people[*].age', 'types': ['null', 'number']},
+            {'path': 'people[*].name', 'types': ['string']},
+        ],
+        'truncated': False,
+    }
+
+
+def test_array_length_range():
+    paths = paths_of(summarize([[1], [1, 2, 3], []]))
+    assert paths['@']['length'] == [3, 3]
+    assert paths['[*]']['length'] == [0, 3]
+    assert paths['[*][*]']['types'] == ['number']
+
+
+def test_types_match_jmespath_names():
+    paths = paths_of(summarize({'a': True, 'b': 1.5, 'c': None, 'd': 'x'}))
+    assert paths['a']['types'] == ['boolean']
+    assert paths['b']['types'] == ['number']
+    assert paths['c']['types'] == ['null']
+    assert paths['d']['types'] == ['string']
+
+
+def test_keys_that_arent_identifiers_are_quoted():
+    paths = paths_of(summarize({'foo bar': {'a"b': 1}, '1x': 2}))
+    assert '"foo bar"' in paths
+    assert '"foo bar"."a\\"b"' in paths
+    assert '"1x"' in paths
+
+
+def test_number_of_paths_is_capped():
+    summary = summarize(dict(('key%s' % i, i) for i in range(100)),
+                        max_paths=10)
+    assert len(summary['paths']) == 10
+    assert summary['truncated']
+
+
+def test_depth_is_capped():
+    document = {}
+    current = document
+    for _ in range(50):
+        current['a'] = {}
+        current = current['a']
+    summary = summarize(document, max_depth=5)
+    assert len(summary['paths']) == 6
+    assert summary['truncated']
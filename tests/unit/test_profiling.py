@@ -0,0 +1,64 @@
+import time
+
+from chalicelib.profiling import Profiler, sign, SIGNATURE_HEADER
+
+
+SECRET = b'secret'
+
+
+class RecordingSink:
+    def __init__(self):
+        self.files = {}
+
+    def __call__(self, name, contents):
+        self.files[name] = contents
+
+
+def busy_work():
+    return sum(i * i for i in range(20000))
+
+
+def test_disabled_without_environment():
+    assert Profiler.from_environ({}) is None
+    assert Profiler.from_environ({'APP_PROFILE': '5'}).window == 5
+
+
+def test_can_profile_window_of_requests():
+    sink = RecordingSink()
+    profiler = Profiler(sink=sink, window=2, interval=0.001,
+                        start_on_first=True)
+    for _ in range(2):
+        with profiler.profile():
+            busy_work()
+    names = sorted(sink.files)
+    assert len(names) == 2
+    assert names[0].endswith('.allocations.txt')
+    assert names[1].endswith('.folded')
+    assert 'busy_work' in sink.files[names[1]]
+    # Only a single window is captured.
+    with profiler.profile():
+        busy_work()
+    assert len(sink.files) == 2
+
+
+def test_signed_header_starts_profile():
+    sink = RecordingSink()
+    profiler = Profiler(sink=sink, window=1, secret=SECRET)
+    with profiler.profile({}):
+        pass
+    assert not sink.files
+    signature = sign(SECRET, int(time.time()) + 60)
+    with profiler.profile({SIGNATURE_HEADER: signature}):
+        busy_work()
+    assert len(sink.files) == 2
+
+
+def test_invalid_signatures_ignored():
+    sink = RecordingSink()
+    profiler = Profiler(sink=sink, window=1, secret=SECRET)
+    expired = sign(SECRET, int(time.time()) - 60)
+    wrong_secret = sign(b'other', int(time.time()) + 60)
+    for signature in [expired, wrong_secret, 'garbage']:
+        with profiler.profile({SIGNATURE_HEADER: signature}):
+            pass
+    assert not sink.files
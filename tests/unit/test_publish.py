@@ -0,0 +1,54 @@
+import gzip
+import json
+
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+from chalicelib.metrics import Metrics
+from chalicelib.publish import Publisher
+from tests.unit.test_storage import FakeS3Client
+
+
+class FailingS3Client(FakeS3Client):
+    def put_object(self, Bucket, Key, Body, Metadata=None, **headers):
+        raise ClientError({'Error': {'Code': 'AccessDenied'}}, 'PutObject')
+
+
+class UnreachableS3Client(FakeS3Client):
+    def put_object(self, Bucket, Key, Body, Metadata=None, **headers):
+        raise EndpointConnectionError(endpoint_url='https://s3')
+
+    def head_object(self, Bucket, Key):
+        raise EndpointConnectionError(endpoint_url='https://s3')
+
+
+def test_published_copy_is_compressed_and_typed():
+    client = FakeS3Client()
+    publisher = Publisher(client, 'bucket', 'public/')
+    assert publisher.publish('uuid', b'{"query":"foo"}')
+    body = client.state['bucket']['public/uuid.json']
+    assert json.loads(gzip.decompress(body)) == {'query': 'foo'}
+    headers = client.headers[('bucket', 'public/uuid.json')]
+    assert headers['ContentType'] == 'application/json'
+    assert headers['ContentEncoding'] == 'gzip'
+    assert 'immutable' in headers['CacheControl']
+
+
+def test_key_without_prefix():
+    assert Publisher(FakeS3Client(), 'bucket', '').key('uuid') == 'uuid.json'
+
+
+def test_failures_are_not_raised():
+    metrics = Metrics()
+    for client in [FailingS3Client(), UnreachableS3Client()]:
+        publisher = Publisher(client, 'bucket', 'public', metrics=metrics)
+        assert not publisher.publish('uuid', b'{}')
+        assert not publisher.is_published('uuid')
+    assert metrics.counter('publish.errors') == 2
+
+
+def test_is_published():
+    client = FakeS3Client()
+    publisher = Publisher(client, 'bucket', 'public')
+    assert not publisher.is_published('uuid')
+    publisher.publish('uuid', b'{}')
+    assert publisher.is_published('uuid')
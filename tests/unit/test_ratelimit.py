@@ -0,0 +1,165 @@
+from botocore.exceptions import ClientError
+from botocore.exceptions import EndpointConnectionError
+from pytest import raises
+
+from chalicelib.ratelimit import Budget, RateLimiter, RateLimitExceeded
+from chalicelib.ratelimit import MemoryBackend, DynamoDBBackend
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeDynamoDBClient:
+    def __init__(self):
+        self.items = {}
+        self.conflicts = 0
+        self.unreachable = False
+
+    def get_item(self, TableName, Key, ConsistentRead):
+        if self.unreachable:
+            raise EndpointConnectionError(endpoint_url='https://dynamodb')
+        item = self.items.get(Key['pk']['S'])
+        return {'Item': item} if item is not None else {}
+
+    def put_item(self, TableName, Item, ConditionExpression,
+                 ExpressionAttributeValues=None):
+        key = Item['pk']['S']
+        if self.conflicts:
+            self.conflicts -= 1
+            raise ClientError(
+                {'Error': {'Code': 'ConditionalCheckFailedException'}},
+                'PutItem')
+        current = self.items.get(key)
+        if current is not None:
+            expected = ExpressionAttributeValues[':version']['N']
+            assert current['version']['N'] == expected
+        self.items[key] = Item
+
+
+def test_can_parse_budget():
+    budget = Budget.parse('2/10')
+    assert budget.rate == 2
+    assert budget.capacity == 10
+    assert Budget.parse('5').capacity == 5
+
+
+def test_allows_bursts_up_to_capacity():
+    clock = FakeClock()
+    limiter = RateLimiter({'read': Budget(1, 3)}, clock=clock)
+    for _ in range(3):
+        limiter.check('client', 'read')
+    with raises(RateLimitExceeded) as e:
+        limiter.check('client', 'read')
+    assert e.value.retry_after == 1
+    # Other clients have their own buckets.
+    limiter.check('other', 'read')
+    # Tokens are refilled over time.
+    clock.now += 1
+    limiter.check('client', 'read')
+
+
+def test_budgets_are_separate():
+    limiter = RateLimiter({'read': Budget(1, 1), 'bytes': Budget(10, 100)},
+                          clock=FakeClock())
+    limiter.check('client', 'read')
+    limiter.check('client', 'bytes', 100)
+    with raises(RateLimitExceeded):
+        limiter.check('client', 'bytes', 1)
+    # Budgets that aren't configured are unlimited.
+    limiter.check('client', 'write')
+
+
+def test_cost_larger_than_capacity_leaves_bucket_in_debt():
+    clock = FakeClock()
+    limiter = RateLimiter({'bytes': Budget(10, 100)}, clock=clock)
+    limiter.check('client', 'bytes', 1000)
+    # The 900 bytes over capacity are paid back before the bucket is
+    # full again.
+    with raises(RateLimitExceeded) as e:
+        limiter.check('client', 'bytes', 1)
+    assert e.value.retry_after == 90.1
+    clock.now += 50
+    with raises(RateLimitExceeded) as e:
+        limiter.check('client', 'bytes', 1000)
+    assert e.value.retry_after == 50
+    clock.now += 50
+    limiter.check('client', 'bytes', 1000)
+
+
+def test_rejected_requests_are_refunded():
+    limiter = RateLimiter({'write': Budget(1, 2), 'bytes': Budget(1, 10)},
+                          clock=FakeClock())
+    limiter.check('client', 'bytes', 8)
+    with raises(RateLimitExceeded) as e:
+        limiter.check_all('client', [('write', 1), ('bytes', 5)])
+    assert e.value.budget == 'bytes'
+    # The write token taken before bytes was checked was given back.
+    limiter.check_all('client', [('write', 2), ('bytes', 2)])
+    with raises(RateLimitExceeded):
+        limiter.check('client', 'write')
+
+
+def test_memory_backend_is_bounded():
+    backend = MemoryBackend(max_clients=2)
+    budget = Budget(1, 1)
+    for client in ['a', 'b', 'c']:
+        assert backend.consume(client, 1, budget, 0) == 0
+    # 'a' was evicted so it has a full bucket again.
+    assert backend.consume('a', 1, budget, 0) == 0
+    assert backend.consume('c', 1, budget, 0) > 0
+
+
+def test_dynamodb_backend_shares_buckets():
+    client = FakeDynamoDBClient()
+    clock = FakeClock()
+    first = RateLimiter({'write': Budget(1, 2)},
+                        backend=DynamoDBBackend(client, 'table'), clock=clock)
+    second = RateLimiter({'write': Budget(1, 2)},
+                         backend=DynamoDBBackend(client, 'table'),
+                         clock=clock)
+    first.check('client', 'write')
+    second.check('client', 'write')
+    with raises(RateLimitExceeded):
+        first.check('client', 'write')
+    assert client.items['write:client']['version']['N'] == '2'
+
+
+def test_dynamodb_backend_retries_conflicts():
+    client = FakeDynamoDBClient()
+    client.conflicts = 1
+    backend = DynamoDBBackend(client, 'table')
+    assert backend.consume('key', 1, Budget(1, 1), 0) == 0
+    assert 'key' in client.items
+
+
+def test_dynamodb_backend_fails_open():
+    client = FakeDynamoDBClient()
+    client.conflicts = DynamoDBBackend.MAX_ATTEMPTS
+    backend = DynamoDBBackend(client, 'table')
+    assert backend.consume('key', 1, Budget(1, 1), 0) == 0
+
+
+def test_dynamodb_backend_fails_open_when_unreachable():
+    client = FakeDynamoDBClient()
+    client.unreachable = True
+    backend = DynamoDBBackend(client, 'table')
+    assert backend.consume('key', 1, Budget(1, 1), 0) == 0
+    backend.refund('key', 1, Budget(1, 1), 0)
+
+
+def test_dynamodb_backend_refunds():
+    client = FakeDynamoDBClient()
+    clock = FakeClock()
+    limiter = RateLimiter({'write': Budget(1, 2), 'bytes': Budget(1, 1)},
+                          backend=DynamoDBBackend(client, 'table'),
+                          clock=clock)
+    limiter.check('client', 'bytes')
+    with raises(RateLimitExceeded):
+        limiter.check_all('client', [('write', 2), ('bytes', 1)])
+    assert float(client.items['write:client']['tokens']['N']) == 2
+    limiter.check('client', 'write', 2)
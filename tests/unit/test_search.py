@@ -0,0 +1,175 @@
+import uuid
+
+from botocore.exceptions import ClientError, EndpointConnectionError
+from pytest import fixture
+
+from chalicelib.search import SearchIndex, S3SegmentStore, Segment
+from chalicelib.search import build_segment, merge_segments, tokenize
+from tests.unit.test_storage import FakeS3Client
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FailingS3Client(FakeS3Client):
+    def put_object(self, Bucket, Key, Body, Metadata=None):
+        raise ClientError({'Error': {'Code': 'InternalError'}}, 'PutObject')
+
+
+class UnreachableS3Client(FakeS3Client):
+    def put_object(self, Bucket, Key, Body, Metadata=None):
+        raise EndpointConnectionError(endpoint_url='https://s3')
+
+    def list_objects_v2(self, **kwargs):
+        raise EndpointConnectionError(endpoint_url='https://s3')
+
+
+class NoDeleteS3Client(FakeS3Client):
+    def delete_object(self, Bucket, Key):
+        self.calls.append(('delete_object', Key))
+        raise ClientError({'Error': {'Code': 'AccessDenied'}},
+                          'DeleteObject')
+
+
+@fixture
+def s3_client():
+    return FakeS3Client()
+
+
+@fixture
+def clock():
+    return FakeClock()
+
+
+def create_index(s3_client, clock, **kwargs):
+    return SearchIndex(S3SegmentStore(s3_client, 'bucket', 'test'),
+                       clock=clock, **kwargs)
+
+
+def new_uuid():
+    return str(uuid.uuid4())
+
+
+def test_tokenize_splits_identifiers():
+    assert tokenize('sort_by(people, &Age)[0].name') == [
+        'sort_by', 'people', 'age', 'name']
+    assert tokenize(None) == []
+
+
+def test_segment_postings_ordered_by_impact():
+    short, long = new_uuid(), new_uuid()
+    segment = Segment(build_segment([
+        (long, tokenize('foo.bar.baz.qux.name')),
+        (short, tokenize('name')),
+    ]))
+    assert segment.doc_count == 2
+    assert list(segment.iter_terms()) == ['bar', 'baz', 'foo', 'name', 'qux']
+    postings = segment.postings('name')
+    # The shorter query is the better match.
+    assert [segment.uuid(d) for d, _ in postings] == [short, long]
+    assert postings[0][1] > postings[1][1]
+    assert segment.postings('name', limit=1) == postings[:1]
+    assert segment.doc_freq('foo') == 1
+    assert segment.postings('missing') == []
+
+
+def test_merge_keeps_each_document_once():
+    first, second = new_uuid(), new_uuid()
+    merged = Segment(merge_segments([
+        Segment(build_segment([(first, ['foo'])])),
+        Segment(build_segment([(first, ['foo']), (second, ['bar'])])),
+    ]))
+    assert merged.doc_count == 2
+    assert merged.doc_freq('foo') == 1
+    assert [merged.uuid(d) for d, _ in merged.postings('bar')] == [second]
+
+
+def test_search_ranks_matches(s3_client, clock):
+    index = create_index(s3_client, clock)
+    uuids = [new_uuid() for _ in range(3)]
+    index.add(uuids[0], 'sort_by(people, &age)')
+    index.add(uuids[1], 'people[*].name')
+    index.add(uuids[2], 'locations[?state == `WA`].name')
+    results = index.search('sort_by people')
+    assert [u for u, _ in results] == uuids[:2]
+    assert [u for u, _ in index.search('name', limit=1)] == [uuids[1]]
+    assert index.search('missing') == []
+
+
+def test_flushed_segments_visible_to_other_indexes(s3_client, clock):
+    writer = create_index(s3_client, clock, flush_size=2)
+    reader = create_index(s3_client, clock, refresh_interval=60)
+    assert reader.search('foo') == []
+    doc_uuid = new_uuid()
+    writer.add(doc_uuid, 'foo')
+    writer.add(new_uuid(), 'bar')
+    # The reader's list of segments hasn't been refreshed yet.
+    assert reader.search('foo') == []
+    clock.now += 60
+    assert [u for u, _ in reader.search('foo')] == [doc_uuid]
+
+
+def test_flush_interval(s3_client, clock):
+    index = create_index(s3_client, clock, flush_interval=60)
+    index.add(new_uuid(), 'foo')
+    assert s3_client.state == {}
+    clock.now += 60
+    index.add(new_uuid(), 'bar')
+    assert len(s3_client.state['bucket']) == 1
+
+
+def test_failed_flush_is_retried(clock):
+    index = create_index(FailingS3Client(), clock, flush_size=1)
+    doc_uuid = new_uuid()
+    index.add(doc_uuid, 'foo')
+    # The document is still searchable from memory.
+    assert [u for u, _ in index.search('foo')] == [doc_uuid]
+
+
+def test_unreachable_store_is_retried(clock):
+    client = UnreachableS3Client()
+    index = create_index(client, clock, flush_size=1)
+    doc_uuid = new_uuid()
+    index.add(doc_uuid, 'foo')
+    assert [u for u, _ in index.search('foo')] == [doc_uuid]
+    client.put_object = FakeS3Client.put_object.__get__(client)
+    assert index.flush() is not None
+
+
+def test_segments_not_merged_without_delete(clock):
+    client = NoDeleteS3Client()
+    index = create_index(client, clock, flush_size=1)
+    for _ in range(20):
+        index.add(new_uuid(), 'foo')
+    # Only the flushed segments were written, and deletes were only
+    # tried once.
+    assert len(client.state['bucket']) == 20
+    assert [c for c in client.calls if c[0] == 'delete_object'] == [
+        ('delete_object', 'test/search/.delete-check')]
+
+
+def test_small_segments_are_merged(s3_client, clock):
+    index = create_index(s3_client, clock, flush_size=1)
+    uuids = [new_uuid() for _ in range(20)]
+    for doc_uuid in uuids:
+        index.add(doc_uuid, 'foo')
+    segments = S3SegmentStore(s3_client, 'bucket', 'test').list()
+    assert len(segments) <= 16
+    found = [u for u, _ in index.search('foo', limit=100)]
+    assert sorted(found) == sorted(uuids)
+
+
+def test_backfill_writes_segments(s3_client, clock, tmpdir):
+    index = create_index(s3_client, clock, local_dir=str(tmpdir))
+    uuids = [new_uuid() for _ in range(5)]
+    count = index.backfill([(u, 'foo') for u in uuids], segment_size=2)
+    assert count == 5
+    assert len(tmpdir.listdir()) == 3
+    reader = create_index(s3_client, clock, local_dir=str(tmpdir.mkdir('r')))
+    found = [u for u, _ in reader.search('foo', limit=10)]
+    assert sorted(found) == sorted(uuids)
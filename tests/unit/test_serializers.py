@@ -0,0 +1,64 @@
+import math
+
+from pytest import fixture, raises, importorskip
+
+from chalicelib.serializers import JSONSerializer, FastJSONSerializer
+from chalicelib.serializers import TaggedSerializer, UnknownFormatError
+from chalicelib.serializers import get_serializer
+
+
+DOCUMENT = {'query': 'foo[?bar > `1`]',
+            'data': {'foo': [{'bar': 1}, {'bar': 2.5, 'baz': u'☃'}]}}
+
+
+@fixture(params=['json', 'fastjson', 'msgpack'])
+def serializer(request):
+    if request.param == 'msgpack':
+        importorskip('msgpack')
+    return get_serializer(request.param)
+
+
+def test_round_trips_documents(serializer):
+    assert serializer.loads(serializer.dumps(DOCUMENT)) == DOCUMENT
+
+
+def test_tagged_round_trip(serializer):
+    tagged = TaggedSerializer(serializer)
+    contents = tagged.dumps(DOCUMENT)
+    assert contents[1:2] == serializer.tag
+    assert tagged.loads(contents) == DOCUMENT
+    assert JSONSerializer().loads(tagged.loads_json(contents)) == DOCUMENT
+
+
+def test_reads_values_in_other_formats(serializer):
+    tagged = TaggedSerializer(serializer)
+    untagged = b'{"foo":"bar"}'
+    assert tagged.loads(untagged) == {'foo': 'bar'}
+    assert tagged.loads_json(untagged) == untagged
+    json_tagged = TaggedSerializer(JSONSerializer()).dumps({'foo': 'bar'})
+    assert tagged.loads(json_tagged) == {'foo': 'bar'}
+    assert tagged.loads_json(json_tagged) == b'{"foo":"bar"}'
+
+
+def test_unknown_tags_raise_error():
+    with raises(UnknownFormatError):
+        TaggedSerializer(JSONSerializer()).loads(b'\x00zabc')
+
+
+def test_unknown_serializer_name():
+    with raises(ValueError):
+        get_serializer('yaml')
+
+
+def test_fast_json_falls_back_for_unsupported_values():
+    serializer = FastJSONSerializer()
+    assert serializer.loads(serializer.dumps({'a': 2 ** 70})) == {'a': 2 ** 70}
+    assert math.isnan(serializer.loads(b'{"a": NaN}')['a'])
+
+
+def test_values_the_format_cant_hold_are_stored_as_json():
+    importorskip('msgpack')
+    tagged = TaggedSerializer(get_serializer('msgpack'))
+    contents = tagged.dumps({'a': 2 ** 70})
+    assert contents[1:2] == JSONSerializer.tag
+    assert tagged.loads(contents) == {'a': 2 ** 70}
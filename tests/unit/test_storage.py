@@ -1,14 +1,27 @@
+import gzip
+import json
+import time
+from collections import OrderedDict
 from unittest import mock
-from io import StringIO
+from io import BytesIO
 
 import boto3
+from botocore.config import Config as ClientConfig
+from botocore.exceptions import ClientError, ReadTimeoutError
 from pytest import fixture, raises
 
+from chalicelib import storage as storage_module
 from chalicelib.storage import Config
 from chalicelib.storage import S3Storage
 from chalicelib.storage import CachingStorage
+from chalicelib.storage import CircuitBreakingStorage
 from chalicelib.storage import Storage
 from chalicelib.storage import MaxSizeError
+from chalicelib.storage import DeadlineExceededError
+from chalicelib.storage import create_s3_client
+from chalicelib.metrics import Metrics
+from chalicelib.publish import Publisher
+from chalicelib.breaker import CircuitOpenError
 
 
 def test_config_create():
@@ -17,6 +30,39 @@ def test_config_create():
     assert c.prefix == 'key'
 
 
+def test_can_create_tuned_s3_client():
+    config = Config(bucket='foo', max_pool_connections=25,
+                    connect_timeout=1, read_timeout=3,
+                    retry_mode='adaptive', max_attempts=4)
+    session = boto3.session.Session(
+        region_name='us-west-2',
+        aws_access_key_id='access_key',
+        aws_secret_access_key='secret_key')
+    client = create_s3_client(config, session=session)
+    client_config = client.meta.config
+    assert client_config.max_pool_connections == 25
+    assert client_config.connect_timeout == 1
+    assert client_config.read_timeout == 3
+    assert client_config.retries['mode'] == 'adaptive'
+    if 'tcp_keepalive' in ClientConfig.OPTION_DEFAULTS:
+        assert client_config.tcp_keepalive
+
+
+def test_can_create_s3_client_without_keepalive_support():
+    # botocore before 1.27 raises a TypeError for tcp_keepalive.
+    class OldClientConfig(ClientConfig):
+        OPTION_DEFAULTS = OrderedDict(
+            (k, v) for k, v in ClientConfig.OPTION_DEFAULTS.items()
+            if k != 'tcp_keepalive')
+
+    session = mock.Mock()
+    with mock.patch('botocore.config.Config', OldClientConfig):
+        create_s3_client(Config(bucket='foo'), session=session)
+    client_config = session.client.call_args[1]['config']
+    assert client_config.max_pool_connections == \
+        storage_module.MAX_POOL_CONNECTIONS
+
+
 @fixture
 def mock_client():
     s3 = boto3.client(
@@ -30,7 +76,10 @@ def mock_client():
 
 @fixture
 def mock_storage():
-    return mock.Mock(spec=Storage)
+    storage = mock.Mock(spec=Storage)
+    storage.dedupes_data = False
+    storage.data_ref.return_value = None
+    return storage
 
 
 @fixture
@@ -41,24 +90,96 @@ def fake_client():
 class FakeS3Client:
     def __init__(self):
         self.state = {}
+        self.metadata = {}
+        self.headers = {}
+        self.calls = []
 
-    def put_object(self, Bucket, Key, Body):
+    def put_object(self, Bucket, Key, Body, Metadata=None, **headers):
+        self.calls.append(('put_object', Key))
         bucket_state = self.state.setdefault(Bucket, {})
         bytes_body = self._get_bytes_body(Body)
         bucket_state[Key] = bytes_body
+        self.metadata[(Bucket, Key)] = Metadata or {}
+        self.headers[(Bucket, Key)] = headers
 
-    def get_object(self, Bucket, Key):
+    def get_object(self, Bucket, Key, Range=None):
+        self.calls.append(('get_object', Key))
         bucket_state = self.state.setdefault(Bucket, {})
-        return {
-            'Body': StringIO(bucket_state[Key]),
-        }
+        if Key not in bucket_state:
+            raise ClientError(
+                {'Error': {'Code': 'NoSuchKey', 'Message': Key}},
+                'GetObject')
+        body = bucket_state[Key]
+        response = {'Metadata': self.metadata.get((Bucket, Key), {})}
+        if Range is not None:
+            start, end = Range[len('bytes='):].split('-')
+            response['ContentRange'] = 'bytes %s-%s/%s' % (
+                start, end, len(body))
+            body = body[int(start):int(end) + 1]
+        response['ContentLength'] = len(body)
+        response['Body'] = BytesIO(body)
+        return response
+
+    def copy_object(self, Bucket, Key, CopySource):
+        self.calls.append(('copy_object', Key))
+        source = self.state[CopySource['Bucket']][CopySource['Key']]
+        self.state.setdefault(Bucket, {})[Key] = source
+        self.metadata[(Bucket, Key)] = self.metadata.get(
+            (CopySource['Bucket'], CopySource['Key']), {})
+
+    def documents(self, Bucket='bucket'):
+        # The stored objects other than path summaries, which are
+        # written alongside every document.
+        return dict((k, v) for k, v in self.state.get(Bucket, {}).items()
+                    if not k.startswith('paths/') and '/paths/' not in k)
+
+    def head_object(self, Bucket, Key):
+        self.calls.append(('head_object', Key))
+        if Key not in self.state.get(Bucket, {}):
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        return {'Metadata': self.metadata.get((Bucket, Key), {})}
+
+    def delete_object(self, Bucket, Key):
+        self.calls.append(('delete_object', Key))
+        self.state.get(Bucket, {}).pop(Key, None)
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None,
+                        ContinuationToken=None, MaxKeys=2):
+        # MaxKeys is small so pagination gets exercised.
+        self.calls.append(('list_objects_v2', Prefix))
+        keys = sorted(k for k in self.state.get(Bucket, {})
+                      if k.startswith(Prefix))
+        if Delimiter is not None:
+            keys = [k for k in keys if Delimiter not in k[len(Prefix):]]
+        if ContinuationToken is not None:
+            keys = [k for k in keys if k > ContinuationToken]
+        page = keys[:MaxKeys]
+        response = {'Contents': [{'Key': k} for k in page],
+                    'IsTruncated': len(keys) > MaxKeys}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page[-1]
+        return response
 
     def _get_bytes_body(self, body):
         if hasattr(body, 'read'):
-            return body.read()
+            body = body.read()
+        if isinstance(body, str):
+            body = body.encode('utf-8')
         return body
 
 
+class SlowFakeS3Client(FakeS3Client):
+    # Each get_object() call sleeps for the next delay in the list.
+    def __init__(self, delays):
+        super().__init__()
+        self.delays = list(delays)
+
+    def get_object(self, Bucket, Key):
+        delay = self.delays.pop(0) if self.delays else 0
+        time.sleep(delay)
+        return super().get_object(Bucket, Key)
+
+
 class TestS3Storage:
     def setup_method(self):
         self.config = Config(bucket='bucket',
@@ -77,10 +198,18 @@ class TestS3Storage:
         retrieved = storage.get(uid)
         assert retrieved == self.input_data
         assert 'bucket' in fake_client.state
-        keys = list(fake_client.state['bucket'].keys())
+        keys = list(fake_client.documents().keys())
         assert len(keys) == 1, keys
         assert keys[0].startswith('prefix/')
 
+    def test_can_put_and_get_index(self, fake_client):
+        storage = S3Storage(fake_client, self.config)
+        assert storage.get_index('recent') is None
+        storage.put_index('recent', {'entries': [['a', 1, 'foo']]})
+        assert storage.get_index('recent') == {'entries': [['a', 1, 'foo']]}
+        assert 'prefix/indexes/recent.json' in fake_client.state['bucket']
+        assert list(storage.iter_uuids()) == []
+
     def test_can_put_and_get_with_no_prefix(self, fake_client):
         config = Config(bucket='bucket')
         storage = S3Storage(fake_client, config)
@@ -95,7 +224,49 @@ class TestS3Storage:
         uid = storage.put(self.input_data)
         retrieved = storage.get(uid)
         assert retrieved == self.input_data
-        assert list(fake_client.state['bucket'].keys()) == ['slash/%s' % uid]
+        assert list(fake_client.documents().keys()) == ['slash/%s' % uid]
+
+    def test_records_first_byte_and_transfer_times(self, fake_client):
+        metrics = Metrics()
+        storage = S3Storage(fake_client, self.config, metrics=metrics)
+        storage.get(storage.put(self.input_data))
+        snapshot = metrics.snapshot()['timings']
+        assert snapshot['s3.get.first_byte']['count'] == 1
+        assert snapshot['s3.get.transfer']['count'] == 1
+        assert snapshot['s3.put']['count'] == 1
+
+    def test_can_get_metadata_with_ranged_get(self, fake_client):
+        storage = S3Storage(fake_client, self.config)
+        data = {'query': 'foo', 'data': {'foo': 'bar' * 10000}}
+        uid = storage.put(data)
+        fake_client.calls = []
+        assert storage.get_metadata(uid) == {'query': 'foo'}
+        # Only a single ranged GET is needed.
+        assert len(fake_client.calls) == 1
+        assert storage.get_fields(uid, ['query']) == {'query': 'foo'}
+        assert storage.get_fields(uid, ['query', 'data']) == data
+        assert storage.get_fields(uid, ['unknown']) == {}
+
+    def test_metadata_longer_than_range_size(self, fake_client):
+        storage = S3Storage(fake_client, self.config)
+        data = {'query': 'a' * 5000, 'data': {'foo': 'bar'}}
+        uid = storage.put(data)
+        assert storage.get_metadata(uid) == {'query': 'a' * 5000}
+
+    def test_metadata_for_documents_without_data(self, fake_client):
+        storage = S3Storage(fake_client, self.config)
+        assert storage.get_metadata(storage.put({'data': 1})) == {}
+        assert storage.get_metadata(storage.put({'query': 'a'})) == {
+            'query': 'a'}
+
+    def test_metadata_for_legacy_objects(self, fake_client):
+        storage = S3Storage(fake_client, self.config)
+        small = storage.put(self.input_data)
+        large = storage.put({'query': 'foo', 'data': 'a' * 10000})
+        fake_client.metadata.clear()
+        assert storage.get_metadata(small) == {
+            'query': 'foo', 'input': {'foo': 'bar'}}
+        assert storage.get_metadata(large) == {'query': 'foo'}
 
     def test_can_validate_max_body_size(self, fake_client):
         config = Config(bucket='bucket', max_body_size=15)
@@ -106,10 +277,608 @@ class TestS3Storage:
         uid = storage.put(under_max_size)
         with raises(MaxSizeError):
             storage.put(over_max_size)
-        assert list(fake_client.state['bucket'].keys()) == [uid]
+        assert list(fake_client.documents().keys()) == [uid]
+
+    def test_put_many_returns_result_per_document(self, fake_client):
+        config = Config(bucket='bucket', max_body_size=15)
+        metrics = Metrics()
+        storage = S3Storage(fake_client, config, metrics=metrics)
+        results = storage.put_many([{"foo": "bar"},
+                                    {"foo": {"bar": {"baz": "qux"}}},
+                                    {"baz": "qux"}])
+        assert isinstance(results[1], MaxSizeError)
+        assert storage.get(results[0]) == {"foo": "bar"}
+        assert storage.get(results[2]) == {"baz": "qux"}
+        assert len(fake_client.documents()) == 2
+        assert metrics.counter('s3.put.batches') == 1
+
+    def test_path_summary_stored_with_document(self, fake_client):
+        metrics = Metrics()
+        storage = S3Storage(fake_client, self.config, metrics=metrics)
+        uid = storage.put({'query': 'foo', 'data': {'foo': [1, 2]}})
+        assert 'prefix/paths/%s.json' % uid in fake_client.state['bucket']
+        fake_client.calls = []
+        paths = storage.get_paths(uid)
+        assert [p['path'] for p in paths['paths']] == ['@', 'foo', 'foo[*]']
+        assert fake_client.calls == [
+            ('get_object', 'prefix/paths/%s.json' % uid)]
+        assert metrics.counter('s3.paths.backfilled') == 0
+
+    def test_missing_path_summary_is_backfilled(self, fake_client):
+        metrics = Metrics()
+        storage = S3Storage(fake_client, self.config, metrics=metrics)
+        uid = storage.put({'query': 'foo', 'data': {'foo': 'bar'}})
+        del fake_client.state['bucket']['prefix/paths/%s.json' % uid]
+        expected = {'paths': [{'path': '@', 'types': ['object']},
+                              {'path': 'foo', 'types': ['string']}],
+                    'truncated': False}
+        assert storage.get_paths(uid) == expected
+        assert metrics.counter('s3.paths.backfilled') == 1
+        assert 'prefix/paths/%s.json' % uid in fake_client.state['bucket']
+        assert storage.get_paths(uid) == expected
+        assert metrics.counter('s3.paths.backfilled') == 1
+
+    def test_put_many_returns_connection_errors(self, fake_client):
+        put_object = fake_client.put_object
+
+        def flaky_put_object(Bucket, Key, Body, **kwargs):
+            if b'"fail"' in fake_client._get_bytes_body(Body):
+                raise ReadTimeoutError(endpoint_url='https://s3')
+            return put_object(Bucket, Key, Body, **kwargs)
+
+        fake_client.put_object = flaky_put_object
+        storage = S3Storage(fake_client, Config(bucket='bucket'))
+        results = storage.put_many([{"foo": "bar"}, {"foo": "fail"},
+                                    {"baz": "qux"}])
+        assert isinstance(results[1], ReadTimeoutError)
+        assert storage.get(results[0]) == {"foo": "bar"}
+        assert storage.get(results[2]) == {"baz": "qux"}
+
+    def test_put_many_limits_total_size(self, fake_client):
+        config = Config(bucket='bucket', max_batch_size=40)
+        storage = S3Storage(fake_client, config)
+        with raises(MaxSizeError):
+            storage.put_many([{"foo": "bar"}] * 4)
+        # Nothing in the batch is saved.
+        assert fake_client.state == {}
+
+
+class TestHedgedReads:
+    def setup_method(self):
+        self.input_data = {'query': 'foo', 'data': {'foo': 'bar'}}
+
+    def test_slow_read_is_hedged(self):
+        client = SlowFakeS3Client(delays=[0, 1, 0])
+        config = Config(bucket='bucket', hedge_reads=True,
+                        hedge_min_delay=0.01)
+        metrics = Metrics()
+        storage = S3Storage(client, config, metrics=metrics)
+        uid = storage.put(self.input_data)
+        # The first get is fast so we shouldn't hedge.
+        assert storage.get(uid) == self.input_data
+        assert metrics.counter('s3.get.hedged') == 0
+        # The second takes a second, so the hedged request should win.
+        start = time.monotonic()
+        assert storage.get(uid) == self.input_data
+        assert time.monotonic() - start < 0.5
+        assert metrics.counter('s3.get.hedged') == 1
+        assert metrics.counter('s3.get.hedge_wins') == 1
+        assert metrics.counter('s3.get.requests') == 2
+
+    def test_errors_propagate_when_hedging(self):
+        client = SlowFakeS3Client(delays=[])
+        config = Config(bucket='bucket', hedge_reads=True)
+        storage = S3Storage(client, config)
+        with raises(ClientError):
+            storage.get('unknown')
+
+    def test_read_bounded_by_deadline(self):
+        client = SlowFakeS3Client(delays=[1])
+        config = Config(bucket='bucket', deadline_margin=0.5)
+        metrics = Metrics()
+        storage = S3Storage(client, config, metrics=metrics,
+                            remaining_time=lambda: 0.6)
+        uid = storage.put(self.input_data)
+        with raises(DeadlineExceededError):
+            storage.get(uid)
+        assert metrics.counter('s3.get.deadline_exceeded') == 1
+
+    def test_no_deadline_when_remaining_time_unknown(self):
+        client = SlowFakeS3Client(delays=[0.05])
+        config = Config(bucket='bucket')
+        storage = S3Storage(client, config, remaining_time=lambda: None)
+        uid = storage.put(self.input_data)
+        assert storage.get(uid) == self.input_data
+
+
+class FakeRawCache:
+    # An in memory version of SemiDBMCache.
+    def __init__(self):
+        self.state = {}
+
+    def get(self, key, default=None):
+        if key not in self.state:
+            return default
+        return self[key]
+
+    def __getitem__(self, key):
+        return json.loads(self.state[key])
+
+    def __contains__(self, key):
+        return key in self.state
+
+    def __setitem__(self, key, value):
+        self.state[key] = json.dumps(value).encode('utf-8')
+
+    def get_raw(self, key):
+        return self.state.get(key)
+
+    def set_raw(self, key, value):
+        self.state[key] = value
+
+    def set_many(self, items):
+        for key, value in items:
+            self[key] = value
+
+
+class TestRawDocuments:
+    def test_can_stream_from_s3(self, fake_client):
+        storage = S3Storage(fake_client, Config(bucket='bucket'))
+        data = {'query': 'foo', 'data': list(range(1000))}
+        uid = storage.put(data)
+        chunks = list(storage.iter_raw(uid, chunk_size=100))
+        assert len(chunks) > 1
+        assert all(len(chunk) <= 100 for chunk in chunks)
+        assert json.loads(b''.join(chunks)) == data
+        assert json.loads(storage.get_raw(uid)) == data
+
+    def test_stream_errors_raised_immediately(self, fake_client):
+        storage = S3Storage(fake_client, Config(bucket='bucket'))
+        with raises(ClientError):
+            storage.iter_raw('unknown')
+
+    def test_raw_get_populates_cache(self, mock_storage):
+        cache = FakeRawCache()
+        mock_storage.get_raw.return_value = b'{"foo":"bar"}'
+        storage = CachingStorage(mock_storage, cache)
+        assert storage.get_raw('uuid') == b'{"foo":"bar"}'
+        assert storage.get_raw('uuid') == b'{"foo":"bar"}'
+        assert mock_storage.get_raw.call_count == 1
+        assert b''.join(storage.iter_raw('uuid')) == b'{"foo":"bar"}'
+        assert not mock_storage.iter_raw.called
+
+    def test_stream_miss_uses_real_storage(self, mock_storage):
+        cache = FakeRawCache()
+        mock_storage.iter_raw.return_value = iter([b'{}'])
+        storage = CachingStorage(mock_storage, cache)
+        assert list(storage.iter_raw('uuid')) == [b'{}']
+        assert 'uuid' not in cache
+
+    def test_small_stream_miss_cached(self, fake_client):
+        cache = FakeRawCache()
+        real_storage = S3Storage(fake_client, Config(bucket='bucket'))
+        uuid = real_storage.put({'query': 'foo', 'data': 'x' * 100})
+        storage = CachingStorage(real_storage, cache, max_stream_size=1000)
+        chunks = storage.iter_raw(uuid, chunk_size=10)
+        first = next(chunks)
+        # Not cached until it's been read in full.
+        assert uuid not in cache
+        body = first + b''.join(chunks)
+        assert cache.get_raw(uuid) == body
+        fake_client.calls = []
+        assert b''.join(storage.iter_raw(uuid)) == body
+        assert fake_client.calls == []
+
+    def test_large_stream_miss_not_cached(self, fake_client):
+        cache = FakeRawCache()
+        real_storage = S3Storage(fake_client, Config(bucket='bucket'))
+        uuid = real_storage.put({'query': 'foo', 'data': 'x' * 100})
+        storage = CachingStorage(real_storage, cache, max_stream_size=100)
+        assert json.loads(b''.join(storage.iter_raw(uuid)))['query'] == 'foo'
+        assert uuid not in cache
+
+
+class TestShardedKeys:
+    def setup_method(self):
+        self.data = {'query': 'foo', 'data': {'foo': 'bar'}}
+
+    def test_keys_spread_across_shards(self, fake_client):
+        config = Config(bucket='bucket', prefix='prefix', shards=16)
+        storage = S3Storage(fake_client, config)
+        uuids = [storage.put(self.data) for _ in range(50)]
+        shards = set()
+        for key in fake_client.documents():
+            prefix, shard, uuid = key.split('/')
+            assert prefix == 'prefix'
+            assert len(shard) == 1
+            shards.add(shard)
+        assert len(shards) > 1
+        for uuid in uuids:
+            assert storage.get(uuid) == self.data
+
+    def test_shard_names_are_fixed_width(self, fake_client):
+        config = Config(bucket='bucket', shards=256)
+        storage = S3Storage(fake_client, config)
+        storage.put(self.data)
+        shard = list(fake_client.documents())[0].split('/')[0]
+        assert len(shard) == 2
+
+    def test_can_find_legacy_keys(self, fake_client):
+        legacy = S3Storage(fake_client, Config(bucket='bucket',
+                                               prefix='prefix'))
+        uuid = legacy.put(self.data)
+        metrics = Metrics()
+        sharded = S3Storage(fake_client, Config(
+            bucket='bucket', prefix='prefix', shards=16), metrics=metrics)
+        assert sharded.get(uuid) == self.data
+        assert sharded.get_metadata(uuid) == {'query': 'foo'}
+        assert json.loads(b''.join(sharded.iter_raw(uuid))) == self.data
+        assert metrics.counter('s3.get.legacy') == 3
+
+    def test_legacy_lookup_can_be_disabled(self, fake_client):
+        legacy = S3Storage(fake_client, Config(bucket='bucket'))
+        uuid = legacy.put(self.data)
+        sharded = S3Storage(fake_client, Config(
+            bucket='bucket', shards=16, legacy_lookup=False))
+        with raises(ClientError):
+            sharded.get(uuid)
+
+    def test_can_migrate_legacy_keys(self, fake_client):
+        legacy = S3Storage(fake_client, Config(bucket='bucket',
+                                               prefix='prefix'))
+        uuids = [legacy.put(self.data) for _ in range(5)]
+        sharded = S3Storage(fake_client, Config(
+            bucket='bucket', prefix='prefix', shards=16))
+        assert sharded.migrate_legacy_keys(delete=True) == 5
+        # Running it again is a noop.
+        assert sharded.migrate_legacy_keys(delete=True) == 0
+        fake_client.calls = []
+        for uuid in uuids:
+            assert sharded.get(uuid) == self.data
+        assert len(fake_client.calls) == 5
+        assert sorted(sharded.iter_uuids()) == sorted(uuids)
+
+    def test_can_find_legacy_chunks_and_data(self, fake_client):
+        config = Config(bucket='bucket', prefix='prefix', chunk_size=100,
+                        max_body_size=1024 * 1024, dedupe_data=True,
+                        dedupe_min_size=100)
+        data = {'query': 'foo', 'data': [{'index': i} for i in range(100)]}
+        uuid = S3Storage(fake_client, config).put(data)
+        legacy_keys = set(fake_client.documents())
+        config.shards = 16
+        sharded = S3Storage(fake_client, config)
+        assert sharded.get(uuid) == data
+        # The document, its data and the data's chunks.
+        assert sharded.migrate_legacy_keys(delete=True) == len(legacy_keys)
+        assert not legacy_keys & set(fake_client.documents())
+        assert sharded.get(uuid) == data
+
+    def test_iter_uuids_covers_both_layouts(self, fake_client):
+        config = Config(bucket='bucket', prefix='prefix', chunk_size=10,
+                        max_body_size=1000)
+        legacy = S3Storage(fake_client, config)
+        first = legacy.put(self.data)
+        config.shards = 16
+        sharded = S3Storage(fake_client, config)
+        second = sharded.put(self.data)
+        assert sorted(sharded.iter_uuids()) == sorted([first, second])
+
+
+class TestChunkedStorage:
+    def setup_method(self):
+        self.config = Config(bucket='bucket', prefix='prefix',
+                             max_body_size=1024 * 1024, chunk_size=1000)
+        self.data = {'query': 'foo',
+                     'data': [{'index': i} for i in range(1000)]}
+
+    def test_can_put_and_get_chunked_document(self, fake_client):
+        storage = S3Storage(fake_client, self.config)
+        uid = storage.put(self.data)
+        keys = fake_client.state['bucket']
+        chunk_keys = [k for k in keys if k.startswith('prefix/chunks/')]
+        assert len(chunk_keys) > 1
+        assert all(len(keys[k]) <= 1000 for k in chunk_keys)
+        assert storage.get(uid) == self.data
+
+    def test_small_documents_not_chunked(self, fake_client):
+        storage = S3Storage(fake_client, self.config)
+        uid = storage.put({'query': 'foo', 'data': 'bar'})
+        assert list(fake_client.documents()) == ['prefix/%s' % uid]
+
+    def test_identical_chunks_stored_once(self, fake_client):
+        storage = S3Storage(fake_client, self.config)
+        storage.put(self.data)
+        num_keys = len(fake_client.documents())
+        storage.put(self.data)
+        assert len(fake_client.documents()) == num_keys + 1
+
+    def test_can_stream_chunked_document(self, fake_client):
+        storage = S3Storage(fake_client, self.config)
+        uid = storage.put(self.data)
+        chunks = list(storage.iter_raw(uid, chunk_size=100))
+        assert json.loads(b''.join(chunks)) == self.data
+
+    def test_can_get_metadata_of_chunked_document(self, fake_client):
+        storage = S3Storage(fake_client, self.config)
+        data = dict(self.data, query='a' * 2500)
+        uid = storage.put(data)
+        assert storage.get_metadata(uid) == {'query': 'a' * 2500}
+
+    def test_chunks_cached_individually(self, fake_client):
+        cache = FakeRawCache()
+        storage = S3Storage(fake_client, self.config, chunk_cache=cache)
+        uid = storage.put(self.data)
+        assert all(k.startswith('chunk:') for k in cache.state)
+        fake_client.calls = []
+        assert storage.get(uid) == self.data
+        # Only the manifest needs to be retrieved from S3.
+        assert len(fake_client.calls) == 1
+
+    def test_corrupt_chunk_detected(self, fake_client):
+        storage = S3Storage(fake_client, self.config)
+        uid = storage.put(self.data)
+        bucket = fake_client.state['bucket']
+        chunk_key = [k for k in bucket if '/chunks/' in k][0]
+        bucket[chunk_key] = b'corrupt'
+        with raises(ValueError):
+            storage.get(uid)
+
+    def test_corrupt_cached_chunk_refetched(self, fake_client):
+        cache = FakeRawCache()
+        storage = S3Storage(fake_client, self.config, chunk_cache=cache)
+        uid = storage.put(self.data)
+        key = sorted(cache.state)[0]
+        cache.state[key] = b'corrupt'
+        assert storage.get(uid) == self.data
+        assert cache.state[key] != b'corrupt'
+
+
+class TestDedupedData:
+    def setup_method(self):
+        self.config = Config(bucket='bucket', prefix='prefix',
+                             dedupe_data=True, dedupe_min_size=100)
+        self.data = {'query': 'foo',
+                     'data': [{'index': i} for i in range(100)]}
+
+    def test_data_stored_once(self, fake_client):
+        metrics = Metrics()
+        storage = S3Storage(fake_client, self.config, metrics=metrics)
+        first = storage.put(self.data)
+        second = storage.put(dict(self.data, query='bar'))
+        bucket = fake_client.documents()
+        data_keys = [k for k in bucket if k.startswith('prefix/data/')]
+        assert len(data_keys) == 1
+        assert len(bucket) == 3
+        assert metrics.counter('s3.put.data') == 1
+        assert metrics.counter('s3.put.data_deduped') == 1
+        assert storage.get(first) == self.data
+        assert storage.get(second) == dict(self.data, query='bar')
+        assert storage.get_metadata(second) == {'query': 'bar'}
+        chunks = list(storage.iter_raw(first, chunk_size=100))
+        assert json.loads(b''.join(chunks)) == self.data
+
+    def test_data_stored_when_head_is_forbidden(self, fake_client):
+        # Without s3:ListBucket a missing key is a 403, not a 404.
+        def head_object(Bucket, Key):
+            raise ClientError({'Error': {'Code': '403'}}, 'HeadObject')
+
+        fake_client.head_object = head_object
+        storage = S3Storage(fake_client, self.config)
+        uid = storage.put(self.data)
+        assert storage.get(uid) == self.data
+
+    def test_small_data_stored_inline(self, fake_client):
+        storage = S3Storage(fake_client, self.config)
+        uid = storage.put({'query': 'foo', 'data': 'bar'})
+        assert list(fake_client.documents()) == ['prefix/%s' % uid]
+        assert storage.data_ref({'query': 'foo', 'data': 'bar'}) is None
+
+    def test_cached_data_not_checked(self, fake_client):
+        cache = FakeRawCache()
+        storage = S3Storage(fake_client, self.config, chunk_cache=cache)
+        storage.put(self.data)
+        fake_client.calls = []
+        uid = storage.put(self.data)
+        assert [c for c in fake_client.calls if '/paths/' not in c[1]] == [
+            ('put_object', 'prefix/%s' % uid)]
+
+    def test_corrupt_data_detected(self, fake_client):
+        storage = S3Storage(fake_client, self.config)
+        uid = storage.put(self.data)
+        bucket = fake_client.state['bucket']
+        data_key = [k for k in bucket if '/data/' in k][0]
+        bucket[data_key] = b'[]'
+        with raises(ValueError):
+            storage.get(uid)
+
+    def test_chunked_data(self, fake_client):
+        config = Config(bucket='bucket', dedupe_data=True, chunk_size=100,
+                        dedupe_min_size=100)
+        storage = S3Storage(fake_client, config)
+        uid = storage.put(self.data)
+        assert storage.get(uid) == self.data
+
+    def test_cache_shares_data(self, fake_client):
+        cache = FakeRawCache()
+        real_storage = S3Storage(fake_client, self.config, chunk_cache=cache)
+        storage = CachingStorage(real_storage, cache)
+        first = storage.put(self.data)
+        second = storage.put(dict(self.data, query='bar'))
+        assert len([k for k in cache.state if k.startswith('data:')]) == 1
+        assert first not in cache.state
+        fake_client.calls = []
+        assert storage.get(second) == dict(self.data, query='bar')
+        assert json.loads(storage.get_raw(first)) == self.data
+        assert storage.get_metadata(first) == {'query': 'foo'}
+        assert fake_client.calls == []
+
+    def test_cache_misses_cached_in_parts(self, fake_client):
+        cache = FakeRawCache()
+        uid = S3Storage(fake_client, self.config).put(self.data)
+        real_storage = S3Storage(fake_client, self.config)
+        storage = CachingStorage(real_storage, cache)
+        assert json.loads(storage.get_raw(uid)) == self.data
+        digest = real_storage.data_ref(self.data)
+        assert sorted(cache.state) == sorted(['%s:ref' % uid,
+                                             'data:%s' % digest])
+        fake_client.calls = []
+        assert storage.get(uid) == self.data
+        assert fake_client.calls == []
+
+
+class UnavailableS3Client(FakeS3Client):
+    def get_object(self, Bucket, Key, Range=None):
+        raise ClientError({'Error': {'Code': 'InternalError'},
+                           'ResponseMetadata': {'HTTPStatusCode': 500}},
+                          'GetObject')
+
+
+class TestCircuitBreakingStorage:
+    def test_opens_on_s3_errors(self):
+        client = UnavailableS3Client()
+        storage = CircuitBreakingStorage(
+            S3Storage(client, Config(bucket='bucket')), min_calls=2)
+        for _ in range(2):
+            with raises(ClientError):
+                storage.get('uuid')
+        assert storage.breaker.state == 'open'
+        client.calls = []
+        with raises(CircuitOpenError):
+            storage.get_raw('uuid')
+        with raises(CircuitOpenError):
+            storage.put({'query': 'foo'})
+        with raises(CircuitOpenError):
+            storage.get_index('recent')
+        assert client.calls == []
+
+    def test_batch_uploads_counted_individually(self):
+        client = UnavailableS3Client()
+
+        def put_object(Bucket, Key, Body, **kwargs):
+            raise ClientError({'Error': {'Code': 'InternalError'},
+                               'ResponseMetadata': {'HTTPStatusCode': 500}},
+                              'PutObject')
+
+        client.put_object = put_object
+        storage = CircuitBreakingStorage(
+            S3Storage(client, Config(bucket='bucket')), min_calls=3)
+        results = storage.put_many([{'query': 'foo'}] * 3)
+        assert all(isinstance(r, ClientError) for r in results)
+        assert storage.breaker.stats()['failures'] == 3
+        assert storage.breaker.state == 'open'
+        # A batch that can't be saved at all fails fast.
+        with raises(CircuitOpenError):
+            storage.put_many([{'query': 'foo'}] * 3)
+
+    def test_missing_keys_dont_count(self, fake_client):
+        storage = CircuitBreakingStorage(
+            S3Storage(fake_client, Config(bucket='bucket')), min_calls=2)
+        for _ in range(4):
+            with raises(ClientError):
+                storage.get('uuid')
+        assert storage.breaker.state == 'closed'
+
+    def test_cache_served_while_open(self):
+        client = UnavailableS3Client()
+        storage = CircuitBreakingStorage(
+            S3Storage(client, Config(bucket='bucket')), min_calls=1)
+        with raises(ClientError):
+            storage.get('other')
+        cache = {'uuid': {'query': 'foo', 'data': 'bar'}}
+        caching = CachingStorage(storage, cache)
+        assert caching.get('uuid') == {'query': 'foo', 'data': 'bar'}
+        with raises(CircuitOpenError):
+            caching.get('other')
 
 
 class TestCachingStorage:
+    def test_metadata_uses_cached_document(self, mock_storage):
+        cache = {'uuid': {'query': 'foo', 'data': 'bar'}}
+        storage = CachingStorage(mock_storage, cache)
+        assert storage.get_fields('uuid', ['query']) == {'query': 'foo'}
+        assert not mock_storage.get_metadata.called
+
+    def test_metadata_cached_separately(self, mock_storage):
+        cache = {}
+        mock_storage.get_metadata.return_value = {'query': 'foo'}
+        storage = CachingStorage(mock_storage, cache)
+        assert storage.get_metadata('uuid') == {'query': 'foo'}
+        assert storage.get_metadata('uuid') == {'query': 'foo'}
+        assert mock_storage.get_metadata.call_count == 1
+        assert 'uuid' not in cache
+
+    def test_new_shares_published(self, mock_storage, fake_client):
+        cache = {}
+        mock_storage.put.return_value = 'uuid'
+        publisher = Publisher(fake_client, 'bucket', 'public')
+        storage = CachingStorage(mock_storage, cache, publisher=publisher)
+        storage.put({'query': 'foo', 'data': 'bar'})
+        assert 'public/uuid.json' in fake_client.state['bucket']
+        assert cache['uuid:published'] is True
+        # Reads don't publish it again.
+        fake_client.calls = []
+        storage.get('uuid')
+        assert fake_client.calls == []
+
+    def test_popular_shares_published(self, mock_storage, fake_client):
+        cache = {'uuid': {'query': 'foo', 'data': 'bar'}}
+        publisher = Publisher(fake_client, 'bucket', 'public', threshold=3)
+        storage = CachingStorage(mock_storage, cache, publisher=publisher)
+        storage.put({'query': 'foo', 'data': 'bar'})
+        assert 'bucket' not in fake_client.state
+        storage.get('uuid')
+        storage.get('uuid')
+        assert 'bucket' not in fake_client.state
+        storage.get('uuid')
+        body = fake_client.state['bucket']['public/uuid.json']
+        assert json.loads(gzip.decompress(body)) == cache['uuid']
+        storage.get('uuid')
+        assert fake_client.calls == [('head_object', 'public/uuid.json'),
+                                     ('put_object', 'public/uuid.json')]
+
+    def test_shares_published_by_other_containers_not_republished(
+            self, mock_storage, fake_client):
+        cache = {'uuid': {'query': 'foo', 'data': 'bar'}}
+        publisher = Publisher(fake_client, 'bucket', 'public', threshold=1)
+        publisher.publish('uuid', b'{}')
+        fake_client.calls = []
+        storage = CachingStorage(mock_storage, cache, publisher=publisher)
+        storage.get('uuid')
+        storage.get('uuid')
+        assert fake_client.calls == [('head_object', 'public/uuid.json')]
+        assert cache['uuid:published'] is True
+
+    def test_reads_dont_publish_without_threshold(self, mock_storage,
+                                                  fake_client):
+        cache = {'uuid': {'query': 'foo', 'data': 'bar'}}
+        publisher = Publisher(fake_client, 'bucket', 'public')
+        storage = CachingStorage(mock_storage, cache, publisher=publisher)
+        storage.get('uuid')
+        assert fake_client.calls == []
+
+    def test_read_counts_are_bounded(self, mock_storage, fake_client,
+                                     monkeypatch):
+        monkeypatch.setattr(storage_module, 'MAX_TRACKED_READS', 10)
+        cache = dict(('uuid%s' % i, {'query': 'foo'}) for i in range(20))
+        publisher = Publisher(fake_client, 'bucket', 'public', threshold=4)
+        storage = CachingStorage(mock_storage, cache, publisher=publisher)
+        for _ in range(3):
+            storage.get('uuid0')
+        for i in range(1, 11):
+            storage.get('uuid%s' % i)
+        # Shares read once were dropped and uuid0's count was halved.
+        assert storage._reads == {'uuid0': 1}
+
+    def test_paths_are_cached(self, mock_storage):
+        cache = {}
+        mock_storage.get_paths.return_value = {'paths': [],
+                                               'truncated': False}
+        storage = CachingStorage(mock_storage, cache)
+        assert storage.get_paths('uuid') == {'paths': [], 'truncated': False}
+        assert storage.get_paths('uuid') == {'paths': [], 'truncated': False}
+        assert mock_storage.get_paths.call_count == 1
+        assert 'uuid:paths' in cache
+
     def test_not_in_cache_calls_real_storage(self, mock_storage):
         cache = {}
         mock_storage.get.return_value = {'foo': 'bar'}
@@ -134,6 +903,27 @@ class TestCachingStorage:
         assert mock_storage.get.call_count == 1
         assert 'uuid' in cache
 
+    def test_reads_and_puts_are_recorded(self, mock_storage):
+        listings = mock.Mock()
+        mock_storage.put.return_value = 'uuid'
+        storage = CachingStorage(mock_storage, {}, listings=listings)
+        storage.put({'query': 'foo'})
+        storage.get('uuid')
+        listings.record_put.assert_called_with('uuid', {'query': 'foo'})
+        listings.record_read.assert_called_with('uuid')
+
+    def test_put_many_caches_saved_documents(self, mock_storage):
+        cache = FakeRawCache()
+        listings = mock.Mock()
+        error = MaxSizeError()
+        mock_storage.put_many.return_value = ['first', error, 'third']
+        storage = CachingStorage(mock_storage, cache, listings=listings)
+        documents = [{'query': 'a'}, {'query': 'b'}, {'query': 'c'}]
+        assert storage.put_many(documents) == ['first', error, 'third']
+        assert sorted(cache.state) == ['first', 'third']
+        assert cache['third'] == {'query': 'c'}
+        assert listings.record_put.call_count == 2
+
     def test_assert_put_inserts_in_cache(self, mock_storage):
         cache = {}
         mock_storage.put.return_value = 'returned-uuid'
@@ -0,0 +1,121 @@
+import json
+from io import BytesIO
+from wsgiref.util import setup_testing_defaults
+
+from chalice import Chalice
+from pytest import fixture
+
+from chalicelib.wsgi import WSGIAdapter
+
+
+@fixture
+def chalice_app():
+    app = Chalice(app_name='test-app')
+
+    @app.route('/items', methods=['POST'])
+    def create():
+        return {'created': app.current_request.json_body}
+
+    @app.route('/items/latest')
+    def latest():
+        return {'latest': True}
+
+    @app.route('/items/{name}')
+    def get_item(name):
+        params = app.current_request.query_params or {}
+        return {'name': name, 'params': params}
+
+    return app
+
+
+def call(wsgi_app, path, method='GET', body=b'', query='',
+         content_type='application/json'):
+    environ = {}
+    setup_testing_defaults(environ)
+    environ.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'CONTENT_LENGTH': str(len(body)),
+        'CONTENT_TYPE': content_type,
+        'wsgi.input': BytesIO(body),
+    })
+    response = {}
+
+    def start_response(status, headers):
+        response['status'] = status
+        response['headers'] = dict(headers)
+
+    chunks = list(wsgi_app(environ, start_response))
+    return response['status'], response['headers'], chunks
+
+
+def test_can_call_chalice_routes(chalice_app):
+    adapter = WSGIAdapter(chalice_app)
+    status, _, chunks = call(adapter, '/items/foo', query='a=b')
+    assert status == '200 OK'
+    assert json.loads(b''.join(chunks)) == {
+        'name': 'foo', 'params': {'a': 'b'}}
+
+
+def test_static_routes_matched_first(chalice_app):
+    adapter = WSGIAdapter(chalice_app)
+    _, _, chunks = call(adapter, '/items/latest')
+    assert json.loads(b''.join(chunks)) == {'latest': True}
+
+
+def test_can_post_json(chalice_app):
+    adapter = WSGIAdapter(chalice_app)
+    _, _, chunks = call(adapter, '/items', method='POST', body=b'{"a":1}')
+    assert json.loads(b''.join(chunks)) == {'created': {'a': 1}}
+
+
+def test_ignores_default_content_type_without_body(chalice_app):
+    adapter = WSGIAdapter(chalice_app)
+    status, _, _ = call(adapter, '/items/latest', content_type='text/plain')
+    assert status == '200 OK'
+
+
+def test_unknown_route(chalice_app):
+    adapter = WSGIAdapter(chalice_app)
+    status, _, _ = call(adapter, '/unknown')
+    assert status == '404 Not Found'
+
+
+def test_streaming_route(chalice_app):
+    def stream(name, identity):
+        assert identity == {'sourceIp': '127.0.0.1'}
+        return iter([b'{"name":', b'"%s"}' % name.encode('utf-8')])
+
+    adapter = WSGIAdapter(chalice_app,
+                          streaming_routes={'/items/{name}': stream})
+    status, headers, chunks = call(adapter, '/items/foo')
+    assert status == '200 OK'
+    assert headers['Content-Type'] == 'application/json'
+    assert chunks == [b'{"name":', b'"foo"}']
+
+
+def test_streaming_errors_fall_back_to_chalice(chalice_app):
+    def stream(name, identity):
+        raise KeyError(name)
+
+    adapter = WSGIAdapter(chalice_app,
+                          streaming_routes={'/items/{name}': stream})
+    status, _, chunks = call(adapter, '/items/foo')
+    assert status == '200 OK'
+    assert json.loads(b''.join(chunks))['name'] == 'foo'
+
+
+def test_streaming_upload(chalice_app):
+    def stream(name, body, length, identity):
+        for line in body.read(length).splitlines():
+            yield b'{"%s":%s}\n' % (name.encode('utf-8'), line)
+
+    adapter = WSGIAdapter(chalice_app,
+                          streaming_uploads={'/items/{name}': stream})
+    status, headers, chunks = call(adapter, '/items/foo', method='POST',
+                                   body=b'1\n2\n',
+                                   content_type='application/x-ndjson')
+    assert status == '200 OK'
+    assert headers['Content-Type'] == 'application/x-ndjson'
+    assert chunks == [b'{"foo":1}\n', b'{"foo":2}\n']